@@ -3,10 +3,11 @@ from argparse import Namespace
 import pickle
 import torch
 import torch.utils.data
-from .simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset
+from .simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset, collate_batch
 from .model.egno import EGNO
 from .utils import EarlyStopping, cumulative_random_tensor_indices_capped, random_ascending_tensor
 from torch_geometric.utils import to_dense_batch
+from utils import EnergyDriftAccumulator
 import os
 from torch import nn, optim
 import json
@@ -85,6 +86,8 @@ def get_args():
                         help='The number of particles.')
     parser.add_argument('--n_balls', type=int, default=5,
                         help='The number of modes.')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='DataLoader worker processes, kept alive across epochs.')
     return parser.parse_args()
 
 time_exp_dic = {'time': 0, 'counter': 0}
@@ -114,17 +117,20 @@ def main(config=None):
     dataset_train = SimulationDataset(partition='train', max_samples=args.max_training_samples,
                                       data_dir=args.data_dir,n_balls=args.n_balls, num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=varDt) #, num_inputs=args.num_inputs
     loader_train = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True,
-                                               num_workers=0)
+                                               num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                                               pin_memory=args.cuda, collate_fn=collate_batch)
 
     dataset_val = SimulationDataset(partition='val',
                                     data_dir=args.data_dir, n_balls=args.n_balls, num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=varDt)#num_inputs=args.num_inputs
     loader_val = torch.utils.data.DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False,
-                                             num_workers=0)
+                                             num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                                             pin_memory=args.cuda, collate_fn=collate_batch)
 
     dataset_test = SimulationDataset(partition='test',data_dir=args.data_dir, n_balls=args.n_balls, num_timesteps=args.num_timesteps, 
                                 num_inputs=args.num_inputs, rollout=args.rollout, traj_len=args.traj_len, varDT= varDt)
     loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False,
-                                              num_workers=0)
+                                              num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                                              pin_memory=args.cuda, collate_fn=collate_batch)
     
     if args.model == 'egno':
         model = EGNO(n_layers=args.n_layers, in_node_nf=1, in_edge_nf=2, hidden_nf=args.nf, device=device,
@@ -198,9 +204,12 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
     #print(f"this is the {loader.dataset.partition} partition")
     if rollout:
         first = True ## 0: target, 1: prediction
+        # per-timestep energy drift statistics, the full energies are only kept with --save_energies
+        drift = EnergyDriftAccumulator()
     
     for batch_idx, data in enumerate(loader):
-        data = [d.to(device) for d in data]
+        # edge_attr is None for datasets with store_edge_attr=False
+        data = [None if d is None else d.to(device) for d in data]
         loc, vel, edge_attr, charges, loc_true = data #loc_true.shape:[B, N, T, 3]
          #loc.shape : [B, num_inputs, N, 3], edge_attr.shape: [B, num_inputs*N, 1]
         
@@ -211,7 +220,7 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
             timesteps = None
             if args.num_inputs > 1 : #and rollout
                 
-                start = 30
+                start = loader.dataset.frame_index(30)
                 loc = loc.transpose(0,1) #T,B,N,3
                 vel = vel.transpose(0,1)
                 
@@ -221,11 +230,13 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                     vel = vel[start + timesteps]
                 
                 batch_size = loc.shape[1]
-                edges = loader.dataset.get_edges(batch_size, n_nodes)
-                edges = [edges[0].to(device), edges[1].to(device)]
+                edges = loader.dataset.get_edges(batch_size, n_nodes, device)
                 rows, cols = edges
                 
-                edge_attr_o = edge_attr.view(-1, edge_attr.shape[-1])
+                if edge_attr is None:
+                    edge_attr_o = loader.dataset.edge_attr_fun(charges, rows, cols)
+                else:
+                    edge_attr_o = edge_attr.view(-1, edge_attr.shape[-1])
 
                 loc_inputs = []
                 vel_inputs = []
@@ -260,12 +271,14 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 nodes = torch.sqrt(torch.sum(vel ** 2, dim=1)).unsqueeze(1).detach()
                 if charges is not None:
                     nodes = torch.cat([nodes, charges.view(-1, 1)], dim=1)
-                edges = loader.dataset.get_edges(batch_size, n_nodes)
-                edges = [edges[0].to(device), edges[1].to(device)]
+                edges = loader.dataset.get_edges(batch_size, n_nodes, device)
 
                 rows, cols = edges
                 loc_dist = torch.sum((loc[rows] - loc[cols])**2, 1).unsqueeze(1)  # relative distances among locations
-                edge_attr_o = edge_attr.view(-1, edge_attr.shape[-1])
+                if edge_attr is None:
+                    edge_attr_o = loader.dataset.edge_attr_fun(charges, rows, cols)
+                else:
+                    edge_attr_o = edge_attr.view(-1, edge_attr.shape[-1])
                 edge_attr = torch.cat([edge_attr_o, loc_dist], 1).detach()  # concatenate all edge properties
             
             
@@ -277,7 +290,7 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                     #print(loc_true.shape) #[100, 519, 5, 3]
                     loc_true = loc_true.transpose(0,1).reshape(-1, batch_size*n_nodes, 3) #[519, 500, 3]
                     #print(loc_true.shape)
-                    start = 30
+                    start = loader.dataset.frame_index(30)
                     locs_pred, steps = rollout_fn(model, nodes, loc, edges, vel, edge_attr_o, edge_attr,loc_mean, n_nodes, traj_len, batch_size,
                                                   charges=charges, variable_deltaT=args.variable_deltaT)
                     locs_pred = locs_pred.to(device) # (T,BN,3)
@@ -288,7 +301,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 else:
                     locs_pred, energies, energies_allsteps = rollout_fn(model, nodes, loc, edges, vel, edge_attr_o, edge_attr,loc_mean, n_nodes, traj_len, batch_size,
                                                                         charges=charges, num_steps=args.num_timesteps, timesteps=timesteps, 
-                                                                        energy_fun=loader.dataset.energy_fun)
+                                                                        energy_fun=loader.dataset.energy_fun, drift=drift,
+                                                                        keep_energies=args.save_energies)
                     locs_pred = locs_pred.to(device)
                     locs_true = loc_true.view(batch_size * n_nodes, args.num_timesteps*traj_len, 3).transpose(0, 1)
 
@@ -302,7 +316,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 
                 locs_pred = locs_pred[:sup]
                 locs_true = locs_true[:sup]
-                energies_allsteps = energies_allsteps[:sup]
+                if args.save_energies:
+                    energies_allsteps = energies_allsteps[:sup]
                 #print(torch.isnan(locs_pred).any(), torch.isinf(locs_pred).any())
 
                 # print("check reshape:")
@@ -311,7 +326,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 batch = torch.arange(batch_size).repeat_interleave(n_nodes).to(locs_pred.device)  # [BN]
                 targets = to_dense_batch(locs_true.permute(1,0,2), batch)[0].permute(0, 2, 1, 3) # (B, T, N, 3)
                 preds = to_dense_batch(locs_pred.permute(1,0,2), batch)[0].permute(0, 2, 1, 3) # (B, T, N, 3)
-                energies_allsteps = energies_allsteps.permute(1,0,2) # (B, T, 1)
+                if args.save_energies:
+                    energies_allsteps = energies_allsteps.permute(1,0,2) # (B, T, 1)
                 if first:
                     traj_targ = targets
                     traj_pred = preds
@@ -320,7 +336,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 else:
                     traj_targ = torch.cat((traj_targ, targets), dim=0)
                     traj_pred = torch.cat((traj_pred, preds), dim=0)
-                    traj_energies = torch.cat((traj_energies, energies_allsteps), dim=0)
+                    if args.save_energies:
+                        traj_energies = torch.cat((traj_energies, energies_allsteps), dim=0)
                 
                 # print(torch.sum(locs_pred-locs_true))
                 # print("checked")
@@ -363,7 +380,12 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
 
     if rollout:
         wandb.log({f"{loader.dataset.partition}_loss": avg_loss,"avg_num_steps": res['avg_num_steps']}, step=epoch)
-        return avg_loss, {'targets': traj_targ, 'preds': traj_pred, 'energy_conservation': traj_energies, 'test_loss': avg_loss}
+        # the drift statistics cover the same first sup timesteps as targets and preds
+        drift_summary = {key: value[:sup] for key, value in drift.summary().items()}
+        trajectories = {'targets': traj_targ, 'preds': traj_pred, 'test_loss': avg_loss, **drift_summary}
+        if args.save_energies:
+            trajectories['energy_conservation'] = traj_energies
+        return avg_loss, trajectories
         # torch.stack((traj_targ,traj_pred), dim=0)
     else:
         wandb.log({f"{loader.dataset.partition}_loss": avg_loss}, step=epoch)
@@ -373,12 +395,11 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
 def rollout_fn(model, nodes, loc, edges, v, edge_attr_o, edge_attr, 
                loc_mean, n_nodes, traj_len, batch_size, charges=None,
                num_steps=10,variable_deltaT=False, timesteps=None, 
-               energy_fun=None):
+               energy_fun=None, drift=None, keep_energies=True):
     
     rand_timesteps = timesteps
     vel = v
     BN = batch_size*n_nodes
-    batch = torch.arange(batch_size).repeat_interleave(n_nodes).to(loc.device)  # [BN]
     if variable_deltaT:
     #   calculate random indices
         steps, steps_size = cumulative_random_tensor_indices_capped(N=traj_len,start=1,end=num_steps+3, MAX=num_steps*traj_len)
@@ -392,6 +413,12 @@ def rollout_fn(model, nodes, loc, edges, v, edge_attr_o, edge_attr,
 
     energies = []
     energies_allsteps = []
+    if energy_fun is not None:
+        # energy of the (last) input frame, that the drift is relative to
+        if loc.dim() == 3:
+            E0 = energy_fun(loc[-1], vel[-1], nodes[-1, :, -1:])
+        else:
+            E0 = energy_fun(loc, vel, nodes[:, -1:])
     for i in range(traj_len):
         #print("Inside loop \n")
         
@@ -430,14 +457,17 @@ def rollout_fn(model, nodes, loc, edges, v, edge_attr_o, edge_attr,
         loc = loc.view(-1, loc.shape[-1])
     
         if energy_fun is not None:
-            for j in range(num_steps):
-                en = energy_fun(loc_all[j], vel_all[j], nodes[:, -1:], batch=batch)
+            # all inner timesteps at once, on the device
+            en = energy_fun(loc_all, vel_all, nodes[:, -1:])  # [num_steps, B]
+            if drift is not None:
+                drift.update(en, E0, start=i * num_steps)
+            if keep_energies:
                 energies_allsteps.append(en)
-                if j == num_steps-1:
-                    energies.append(en)
+                energies.append(en[-1])
     
-    energies = torch.tensor(np.stack(energies)).unsqueeze(-1) if energy_fun is not None else None
-    energies_allsteps = torch.tensor(np.stack(energies_allsteps)).unsqueeze(-1) if energy_fun is not None else None
+    keep_energies = energy_fun is not None and keep_energies
+    energies = torch.stack(energies).unsqueeze(-1) if keep_energies else None
+    energies_allsteps = torch.cat(energies_allsteps).unsqueeze(-1) if keep_energies else None
     # print("\n outside loop \n")
     if not variable_deltaT:
         loc_preds = loc_preds.reshape(traj_len*num_steps, -1, 3)
@@ -2,7 +2,7 @@ import argparse
 from argparse import Namespace
 import torch
 import torch.utils.data
-from simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset
+from simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset, collate_batch
 from model.egno import EGNO
 from utils import EarlyStopping, cumulative_random_tensor_indices_capped, random_ascending_tensor
 import os
@@ -166,17 +166,17 @@ def main(config=None):
     dataset_train = SimulationDataset(partition='train', max_samples=args.max_training_samples,
                                       data_dir=args.data_dir,n_balls=args.n_balls, num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=varDt) #, num_inputs=args.num_inputs
     loader_train = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True,
-                                               num_workers=0)
+                                               num_workers=0, collate_fn=collate_batch)
 
     dataset_val = SimulationDataset(partition='val',
                                     data_dir=args.data_dir, n_balls=args.n_balls, num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=varDt)#num_inputs=args.num_inputs
     loader_val = torch.utils.data.DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False,
-                                             num_workers=0)
+                                             num_workers=0, collate_fn=collate_batch)
 
     dataset_test = SimulationDataset(partition='test',data_dir=args.data_dir, n_balls=args.n_balls, num_timesteps=args.num_timesteps, 
                                 num_inputs=args.num_inputs, rollout=args.rollout, traj_len=args.traj_len, varDT= varDt)
     loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False,
-                                              num_workers=0)
+                                              num_workers=0, collate_fn=collate_batch)
     
     if args.model == 'egno':
         model = EGNO(n_layers=args.n_layers, in_node_nf=1, in_edge_nf=2, hidden_nf=args.nf, device=device,
@@ -263,7 +263,7 @@ def train(model, optimizer, epoch, loader, args, backprop=True, rollout=False):
             timesteps = None
             if args.num_inputs > 1 : #and rollout
                 
-                start = 30
+                start = loader.dataset.frame_index(30)
                 loc = loc.transpose(0,1) #num_inputs,100,5,3
                 vel = vel.transpose(0,1)
                 
@@ -327,7 +327,7 @@ def train(model, optimizer, epoch, loader, args, backprop=True, rollout=False):
                     #print(loc_true.shape) #[100, 519, 5, 3]
                     loc_true = loc_true.transpose(0,1).reshape(-1, batch_size*n_nodes, 3) #[519, 500, 3]
                     #print(loc_true.shape)
-                    start = 30
+                    start = loader.dataset.frame_index(30)
                     locs_pred, steps = rollout_fn(model, nodes, loc, edges, vel, edge_attr_o, edge_attr,loc_mean, n_nodes, traj_len, batch_size,variable_deltaT=args.variable_deltaT)
                     locs_pred = locs_pred.to(device) # (T,BN,3)
                     end = steps[-1] + start
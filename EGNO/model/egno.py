@@ -3,6 +3,7 @@ from ..model.layer_no import TimeConv, get_timestep_embedding, TimeConv_x
 from ..utils import repeat_elements_to_exact_shape, random_ascending_tensor
 import torch.nn as nn
 import torch
+from topology import topology
 
 
 class EGNO(EGNN):
@@ -58,10 +59,8 @@ class EGNO(EGNN):
             num_nodes = h.shape[0]
             time_emb = get_timestep_embedding(torch.arange(T).to(x), embedding_dim=self.time_emb_dim, max_positions=10000)  # [T, H_t]
         
-        num_edges = edge_index[0].shape[0]
-        cumsum = torch.arange(0, T).to(self.device) * num_nodes
-        cumsum_nodes = cumsum.repeat_interleave(num_nodes, dim=0)
-        cumsum_edges = cumsum.repeat_interleave(num_edges, dim=0)
+        # edges of the T timesteps unrolled into one graph, cached for the edges of the topology cache
+        edge_index_T = topology.expand(edge_index, num_nodes, T)
 
         
 
@@ -116,16 +115,12 @@ class EGNO(EGNN):
             v = repeat_elements_to_exact_shape(v,T)
             loc_mean = repeat_elements_to_exact_shape(loc_mean,T)
             edge_fea = repeat_elements_to_exact_shape(edge_fea,T)
-            edges_0 = edge_index[0].repeat(T) + cumsum_edges
-            edges_1 = edge_index[1].repeat(T) + cumsum_edges
-            edge_index = [edges_0, edges_1]
+            edge_index = edge_index_T
             
         else:
             x = x.repeat(T, 1)
             loc_mean = loc_mean.repeat(T, 1)
-            edges_0 = edge_index[0].repeat(T) + cumsum_edges
-            edges_1 = edge_index[1].repeat(T) + cumsum_edges
-            edge_index = [edges_0, edges_1]
+            edge_index = edge_index_T
             v = v.repeat(T, 1)
 
             edge_fea = edge_fea.repeat(T, 1)
@@ -1,8 +1,23 @@
+import json
 import numpy as np
 import torch
 from pathlib import Path
-from utils import conserved_energy_fun
+from utils import conserved_energy_fun, dataset_cache_key, load_dataset_cache, save_dataset_cache
 from torch_geometric.utils import to_dense_batch
+from topology import topology
+from torch.utils.data import default_collate
+
+
+def collate_batch(batch):
+    """
+    collate_fn for the datasets below: __getitems__ already returns whole batches, one
+    tensor per field. Lists of per-item samples (DataLoaders that do not call
+    __getitems__) go through default_collate, field by field as the edge_attr of
+    datasets with store_edge_attr=False are None.
+    """
+    if isinstance(batch[0], torch.Tensor):
+        return batch
+    return [None if field[0] is None else default_collate(field) for field in zip(*batch)]
 
 
 class NBodyDataset():
@@ -11,7 +26,8 @@ class NBodyDataset():
 
     """
 
-    def __init__(self, data_dir, partition='train', max_samples=1e8, dataset="charged", dataset_name="nbody_small",n_balls=5):
+    def __init__(self, data_dir, partition='train', max_samples=1e8, dataset="charged", dataset_name="nbody_small",n_balls=5,
+                 sample_freq=None, mmap=False, cache_dir=None, store_edge_attr=True):
         self.partition = partition
         self.data_dir = data_dir
         if self.partition == 'val':
@@ -25,19 +41,124 @@ class NBodyDataset():
             self.suffix += f"_{dataset}{n_balls}_initvel1small"
         else:
             raise Exception("Wrong dataset name %s" % self.dataset_name)
+        if sample_freq is not None:
+            # coarser resolution written by derive_dataset.py
+            self.suffix += f"_sf{sample_freq}"
         
         self.n_balls = n_balls
         self.max_samples = int(max_samples)
         self.dataset_name = dataset_name
         self.dataset = dataset
+        self.mmap = mmap
+        self.cache_dir = cache_dir
+        # if False, only the charges are kept and the edge attributes of a batch are
+        # computed by edge_attr_fun on the device: O(S N) memory instead of O(S N^2)
+        self.store_edge_attr = store_edge_attr
         self.data, self.edges = self.load()
         
-    def energy_fun(self, loc, vel, edges, batch=None):
-        return conserved_energy_fun(self.dataset, loc, vel, edges, batch=batch)
+    def energy_fun(self, loc, vel, charges):
+        return conserved_energy_fun(self.dataset, loc, vel, charges, self.n_balls)
+
+    def edge_attr_fun(self, charges, rows, cols):
+        """
+        Edge attributes q_i q_j (m_i m_j for gravity) of a batch, as stored by preprocess.
+        :param charges: B x N x 1 charges or masses
+        :param rows, cols: edge indices of the batch, as given by get_edges
+        :return: E x 1 edge attributes
+        """
+        charges = charges.reshape(-1, 1)
+        return charges[rows] * charges[cols]
+
+    def load_manifest(self):
+        manifest_path = self.data_dir / f'manifest_{self.suffix}.json'
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def load_array(self, name):
+        """
+        Memory-map the {name}_{suffix}.npy output, or the strided view of a finer
+        dataset that derive_dataset.py recorded in the manifest. Nothing is read
+        until the returned array is sliced and copied.
+        """
+        view = self.manifest.get('views', {}).get(name)
+        if view is None:
+            return np.load(self.data_dir / f'{name}_{self.suffix}.npy', mmap_mode='r')
+        data = np.load(self.data_dir / view['file'], mmap_mode='r')
+        return data[:, view['start']::view['stride']]
+
+    def source_files(self):
+        """
+        Files load() reads, the manifest and the loc, vel and charges outputs (or the
+        finer datasets they are views of).
+        """
+        files = [self.data_dir / f'manifest_{self.suffix}.json'] if self.manifest else []
+        for name in ('loc', 'vel', 'charges'):
+            view = self.manifest.get('views', {}).get(name)
+            files.append(self.data_dir / (view['file'] if view else f'{name}_{self.suffix}.npy'))
+        return files
+
+    def cache_params(self):
+        """
+        Parameters the preprocessed tensors depend on, hashed into the cache key.
+        """
+        return dict(cls=type(self).__name__, suffix=self.suffix, dataset=self.dataset, n_balls=self.n_balls,
+                    max_samples=self.max_samples, dataset_name=self.dataset_name,
+                    store_edge_attr=self.store_edge_attr)
+
+    def frame_index(self, frame):
+        """
+        Position of trajectory frame `frame` in the loaded arrays. Data generated with
+        --keep_frames start:stop:stride only holds those frames, so offsets from it count
+        stored frames. Only the frame window from frame_window() is loaded, and positions
+        count from its first frame.
+        """
+        if self.frames is None:
+            return frame - self.window_start
+        start, stop, stride = self.frames['start'], self.frames['stop'], self.frames['stride']
+        assert start <= frame < stop and (frame - start) % stride == 0, \
+            "Frame {} was not kept, the data holds frames {}:{}:{}".format(frame, start, stop, stride)
+        return (frame - start) // stride - self.window_start
+
+    def first_frames(self):
+        if self.dataset_name == "nbody":
+            return 6, 8
+        elif self.dataset_name == "nbody_small":
+            return 30, 40
+        elif self.dataset_name == "nbody_small_out_dist":
+            return 20, 30
+        else:
+            raise Exception("Wrong dataset partition %s" % self.dataset_name)
+
+    def frame_window(self):
+        """
+        Stored frames start:stop that __getitem__ reads, the only ones loaded.
+        """
+        frame_0, frame_T = self.first_frames()
+        return self.frame_index(frame_0), self.frame_index(frame_T) + 1
 
     def load(self):
-        loc = np.load(self.data_dir / f'loc_{self.suffix}.npy') # shape (n_samples, n_timesteps, n_balls, 3)
-        vel = np.load(self.data_dir / f'vel_{self.suffix}.npy')
+        self.manifest = self.load_manifest()
+        # frame window kept by generate_dataset.py --keep_frames, recorded in the manifest
+        self.frames = self.manifest.get('frames')
+        self.window_start = 0
+        start, stop = self.frame_window()
+        key = None
+        if self.cache_dir is not None and not self.mmap:
+            # memory-mapped samples are converted as they are read, nothing to cache
+            key = dataset_cache_key(self.source_files(), window=(start, stop), **self.cache_params())
+            cached = load_dataset_cache(self.cache_dir, key)
+            if cached is not None:
+                self.window_start = start
+                print(f"Loaded dataset {self.suffix} from cache {key}")
+                return ((cached['loc'], cached['vel'], cached.get('edge_attr'), cached['charges']),
+                        cached['edges'].tolist())
+        # slice samples and frames of the memory maps before anything is read
+        loc = self.load_array('loc')[:self.max_samples, start:stop] # shape (n_samples, n_timesteps, n_balls, 3)
+        vel = self.load_array('vel')[:self.max_samples, start:stop]
+        # frame_index counts from the first loaded frame from now on
+        self.window_start = start
         if loc.shape[-2:] != (self.n_balls, 3):
             # should transpose the last two dimensions
             loc = np.transpose(loc, (0, 1, 3, 2))
@@ -45,169 +166,201 @@ class NBodyDataset():
             assert (loc.shape[-2:] == (self.n_balls, 3) and vel.shape[-2:] == (self.n_balls, 3)), "Shape mismatch!"
 
         # edges = np.load(self.data_dir / f'edges_{self.suffix}.npy')
-        charges = np.load(self.data_dir / f'charges_{self.suffix}.npy')
-        mat_charges = charges.repeat(charges.shape[1], axis=2)
-        edges = np.einsum('tij,tji ->tij', mat_charges, mat_charges)
+        charges = np.array(self.load_array('charges')[:self.max_samples])
+        edges = None
+        if self.store_edge_attr:
+            mat_charges = charges.repeat(charges.shape[1], axis=2)
+            edges = np.einsum('tij,tji ->tij', mat_charges, mat_charges)
         print(f"Loaded dataset {self.suffix} with {loc.shape[0]} samples, {loc.shape[2]} nodes, {loc.shape[3]} features")
         
         loc, vel, edge_attr, edges, charges = self.preprocess(loc, vel, edges, charges)
+        if key is not None:
+            tensors = dict(loc=loc, vel=vel, edge_attr=edge_attr, charges=charges, edges=np.array(edges))
+            save_dataset_cache(self.cache_dir, key, {name: x for name, x in tensors.items() if x is not None},
+                               self.cache_params())
         return (loc, vel, edge_attr, charges), edges
 
     def preprocess(self, loc, vel, edges, charges):
-        # cast to torch and swap n_nodes <--> n_features dimensions
-        loc, vel = torch.tensor(loc).float(), torch.tensor(vel).float()
-        n_nodes = loc.size(2)
-        loc = loc[0:self.max_samples, :, :, :]  # limit number of samples
-        vel = vel[0:self.max_samples, :, :, :]  # speed when starting the trajectory
-        charges = charges[0:self.max_samples]
-        edge_attr = []
+        # loc, vel are already limited to max_samples and the frame window
+        if not self.mmap:
+            # cast to float32 torch tensors, in a single copy
+            loc = torch.from_numpy(np.ascontiguousarray(loc, dtype=np.float32))
+            vel = torch.from_numpy(np.ascontiguousarray(vel, dtype=np.float32))
+        n_nodes = loc.shape[2]
 
         # Initialize edges and edge_attributes
         rows, cols = [], []
         for i in range(n_nodes):
             for j in range(n_nodes):
                 if i != j:
-                    edge_attr.append(edges[:, i, j])
                     rows.append(i)
                     cols.append(j)
+        edge_attr = None
+        if edges is not None:
+            # [batch_size, n_edges] and add nf dimension
+            edge_attr = torch.tensor(edges[:, rows, cols]).float().unsqueeze(2)
         edges = [rows, cols]
-        edge_attr = torch.tensor(np.array(edge_attr)).float().transpose(0, 1).unsqueeze(2) 
-        # swap n_nodes <--> batch_size and add nf dimension
         return loc, vel, edge_attr, edges, torch.tensor(charges).float()
 
     def set_max_samples(self, max_samples):
-        self.max_samples = int(max_samples)
+        max_samples = int(max_samples)
+        if not self.mmap and max_samples <= len(self.data[0]):
+            # a subset of the loaded samples
+            self.max_samples = max_samples
+            self.data = tuple(None if x is None else x[:max_samples] for x in self.data)
+            return
+        self.max_samples = max_samples
         self.data, self.edges = self.load()
 
     def get_n_nodes(self):
-        return self.data[0].size(1)
+        return self.data[0].shape[1]
 
-    def __getitem__(self, i):
+    def sample(self, i):
+        """
+        Sample i, or the batch of samples of an index tensor i.
+        """
         loc, vel, edge_attr, charges = self.data
-        loc, vel, edge_attr, charges = loc[i], vel[i], edge_attr[i], charges[i]
-
-        if self.dataset_name == "nbody":
-            frame_0, frame_T = 6, 8
-        elif self.dataset_name == "nbody_small":
-            frame_0, frame_T = 30, 40
-        elif self.dataset_name == "nbody_small_out_dist":
-            frame_0, frame_T = 20, 30
-        else:
-            raise Exception("Wrong dataset partition %s" % self.dataset_name)
+        if self.mmap:
+            # read and convert only the accessed samples
+            idx = i if isinstance(i, int) else np.asarray(i)
+            return (torch.from_numpy(np.ascontiguousarray(loc[idx], dtype=np.float32)),
+                    torch.from_numpy(np.ascontiguousarray(vel[idx], dtype=np.float32)),
+                    None if edge_attr is None else edge_attr[i], charges[i])
+        return loc[i], vel[i], None if edge_attr is None else edge_attr[i], charges[i]
 
+    def __getitem__(self, i):
+        loc, vel, edge_attr, charges = self.sample(i)
+        frame_0, frame_T = (self.frame_index(frame) for frame in self.first_frames())
         return loc[frame_0], vel[frame_0], edge_attr, charges, loc[frame_T]
 
+    def __getitems__(self, indices):
+        # the whole batch at once, as default_collate would stack __getitem__
+        loc, vel, edge_attr, charges = self.sample(torch.as_tensor(indices))
+        frame_0, frame_T = (self.frame_index(frame) for frame in self.first_frames())
+        return [loc[:, frame_0], vel[:, frame_0], edge_attr, charges, loc[:, frame_T]]
+
     def __len__(self):
         return len(self.data[0])
 
-    def get_edges(self, batch_size, n_nodes):
-        edges = [torch.LongTensor(self.edges[0]), torch.LongTensor(self.edges[1])]
-        if batch_size == 1:
-            return edges
-        elif batch_size > 1:
-            rows, cols = [], []
-            for i in range(batch_size):
-                rows.append(edges[0] + n_nodes * i)
-                cols.append(edges[1] + n_nodes * i)
-            edges = [torch.cat(rows), torch.cat(cols)]
-        return edges
+    def get_edges(self, batch_size, n_nodes, device='cpu'):
+        # fully connected, built once on the device and shared by all batches
+        return topology.edges(n_nodes, batch_size, device)
 
 
 class NBodyDynamicsDataset(NBodyDataset):
-    def __init__(self, partition='train', data_dir='.', max_samples=1e8, dataset="charged",dataset_name="nbody_small", n_balls=5, num_timesteps=10, num_inputs=1, rollout=False, traj_len=1,varDT=False):
+    def __init__(self, partition='train', data_dir='.', max_samples=1e8, dataset="charged",dataset_name="nbody_small", n_balls=5, num_timesteps=10, num_inputs=1, rollout=False, traj_len=1,varDT=False,
+                 sample_freq=None, mmap=False, cache_dir=None, store_edge_attr=True, windows=None, window_sampling='all'):
         self.num_timesteps = num_timesteps
         self.rollout = rollout
         self.traj_len = traj_len
         self.num_inputs = num_inputs
         self.var_dt = varDT
-        super(NBodyDynamicsDataset, self).__init__(data_dir, partition, max_samples, dataset, dataset_name, n_balls=n_balls)
+        # first frames start:stop:stride of sliding windows over the trajectories, every sample
+        # of every window with window_sampling='all', one random window per sample access with 'random'
+        self.windows = windows
+        self.window_sampling = window_sampling
+        super(NBodyDynamicsDataset, self).__init__(data_dir, partition, max_samples, dataset, dataset_name, n_balls=n_balls,
+                                                   sample_freq=sample_freq, mmap=mmap, cache_dir=cache_dir,
+                                                   store_edge_attr=store_edge_attr)
+        self.input_frames, self.target_frames = self.frame_indices()
+        self.shifts = self.window_shifts()
+        # frames of the trajectories returned with varDT and several inputs
+        self.traj_frames = self.data[0].shape[1] - int(self.shifts.max())
+        assert int(self.target_frames.max() + self.shifts.max()) < self.data[0].shape[1], \
+            "The windows {} run past the end of the trajectories".format(self.windows)
 
-    def __getitem__(self, i):
-        loc, vel, edge_attr, charges = self.data
-        loc, vel, edge_attr, charges = loc[i], vel[i], edge_attr[i], charges[i]
+    def cache_params(self):
+        return super().cache_params() | dict(num_timesteps=self.num_timesteps, num_inputs=self.num_inputs,
+                                             rollout=self.rollout, traj_len=self.traj_len, varDT=self.var_dt)
 
-        if self.dataset_name == "nbody":
-            frame_0, frame_T = 6, 8
-        elif self.dataset_name == "nbody_small":
-            frame_0, frame_T = 30, 40
-        elif self.dataset_name == "nbody_small_out_dist":
-            frame_0, frame_T = 20, 30
-        else:
-            raise Exception("Wrong dataset partition %s" % self.dataset_name)
-        
-        frame_T = frame_0 + self.num_timesteps
-        
-        if self.rollout:
-                
-            # if self.var_dt:
-            #     #return all locs so that after its possible to select different delta T across the trajectory
-            #     return loc[frame_0], vel[frame_0], edge_attr, charges, loc 
-            
-            delta_frame = frame_T - frame_0
-            for i in range(self.traj_len):
-                last = False
-                #location
-                if last:
-                    locs = [loc[frame_0 + delta_frame + ii - self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-                else:
-                    locs = [loc[frame_0 + delta_frame * ii // self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-                
-                locs = np.stack(locs, axis=1) 
-                
-                if i == 0: # first iter
-                    locs_m = locs
-                else:
-                    locs_m = np.concatenate((locs_m,locs),axis=1)
-                #velocity
-                if last:
-                    vels = [vel[frame_0 + delta_frame + ii - self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-                else:
-                    vels = [vel[frame_0 + delta_frame * ii // self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-                vels = np.stack(vels, axis=1)
-                if i == 0: # first iter
-                    vels_m = vels
-                else:
-                    vels_m = np.concatenate((vels_m,vels),axis=1)
-
-                frame_0 += self.num_timesteps
-                
-            frame_0 = 30
-            locs = locs_m
-            
+    def window_shifts(self):
+        """
+        Stored frames from the first frame to the first frame of every window, only 0 without windows.
+        """
+        if self.windows is None:
+            return torch.zeros(1, dtype=torch.long)
+        frame_0 = self.frame_index(self.first_frames()[0])
+        shifts = torch.tensor([self.frame_index(frame) - frame_0 for frame in range(*self.windows)])
+        assert len(shifts) and shifts.min() >= 0, \
+            "Windows {} must start from frame {} on".format(self.windows, self.first_frames()[0])
+        return shifts
 
-        else:
-            delta_frame = frame_T - frame_0
-            last = False
-            if last:
-                locs = [loc[frame_0 + delta_frame + ii - self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-            else:
-                locs = [loc[frame_0 + delta_frame * ii // self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-            locs = np.stack(locs, axis=1)
-            if last:
-                vels = [vel[frame_0 + delta_frame + ii - self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-            else:
-                vels = [vel[frame_0 + delta_frame * ii // self.num_timesteps] for ii in range(1, self.num_timesteps + 1)]
-            vels = np.stack(vels, axis=1)
+    def locate(self, i):
+        """
+        Trajectory and window shift of sample i, an int or an index tensor. The index is not stored,
+        sample i is the window i // n_trajectories of trajectory i % n_trajectories, so contiguous
+        samples (the blocks of BlockShuffleSampler) come from different trajectories.
+        """
+        if self.windows is None:
+            return i, 0
+        if self.window_sampling == 'random':
+            # a new random window of the trajectory at every access
+            return i, self.shifts[torch.randint(len(self.shifts), torch.as_tensor(i).shape)]
+        return i % len(self.data[0]), self.shifts[i // len(self.data[0])]
 
-        if self.var_dt and self.num_inputs>1:
-                
-            assert self.num_inputs <= self.num_timesteps
-            # idxs = torch.linspace(0, self.num_timesteps - 1, self.num_inputs, dtype=int)
-            # loc_inputs = loc[frame_0 + idxs]
-            # vel_inputs = vel[frame_0 + idxs]
-            
-            return loc, vel, edge_attr, charges, locs
-        
-        elif self.num_inputs > 1:
+    def frame_window(self):
+        shifts = self.window_shifts()
+        if self.var_dt and self.num_inputs > 1:
+            # the whole trajectory from frame_0 is returned
+            return self.frame_index(self.first_frames()[0]), None
+        input_frames, target_frames = self.frame_indices()
+        frames = torch.cat((torch.as_tensor(input_frames).view(-1), target_frames))
+        return int(frames.min() + shifts.min()), int(frames.max() + shifts.max()) + 1
+
+    def frame_indices(self):
+        """
+        Frames of a sample that __getitem__ gathers, computed once: the input frame(s)
+        (an int, or num_inputs frames spread over the first num_timesteps) and the
+        num_timesteps * traj_len target frames following the first input (num_timesteps
+        without rollout). Windows shift them all.
+        """
+        frame_0 = self.frame_index(self.first_frames()[0])
+        traj_len = self.traj_len if self.rollout else 1
+        targets = frame_0 + torch.arange(1, self.num_timesteps * traj_len + 1)
+        if self.rollout:
+            # rollouts always start from frame 30
+            frame_0 = self.frame_index(30)
+        if self.num_inputs > 1:
             assert self.num_inputs <= self.num_timesteps
             idxs = torch.linspace(0, self.num_timesteps - 1, self.num_inputs, dtype=int)
-            loc_inputs = loc[frame_0 + idxs]
-            vel_inputs = vel[frame_0 + idxs]
-            # TODO: cosa fanno edge_attr?
-            return loc_inputs, vel_inputs, edge_attr, charges, locs
+            return frame_0 + idxs, targets
+        return frame_0, targets
 
-        
-        return loc[frame_0], vel[frame_0], edge_attr, charges, locs
+    def __len__(self):
+        if self.windows is not None and self.window_sampling == 'all':
+            return len(self.data[0]) * len(self.shifts)
+        return len(self.data[0])
+
+    def __getitem__(self, i):
+        i, shift = self.locate(i)
+        loc, vel, edge_attr, charges = self.sample(i)
+        # target frames, [n_nodes, T, 3]
+        locs = loc[self.target_frames + shift].transpose(0, 1)
+
+        if self.var_dt and self.num_inputs>1:
+            # the model picks its inputs from the whole trajectory
+            shift = int(shift)
+            return loc[shift:shift + self.traj_frames], vel[shift:shift + self.traj_frames], edge_attr, charges, locs
+
+        return loc[self.input_frames + shift], vel[self.input_frames + shift], edge_attr, charges, locs
+
+    def __getitems__(self, indices):
+        # the whole batch with one gather per field, as default_collate would stack __getitem__
+        i, shifts = self.locate(torch.as_tensor(indices))
+        loc, vel, edge_attr, charges = self.sample(i)
+        batch = torch.arange(len(loc)).unsqueeze(1)
+        shifts = torch.as_tensor(shifts).expand(len(loc)).unsqueeze(1)
+        # target frames, [batch, n_nodes, T, 3]
+        locs = loc[batch, self.target_frames + shifts].transpose(1, 2).contiguous()
+
+        if self.var_dt and self.num_inputs>1:
+            frames = torch.arange(self.traj_frames) + shifts
+            return [loc[batch, frames], vel[batch, frames], edge_attr, charges, locs]
+
+        # [batch, num_inputs] frames, or [batch] for one input
+        frames = (torch.as_tensor(self.input_frames) + shifts).squeeze(-1)
+        batch = batch.view(-1, *[1] * (frames.dim() - 1))
+        return [loc[batch, frames], vel[batch, frames], edge_attr, charges, locs]
 
 
 if __name__ == "__main__":
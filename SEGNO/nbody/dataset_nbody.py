@@ -1,7 +1,21 @@
+import json
 import numpy as np
 import torch
-from utils import conserved_energy_fun
+from utils import conserved_energy_fun, dataset_cache_key, load_dataset_cache, save_dataset_cache
 from torch_geometric.utils import to_dense_batch
+from topology import topology
+from torch.utils.data import default_collate
+
+
+def collate_batch(batch):
+    """
+    collate_fn for NBodyDataset: __getitems__ already returns whole batches, one
+    tensor per field. Lists of per-item samples (DataLoaders that do not call
+    __getitems__) go through default_collate.
+    """
+    if isinstance(batch[0], torch.Tensor):
+        return batch
+    return default_collate(batch)
 
 
 class NBodyDataset():
@@ -9,7 +23,8 @@ class NBodyDataset():
     NBodyDataset
     """
 
-    def __init__(self, data_dir, partition='train', max_samples=1e8, dataset="charged",dataset_name="nbody_small", n_balls=5):
+    def __init__(self, data_dir, partition='train', max_samples=1e8, dataset="charged",dataset_name="nbody_small", n_balls=5,
+                 sample_freq=None, mmap=False, cache_dir=None, frames=None, windows=None, window_sampling='all'):
         self.partition = partition
         self.data_dir = data_dir
         if self.partition == 'val':
@@ -23,54 +38,237 @@ class NBodyDataset():
             self.suffix += f"_{dataset}{n_balls}_initvel1small"
         else:
             raise Exception("Wrong dataset name %s" % self.dataset_name)
+        if sample_freq is not None:
+            # coarser resolution written by derive_dataset.py
+            self.suffix += f"_sf{sample_freq}"
 
         self.n_balls = n_balls
         self.max_samples = int(max_samples)
         self.dataset_name = dataset_name
         self.dataset = dataset
+        self.mmap = mmap
+        self.cache_dir = cache_dir
+        # stored frames after frame 30 that the samples hold, all of them from frame 30 on if None
+        self.offsets = None if frames is None else np.unique(np.asarray(frames, dtype=int))
+        # frames start:stop:stride that sliding windows start from in place of frame 30, every sample
+        # of every window with window_sampling='all', one random window per sample access with 'random'
+        self.windows = windows
+        self.window_sampling = window_sampling
         self.data, self.edges = self.load()
+        self.shifts = self.window_shifts()
+        if self.offsets is not None:
+            # positions of the frames of a sample in the loaded window, before the shift of its window
+            self.window_frames = torch.as_tensor(self.offsets - self.offsets[0]) - self.shifts.min()
+        else:
+            self.window_frames = torch.arange(self.data[0].shape[1] - int(self.shifts.max()))
+        assert len(self.window_frames) and int(self.window_frames.max() + self.shifts.max()) < self.data[0].shape[1], \
+            "The windows {} run past the end of the trajectories".format(self.windows)
+
+    def energy_fun(self, loc, vel, charges):
+        return conserved_energy_fun(self.dataset, loc, vel, charges, self.n_balls)
+
+    def load_manifest(self):
+        manifest_path = self.data_dir / f'manifest_{self.suffix}.json'
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def load_array(self, name):
+        """
+        Memory-map the {name}_{suffix}.npy output, or the strided view of a finer
+        dataset that derive_dataset.py recorded in the manifest. Nothing is read
+        until the returned array is sliced and copied.
+        """
+        view = self.manifest.get('views', {}).get(name)
+        if view is None:
+            return np.load(self.data_dir / f'{name}_{self.suffix}.npy', mmap_mode='r')
+        data = np.load(self.data_dir / view['file'], mmap_mode='r')
+        return data[:, view['start']::view['stride']]
+
+    def source_files(self):
+        """
+        Files load() reads, the manifest and the loc, vel and charges outputs (or the
+        finer datasets they are views of).
+        """
+        files = [self.data_dir / f'manifest_{self.suffix}.json'] if self.manifest else []
+        for name in ('loc', 'vel', 'charges'):
+            view = self.manifest.get('views', {}).get(name)
+            files.append(self.data_dir / (view['file'] if view else f'{name}_{self.suffix}.npy'))
+        return files
+
+    def cache_params(self):
+        """
+        Parameters the preprocessed tensors depend on, hashed into the cache key.
+        """
+        return dict(cls=type(self).__name__, suffix=self.suffix, dataset=self.dataset, n_balls=self.n_balls,
+                    max_samples=self.max_samples, dataset_name=self.dataset_name,
+                    frames=None if self.offsets is None else self.offsets.tolist(), windows=self.windows)
+
+    def frame_index(self, frame):
+        """
+        Position of trajectory frame `frame` in the loaded arrays. Data generated with
+        --keep_frames start:stop:stride only holds those frames, so offsets from it count
+        stored frames. Only the frame window from frame_window() is loaded, and positions
+        count from its first frame.
+        """
+        if self.frames is None:
+            return frame - self.window_start
+        start, stop, stride = self.frames['start'], self.frames['stop'], self.frames['stride']
+        assert start <= frame < stop and (frame - start) % stride == 0, \
+            "Frame {} was not kept, the data holds frames {}:{}:{}".format(frame, start, stop, stride)
+        return (frame - start) // stride - self.window_start
+
+    def frame_positions(self, offsets):
+        """
+        Positions in the samples of the stored frames `offsets` after frame 30.
+        """
+        offsets = np.asarray(offsets)
+        if self.offsets is None:
+            return self.frame_index(30) + offsets
+        positions = np.searchsorted(self.offsets, offsets)
+        assert np.array_equal(self.offsets[np.minimum(positions, len(self.offsets) - 1)], offsets), \
+            "Frames {} are not in the dataset frames {}".format(offsets, self.offsets)
+        return positions
 
-    def energy_fun(self, loc, vel, edges, batch=None):
-        return conserved_energy_fun(self.dataset, loc, vel, edges, batch=batch)
+    def window_shifts(self):
+        """
+        Stored frames from frame 30 to the first frame of every window, only 0 without windows.
+        """
+        if self.windows is None:
+            return torch.zeros(1, dtype=torch.long)
+        frame_0 = self.frame_index(30)
+        shifts = torch.tensor([self.frame_index(frame) - frame_0 for frame in range(*self.windows)])
+        assert len(shifts) and shifts.min() >= 0, "Windows {} must start from frame 30 on".format(self.windows)
+        return shifts
+
+    def locate(self, i):
+        """
+        Trajectories and window shifts of the samples of index tensor i. The index is not stored,
+        sample i is the window i // n_trajectories of trajectory i % n_trajectories, so contiguous
+        samples (the blocks of BlockShuffleSampler) come from different trajectories.
+        """
+        if self.window_sampling == 'random':
+            # a new random window of the trajectory at every access
+            return i, self.shifts[torch.randint(len(self.shifts), i.shape)]
+        return i % len(self.data[0]), self.shifts[i // len(self.data[0])]
+
+    def frame_window(self):
+        """
+        Stored frames start:stop that training reads, the only ones loaded: the
+        rollouts start from frame 30 (6 and 20 for the other datasets) and may run
+        to the end of the trajectories. With frames, only those after frame 30 (after
+        the first frame of each window).
+        """
+        if self.offsets is not None:
+            frame_0 = self.frame_index(30)
+            shifts = self.window_shifts()
+            return (frame_0 + int(self.offsets[0] + shifts.min()),
+                    frame_0 + int(self.offsets[-1] + shifts.max()) + 1)
+        if self.dataset_name == "nbody":
+            frame_0 = 6
+        elif self.dataset_name == "nbody_small_out_dist":
+            frame_0 = 20
+        else:
+            frame_0 = 30
+        return self.frame_index(frame_0), None
 
     def load(self):
+        self.manifest = self.load_manifest()
+        # frame window kept by generate_dataset.py --keep_frames, recorded in the manifest
+        self.frames = self.manifest.get('frames')
+        self.window_start = 0
+        # frames of the window the samples hold
+        self.select = slice(None)
+        start, stop = self.frame_window()
+        key = None
+        if self.cache_dir is not None and not self.mmap:
+            # memory-mapped samples are converted as they are read, nothing to cache
+            key = dataset_cache_key(self.source_files(), window=(start, stop), **self.cache_params())
+            cached = load_dataset_cache(self.cache_dir, key)
+            if cached is not None:
+                self.window_start = start
+                return (cached['loc'], cached['vel']), None
         # loc = np.load(osp.join(dir, 'dataset_gravity', 'loc_' + self.suffix + '.npy'))
-        loc = np.load(self.data_dir / f'loc_{self.suffix}.npy')
-        vel = np.load(self.data_dir / f'vel_{self.suffix}.npy')
+        # slice samples and frames of the memory maps before anything is read
+        loc = self.load_array('loc')[:self.max_samples, start:stop]
+        vel = self.load_array('vel')[:self.max_samples, start:stop]
+        # slices past the stored frames are silently cut short
+        assert stop is None or loc.shape[1] == stop - start, \
+            "Frames {}:{} of the window run past the end of the trajectories".format(start, stop)
+        # frame_index counts from the first loaded frame from now on
+        self.window_start = start
         if loc.shape[-2:] != (self.n_balls, 3):
             # should transpose the last two dimensions
             loc = np.transpose(loc, (0, 1, 3, 2))
             vel = np.transpose(vel, (0, 1, 3, 2))
             assert (loc.shape[-2:] == (self.n_balls, 3) and vel.shape[-2:] == (self.n_balls, 3)), "Shape mismatch!"
+        if self.windows is None and self.offsets is not None and len(self.offsets) < stop - start:
+            self.select = self.offsets - self.offsets[0]
+            if not self.mmap:
+                # read only those frames
+                loc, vel = loc[:, self.select], vel[:, self.select]
        
-        charges = np.load(self.data_dir / f'charges_{self.suffix}.npy')
+        charges = np.array(self.load_array('charges')[:self.max_samples])
+        if self.mmap:
+            # kept memory-mapped, __getitem__ reads and converts the accessed samples
+            self.charges = charges
+            return (loc, vel), None
         loc, vel = self.preprocess(loc, vel, charges)
+        if key is not None:
+            save_dataset_cache(self.cache_dir, key, dict(loc=loc, vel=vel), self.cache_params())
         return (loc, vel), None
 
     def preprocess(self, loc, vel, charges=None):
-        loc, vel = torch.tensor(loc), torch.tensor(vel)
+        # loc, vel are already limited to max_samples and the frame window, cast to float32 in a single copy
+        loc = torch.from_numpy(np.ascontiguousarray(loc, dtype=np.float32))
+        vel = torch.from_numpy(np.ascontiguousarray(vel, dtype=np.float32))
         n_nodes = loc.size(2)
         
         if charges is not None:
-            charges = torch.tensor(charges) # [N_sym, n_nodes, 1]
+            charges = torch.tensor(charges).float() # [N_sym, n_nodes, 1]
             # expand charges to match the time dimension
             charges = charges.unsqueeze(1).expand(-1, loc.size(1), -1, -1)
             loc = torch.cat((loc, charges), dim=-1)
-        loc = loc[0:self.max_samples, :, :, :]  # limit number of samples
-        vel = vel[0:self.max_samples, :, :, :]  # speed when starting the trajectory
 
-        return loc.float(), vel.float()
+        return loc, vel
 
     def set_max_samples(self, max_samples):
-        self.max_samples = int(max_samples)
+        max_samples = int(max_samples)
+        if not self.mmap and max_samples <= len(self.data[0]):
+            # a subset of the loaded samples
+            self.max_samples = max_samples
+            self.data = tuple(x[:max_samples] for x in self.data)
+            return
+        self.max_samples = max_samples
         self.data, self.edges = self.load()
 
     def get_n_nodes(self):
-        return self.data[0].size(1)
+        return self.data[0].shape[1]
+
+    def sample_windows(self, i):
+        """
+        Samples of index tensor i in windowed mode: the frames of the window of every sample,
+        gathered from the loaded frames.
+        """
+        i, shifts = self.locate(i)
+        frames = self.window_frames + shifts.unsqueeze(1)
+        loc, vel = self.data
+        if self.mmap:
+            i, frames = i.numpy()[:, None], frames.numpy()
+            return list(self.preprocess(loc[i, frames], vel[i, frames], self.charges[i[:, 0]]))
+        return [loc[i.unsqueeze(1), frames], vel[i.unsqueeze(1), frames]]
 
     def __getitem__(self, i):
+        if self.windows is not None:
+            loc, vel = self.sample_windows(torch.tensor([i]))
+            return loc[0], vel[0]
         loc, vel = self.data
-        loc, vel = loc[i], vel[i]
+        if self.mmap:
+            loc, vel = self.preprocess(loc[i:i + 1, self.select], vel[i:i + 1, self.select], self.charges[i:i + 1])
+            loc, vel = loc[0], vel[0]
+        else:
+            loc, vel = loc[i], vel[i]
 
         if self.dataset_name == "nbody":
             frame_0, frame_T = 6, 8
@@ -87,20 +285,29 @@ class NBodyDataset():
         #loc shape: [519, 5, 3]
         return loc, vel
 
+    def __getitems__(self, indices):
+        # the whole batch with one gather per field, as default_collate would stack __getitem__
+        if self.windows is not None:
+            return self.sample_windows(torch.as_tensor(indices))
+        loc, vel = self.data
+        if self.mmap:
+            idx = np.asarray(indices)
+            if not isinstance(self.select, slice):
+                # only the selected frames of the samples are read
+                return list(self.preprocess(loc[idx[:, None], self.select], vel[idx[:, None], self.select],
+                                            self.charges[idx]))
+            return list(self.preprocess(loc[idx], vel[idx], self.charges[idx]))
+        idx = torch.as_tensor(indices)
+        return [loc[idx], vel[idx]]
+
     def __len__(self):
+        if self.windows is not None and self.window_sampling == 'all':
+            return len(self.data[0]) * len(self.shifts)
         return len(self.data[0])
 
-    def get_edges(self, batch_size, n_nodes):
-        edges = [torch.LongTensor(self.edges[0]), torch.LongTensor(self.edges[1])]
-        if batch_size == 1:
-            return edges
-        elif batch_size > 1:
-            rows, cols = [], []
-            for i in range(batch_size):
-                rows.append(edges[0] + n_nodes * i)
-                cols.append(edges[1] + n_nodes * i)
-            edges = [torch.cat(rows), torch.cat(cols)]
-        return edges
+    def get_edges(self, batch_size, n_nodes, device='cpu'):
+        # fully connected, built once on the device and shared by all batches
+        return topology.edges(n_nodes, batch_size, device)
 
 
 if __name__ == "__main__":
@@ -4,10 +4,12 @@ import os
 from torch import nn, optim
 from ..models.model import SEGNO
 from torch_geometric.nn import knn_graph
-from .dataset_nbody import NBodyDataset #from nbody.dataset_nbody import NBodyDataset
+from .dataset_nbody import NBodyDataset, collate_batch #from nbody.dataset_nbody import NBodyDataset
 import json
 import wandb 
 from torch_geometric.utils import to_dense_batch
+from utils import EnergyDriftAccumulator
+from topology import topology
 
 time_exp_dic = {'time': 0, 'counter': 0}
 
@@ -72,6 +74,23 @@ def cumulative_random_tensor_indices_capped(N, start, end, MAX=100):
 
 # varDt = False
 
+def frame_offsets(args, rollout=False):
+    """
+    Stored frames after frame 30 that run_epoch reads, for NBodyDataset(frames=...): those of
+    the fixed steps, or None (the whole trajectory from frame 30) with varDT, whose random
+    steps are not bounded: their rounding correction can sum past MAX.
+    """
+    if rollout:
+        if args.varDT:
+            return None
+        return np.arange(args.num_inputs + args.traj_len) * args.num_timesteps
+    if args.num_inputs > 1 and not args.only_test:
+        if args.varDT:
+            return None
+        return np.arange(args.num_inputs + 1) * args.num_timesteps
+    return np.array([0, args.num_timesteps])
+
+
 def train(gpu, args):
     if args.gpus == 0:
         device = 'cpu'
@@ -95,13 +114,13 @@ def train(gpu, args):
 
     dataset_train = NBodyDataset(partition='train', dataset_name=args.nbody_name,
                                  max_samples=args.max_samples, n_balls=args.n_balls)
-    loader_train = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True)
+    loader_train = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True, collate_fn=collate_batch)
 
     dataset_val = NBodyDataset(partition='val', dataset_name=args.nbody_name,n_balls=args.n_balls)
-    loader_val = torch.utils.data.DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False)
+    loader_val = torch.utils.data.DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False, collate_fn=collate_batch)
 
     dataset_test = NBodyDataset(partition='test', dataset_name=args.nbody_name,n_balls=args.n_balls)
-    loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False)
+    loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False, collate_fn=collate_batch)
 
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     loss_mse = nn.MSELoss()
@@ -158,6 +177,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
     n_nodes = args.n_balls
     if rollout:
         first = True
+        # per-timestep energy drift statistics, the full energies are only kept with --save_energies
+        drift = EnergyDriftAccumulator()
 
     for batch_idx, data in enumerate(loader):
         data = [d.to(device) for d in data]
@@ -176,17 +197,19 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 
 
         locs, vels = data   #locs shape: [519, 500, 3] (T,BN,3)
-        start = 30
         if locs.shape[2] > 3:
             h_nodes = locs[0, :, 3:] # node features (charges, masses, etc.)
             locs = locs[:, :, :3]
         else:
             h_nodes = None
-        loc, loc_end, vel = locs[start], locs[start+args.num_timesteps], vels[start]
+        # positions of frames 30 and 30 + num_timesteps in the frames of the batch
+        start, end = loader.dataset.frame_positions([0, args.num_timesteps])
+        loc, loc_end, vel = locs[start], locs[end], vels[start]
 
         #print(loc.shape)
         batch_size = loc.shape[0] // loader.dataset.n_balls
-        batch = torch.arange(0, batch_size).repeat_interleave(n_nodes).long().to(device)
+        # node-to-graph assignment for knn_graph, shared by all batches and rollout steps
+        batch = topology.batch(n_nodes, batch_size, device)
         
         edge_index = knn_graph(loc, 4, batch) # Considers positions only for edge index
         #print(f"edge index shape :{edge_index.shape}")
@@ -198,7 +221,6 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
         edge_attr = loc_dist.detach()
         
         if rollout: 
-            start = 30
             num_prev = args.num_inputs
 
             if varDt: 
@@ -210,7 +232,7 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                 steps = [args.num_timesteps for _ in range(num_prev + args.traj_len - 1)]
                 T = args.num_timesteps
             
-            all_indices = start + np.cumsum([0] + steps)
+            all_indices = loader.dataset.frame_positions(np.cumsum([0] + steps))
             pred_indices = all_indices[num_prev:]
             locs_true = locs[pred_indices].to(device) # (T, BN, 3)
             
@@ -225,7 +247,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
             
             locs_pred, energies = rollout_fn(model, h, loc_list, edge_index, vel_list, edge_attr, batch, args.traj_len,
                                    num_steps=T, num_prev=num_prev, h_nodes=h_nodes,
-                                   energy_fun=loader.dataset.energy_fun)
+                                   energy_fun=loader.dataset.energy_fun, drift=drift,
+                                   keep_energies=args.save_energies)
             locs_pred = locs_pred.to(device)
             #locs_pred shape: [T, BN, 3], energy shape: [T, B, 1]
             corr, avg_num_steps = pearson_correlation_batch(locs_pred, locs_true, n_nodes)
@@ -233,7 +256,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
             
             targets = to_dense_batch(locs_true.permute(1,0,2), batch)[0].permute(0, 2, 1, 3) # (B, T, N, 3)
             preds = to_dense_batch(locs_pred.permute(1,0,2), batch)[0].permute(0, 2, 1, 3) # (B, T, N, 3)
-            energies = energies.permute(1,0,2) # (B, T, 1)
+            if args.save_energies:
+                energies = energies.permute(1,0,2) # (B, T, 1)
             if first:
                 traj_targ = targets
                 traj_pred = preds
@@ -242,7 +266,8 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
             else:
                 traj_targ = torch.cat((traj_targ, targets), dim=0)
                 traj_pred = torch.cat((traj_pred, preds), dim=0)
-                traj_energies = torch.cat((traj_energies, energies), dim=0)
+                if args.save_energies:
+                    traj_energies = torch.cat((traj_energies, energies), dim=0)
 
             #loss with metric (A-MSE)
             losses = loss_mse_no_red(locs_pred, locs_true).view(args.traj_len, batch_size * n_nodes, 3)
@@ -259,13 +284,13 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
                     steps = steps.tolist()[:args.num_inputs]
                     indices = indices[:args.num_inputs]
 
-                start = 30
                 half_step = args.num_timesteps
                 steps = steps if steps is not None else [half_step for _ in range(args.num_inputs)]
 
-                loc = locs[start + np.cumsum([0] + steps[:-1])].transpose(0, 1).contiguous() # BN, T, 3
-                vel = vels[start + np.cumsum([0] + steps[:-1])].transpose(0, 1).contiguous()
-                loc_end = locs[start + np.sum(steps)]
+                inputs = loader.dataset.frame_positions(np.cumsum([0] + steps[:-1]))
+                loc = locs[inputs].transpose(0, 1).contiguous() # BN, T, 3
+                vel = vels[inputs].transpose(0, 1).contiguous()
+                loc_end = locs[loader.dataset.frame_positions(np.sum(steps))]
 
                 h = torch.sqrt(torch.sum(vel ** 2, dim=-1)).T.unsqueeze(-1) # H (T, BN, 1)
                 if h_nodes is not None:
@@ -295,7 +320,10 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
     avg_loss = res['loss'] / res['counter']
     if rollout:
         wandb.log({f"{loader.dataset.partition}_loss": avg_loss,"avg_num_steps": res['avg_num_steps']}, step=epoch)
-        return avg_loss, {'targets': traj_targ, 'preds': traj_pred, 'energies': traj_energies, 'test_loss': avg_loss, 'traj_losses': res['losses']}
+        trajectories = {'targets': traj_targ, 'preds': traj_pred, 'test_loss': avg_loss, 'traj_losses': res['losses'], **drift.summary()}
+        if args.save_energies:
+            trajectories['energies'] = traj_energies
+        return avg_loss, trajectories
     else:
         wandb.log({f"{loader.dataset.partition}_loss": avg_loss}, step=epoch)
         return avg_loss
@@ -304,16 +332,20 @@ def run_epoch(model, optimizer, criterion, epoch, loader, args, backprop=True, r
 @torch.no_grad()
 def rollout_fn(model, h, loc, edge_index, vel, edge_attr, batch, 
                traj_len,num_steps=10, num_prev=1, h_nodes=None,
-               energy_fun=None):
+               energy_fun=None, drift=None, keep_energies=True):
 
     loc_preds = torch.zeros((traj_len,loc.shape[0],loc.shape[-1])) # (T, BN, 3)
-    energies = []
+    locs_e, vels_e = [], []
+    if energy_fun is not None:
+        # energy of the (last) input frame, that the drift is relative to
+        E0 = energy_fun(loc[:, -1] if num_prev > 1 else loc, vel[:, -1] if num_prev > 1 else vel, h_nodes)
     for i in range(traj_len):
         T = num_steps[i] if isinstance(num_steps, list) else num_steps
         loc_p, _, vel_p = model(h, loc, edge_index, vel, edge_attr, T=T)
         
         if energy_fun is not None:
-            energies.append(energy_fun(loc_p, vel_p, h_nodes, batch=batch))
+            locs_e.append(loc_p)
+            vels_e.append(vel_p)
         
         loc_preds[i] = loc_p
 
@@ -338,7 +370,13 @@ def rollout_fn(model, h, loc, edge_index, vel, edge_attr, batch,
             if h_nodes is not None:
                 h = torch.cat((h, h_nodes), dim=1)      
 
-    energies = torch.tensor(np.stack(energies)).unsqueeze(-1) if energy_fun is not None else None
+    energies = None
+    if energy_fun is not None:
+        # energies of all the predicted steps at once, on the device
+        energies = energy_fun(torch.stack(locs_e), torch.stack(vels_e), h_nodes)  # [T, B]
+        if drift is not None:
+            drift.update(energies, E0)
+        energies = energies.unsqueeze(-1) if keep_energies else None
     return loc_preds, energies
 
 
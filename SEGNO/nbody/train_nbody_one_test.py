@@ -4,7 +4,7 @@ import os
 from torch import nn, optim
 from models.model import SEGNO
 from torch_geometric.nn import knn_graph
-from dataset_nbody import NBodyDataset #from nbody.dataset_nbody import NBodyDataset
+from dataset_nbody import NBodyDataset, collate_batch #from nbody.dataset_nbody import NBodyDataset
 from utils import EarlyStopping
 import json
 import wandb    
@@ -104,13 +104,13 @@ def train(gpu, args):
 
     dataset_train = NBodyDataset(partition='train', dataset_name=args.nbody_name,
                                  max_samples=args.max_samples, n_balls=args.n_balls)
-    loader_train = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True)
+    loader_train = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True, collate_fn=collate_batch)
 
     dataset_val = NBodyDataset(partition='val', dataset_name=args.nbody_name,n_balls=args.n_balls)
-    loader_val = torch.utils.data.DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False)
+    loader_val = torch.utils.data.DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False, collate_fn=collate_batch)
 
     dataset_test = NBodyDataset(partition='test', dataset_name=args.nbody_name,n_balls=args.n_balls)
-    loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False)
+    loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False, collate_fn=collate_batch)
 
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     loss_mse = nn.MSELoss()
@@ -199,7 +199,7 @@ def run_epoch(model, optimizer, criterion, epoch, loader, device, args, backprop
                 
 
         locs, vels, loc_ends = data   #locs shape: [519, 500, 3] (T,BN,3)
-        start = 30
+        start = loader.dataset.frame_index(30)
         loc, loc_end, vel = locs[30], locs[start+args.num_steps], vels[30]
         #print(loc.shape)
         batch = torch.arange(0, batch_size)
@@ -214,7 +214,7 @@ def run_epoch(model, optimizer, criterion, epoch, loader, device, args, backprop
         
         if rollout:
             
-            start = 30
+            start = loader.dataset.frame_index(30)
             end = start + args.num_steps
             steps = None
             traj_len = args.traj_len
@@ -265,7 +265,7 @@ def run_epoch(model, optimizer, criterion, epoch, loader, device, args, backprop
                     indices, steps = cumulative_random_tensor_indices_capped(N=traj_len,start=1,end=args.num_steps+3, MAX=args.num_steps*traj_len)#cumulative_random_tensor_indices(args.num_inputs,1,10)
                     #indices +=start
                     #locs_true = locs[indices].to(device)
-                start = 30
+                start = loader.dataset.frame_index(30)
                 half_step = args.num_steps
                 steps = steps if steps is not None else [half_step for _ in range(args.num_inputs)]
                 prev_x = None
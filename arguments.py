@@ -0,0 +1,16 @@
+import argparse
+
+"""
+Command line argument types shared by generate_dataset.py and main.py, kept free of
+torch so that the dataset generation does not depend on it.
+"""
+
+
+def parse_frames(value):
+    parts = value.split(':')
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError('Frames must be start:stop[:stride], got {}'.format(value))
+    start, stop, stride = int(parts[0]), int(parts[1]), int(parts[2]) if len(parts) == 3 else 1
+    if not 0 <= start < stop or stride < 1:
+        raise argparse.ArgumentTypeError('Frames must be start:stop[:stride] with 0 <= start < stop, got {}'.format(value))
+    return start, stop, stride
@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+
+"""
+Derive coarser temporal resolutions from one dataset simulated at a fine --sample-freq,
+instead of simulating every resolution separately:
+
+    python -u generate_dataset.py --simulation=charged --num-train 3000 --seed 43 --suffix small --sample-freq 10
+    python -u derive_dataset.py --simulation=charged --suffix small --sample_freq 20 50 100
+
+writes the {loc,vel,...}_{partition}_charged5_initvel1small_sf{20,50,100} datasets, which the
+NBodyDataset loaders open with sample_freq=20 (main.py --sample_freq 20). With the default
+--mode view only a manifest is written for the per-frame outputs: the loaders read them as
+strided memory-mapped views of the fine files. --mode copy writes strided copies instead.
+The per-system outputs (edges, charges) are hard links to the fine files in both modes.
+
+The integrator takes the same steps for any sample frequency, so the derived datasets hold
+exactly the frames a run at the coarse sample frequency would have stored.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--simulation', type=str, default='charged', choices=['springs', 'charged', 'gravity'],
+                    help='Simulation of the source dataset.')
+parser.add_argument('--n_balls', type=int, default=5,
+                    help='Number of balls in the simulation.')
+parser.add_argument('--initial_vel', type=int, default=1,
+                    help='consider initial velocity')
+parser.add_argument('--suffix', type=str, default="",
+                    help='Suffix of the fine source dataset, the derived ones get _sf{sample_freq} appended.')
+parser.add_argument('--sample_freq', type=int, nargs='+', required=True,
+                    help='Coarse sample frequencies to derive, multiples of the source one.')
+parser.add_argument('--partitions', type=str, nargs='+', default=['train', 'valid', 'test'],
+                    choices=['train', 'valid', 'test'])
+parser.add_argument('--mode', type=str, default='view', choices=['view', 'copy'],
+                    help='Strided memory-mapped views of the source files, or strided copies.')
+parser.add_argument('--data_dir', type=Path, default='data')
+args = parser.parse_args()
+
+suffix = '_' + args.simulation + str(args.n_balls) + "_initvel%d" % args.initial_vel + args.suffix
+
+
+def link(src, dst):
+    # hard link where the file system allows it, so the derived datasets cost no space
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def derive(partition, sample_freq, outdir, block=100):
+    """
+    Write the dataset of one partition at the coarse sample_freq, taking every
+    stride-th frame of the finished fine dataset.
+    """
+    with open(outdir / f'manifest_{partition}{suffix}.json') as f:
+        source = json.load(f)
+    config = source['config']
+    assert len(source['done']) == config['num_sims'] and source['shard'] == [0, 1], \
+        "Partition {} is not finished (or not merged)".format(partition)
+    assert source['frames'] is None, "Cannot derive from a dataset stored with --keep_frames"
+    assert sample_freq % config['sample_freq'] == 0 and config['length'] % sample_freq == 0, \
+        "Sample frequency {} is not a multiple of {} dividing the length {}".format(
+            sample_freq, config['sample_freq'], config['length'])
+    stride = sample_freq // config['sample_freq']
+    # frame j is stored after step (j + 1) * sample_freq, except for gravity which stores step j * sample_freq
+    start = 0 if config['simulation'] == 'gravity' else stride - 1
+    framed = ['loc', 'vel'] + (['edges'] if config['simulation'] == 'gravity' else [])
+
+    dst_suffix = f'{suffix}_sf{sample_freq}'
+    manifest = dict(config=dict(config, sample_freq=sample_freq,
+                                derived_from=dict(suffix=suffix, sample_freq=config['sample_freq'])),
+                    partition=partition, shard=[0, 1], start=0, stop=config['num_sims'],
+                    frames=None, files={}, views={}, done=source['done'])
+    for name, file in source['files'].items():
+        if name not in framed + ['edges', 'charges']:
+            # final integrator states only match the fine frames
+            continue
+        dst = f'{name}_{partition}{dst_suffix}.npy'
+        if name not in framed:
+            link(outdir / file, outdir / dst)
+            manifest['files'][name] = dst
+        elif args.mode == 'view':
+            manifest['views'][name] = dict(file=file, start=start, stride=stride)
+        else:
+            src = np.load(outdir / file, mmap_mode='r')
+            frames = src[:1, start::stride].shape[1]
+            out = np.lib.format.open_memmap(outdir / dst, mode='w+', dtype=src.dtype,
+                                            shape=(len(src), frames) + src.shape[2:])
+            for j in range(0, len(src), block):
+                out[j:j + block] = src[j:j + block, start::stride]
+            out.flush()
+            del out
+            manifest['files'][name] = dst
+
+    tmp_path = outdir / f'manifest_{partition}{dst_suffix}.json.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, outdir / f'manifest_{partition}{dst_suffix}.json')
+
+
+if __name__ == "__main__":
+    for sample_freq in args.sample_freq:
+        for partition in args.partitions:
+            print("Deriving {}{} at sample frequency {}".format(partition, suffix, sample_freq))
+            derive(partition, sample_freq, args.data_dir)
@@ -0,0 +1,141 @@
+import numpy as np
+
+"""
+Energies of the spring, charged and gravity systems, vectorized over any leading
+(sample, time, ...) dimensions: positions and velocities are ...xNx3 arrays, so the
+energies of a whole (S, T, N, 3) dataset are computed in one pass.
+"""
+
+# interaction strengths of the simulators in synthetic_sim.py
+INTERACTION_STRENGTH = {'springs': .1, 'charged': 1., 'gravity': 1.}
+
+
+def pairwise_sq_dist(loc):
+    '''
+    :param loc: ...xNx3 positions
+    :return: ...xNxN squared distances
+    '''
+    # one coordinate at a time, to never hold the ...xNxNx3 differences
+    dist2 = 0.
+    for k in range(loc.shape[-1]):
+        x = loc[..., k]
+        dist2 = dist2 + (x[..., :, None] - x[..., None, :]) ** 2
+    return dist2
+
+
+def kinetic_energy(vel, mass=None):
+    '''
+    :param vel: ...xNx3 velocities
+    :param mass: ...xNx1 masses, unit masses if None
+    :return: kinetic energy, of shape ...
+    '''
+    v2 = np.einsum('...k,...k->...', vel, vel)
+    if mass is not None:
+        v2 = mass[..., 0] * v2
+    return 0.5 * v2.sum(axis=-1)
+
+
+def potential_energy(simulation, loc, params, interaction_strength=None, softening=0., memory_budget=None):
+    '''
+    :param simulation: 'springs', 'charged' or 'gravity'
+    :param loc: ...xNx3 positions
+    :param params: ...xNxN edges (spring constants, or charge products q_i q_j) for springs
+        and charged, ...xNx1 masses for gravity, broadcasting against the leading dimensions of loc
+    :param interaction_strength: the one of the simulator if None
+    :param softening: gravitational softening length
+    :param memory_budget: if given, evaluate in tiles with temporaries of about this many bytes
+        (see blocked_potential_energy) instead of all ...xNxN pairs at once
+    :return: potential energy, of shape ...
+    '''
+    if interaction_strength is None:
+        interaction_strength = INTERACTION_STRENGTH[simulation]
+    if memory_budget is not None:
+        return blocked_potential_energy(simulation, loc, params, interaction_strength, softening, memory_budget)
+    dist2 = pairwise_sq_dist(loc)
+    if simulation == 'springs':
+        return 0.25 * interaction_strength * (params * dist2).sum(axis=(-2, -1))
+
+    # leave out the self interactions
+    n = loc.shape[-2]
+    inv_r = np.where(np.eye(n, dtype=bool), np.inf, dist2 + softening ** 2) ** -0.5
+    if simulation == 'charged':
+        return 0.5 * interaction_strength * (params * inv_r).sum(axis=(-2, -1))
+    if simulation == 'gravity':
+        mass_prod = params * np.swapaxes(params, -1, -2)
+        return -0.5 * interaction_strength * (mass_prod * inv_r).sum(axis=(-2, -1))
+    raise ValueError(f"Unknown simulation: {simulation}")
+
+
+def blocked_potential_energy(simulation, loc, params, interaction_strength=None, softening=0., memory_budget=2 ** 26):
+    '''
+    potential_energy walking tiles of frames and of particle pairs, only the pairs i < j of
+    the upper triangle. The temporaries of a tile take about memory_budget bytes, whatever
+    the number of frames and particles.
+    '''
+    if simulation not in INTERACTION_STRENGTH:
+        raise ValueError(f"Unknown simulation: {simulation}")
+    if interaction_strength is None:
+        interaction_strength = INTERACTION_STRENGTH[simulation]
+    if loc.ndim == 2:
+        return blocked_potential_energy(simulation, loc[None], params[None], interaction_strength,
+                                        softening, memory_budget)[0]
+    lead, n = loc.shape[:-2], loc.shape[-2]
+    params = np.broadcast_to(params, lead + params.shape[-2:])
+    loc = loc.reshape(-1, n, 3)
+
+    # about eight float64 temporaries per frame and particle pair
+    pair_bytes = 64
+    tile = int(min(n, max(1, np.sqrt(memory_budget / pair_bytes))))
+    rows = int(max(1, memory_budget // (pair_bytes * tile ** 2)))
+    upper = np.triu(np.ones((tile, tile), dtype=bool), 1)
+
+    U = np.zeros(len(loc))
+    for a in range(0, len(loc), rows):
+        # frames a:a + rows, as indices into the leading dimensions of params
+        frames = np.unravel_index(np.arange(a, min(a + rows, len(loc))), lead)
+        x = loc[a:a + rows]
+        for i in range(0, n, tile):
+            for j in range(i, n, tile):
+                xi, xj = x[:, i:i + tile], x[:, j:j + tile]
+                dist2 = 0.
+                for k in range(3):
+                    dist2 = dist2 + (xi[:, :, None, k] - xj[:, None, :, k]) ** 2
+                # weight of the pair i < j, counting both orders
+                if simulation == 'gravity':
+                    w = 2 * params[..., i:i + tile, 0][frames][:, :, None] * params[..., j:j + tile, 0][frames][:, None, :]
+                else:
+                    w = params[..., i:i + tile, j:j + tile][frames] + \
+                        np.swapaxes(params[..., j:j + tile, i:i + tile][frames], -1, -2)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    f = dist2 if simulation == 'springs' else (dist2 + softening ** 2) ** -0.5
+                    pair = w * f
+                if i == j:
+                    pair = np.where(upper[:pair.shape[1], :pair.shape[2]], pair, 0.)
+                U[a:a + rows] += pair.sum(axis=(1, 2))
+
+    factor = {'springs': 0.25, 'charged': 0.5, 'gravity': -0.5}[simulation]
+    return factor * interaction_strength * U.reshape(lead)
+
+
+def total_energy(simulation, loc, vel, params, interaction_strength=None, softening=0., memory_budget=None):
+    '''
+    :param loc, vel: ...xNx3 positions and velocities, the rest as for potential_energy
+    :return: kinetic plus potential energy, of shape ...
+    '''
+    mass = params if simulation == 'gravity' else None
+    return kinetic_energy(vel, mass) + potential_energy(simulation, loc, params, interaction_strength, softening,
+                                                        memory_budget)
+
+
+def energy_drift(simulation, loc, vel, params, interaction_strength=None, softening=0., eps=1e-10,
+                 memory_budget=None):
+    '''
+    Relative energy drift along trajectories.
+    :param loc, vel: ...xTxNx3 trajectories
+    :param params: ...xNxN edges or ...xNx1 masses of the systems, constant along the trajectories
+    :return: |E_t - E_0| / (E_0 + eps), of shape ...xT
+    '''
+    energy = total_energy(simulation, loc, vel, np.expand_dims(params, -3), interaction_strength, softening,
+                          memory_budget)
+    E0 = energy[..., :1]
+    return np.abs((energy - E0) / (E0 + eps))
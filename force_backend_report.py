@@ -0,0 +1,76 @@
+import argparse
+import csv
+import time
+import numpy as np
+from synthetic_sim import ChargedParticlesSim, GravitySim
+
+"""
+Accuracy vs speed of the Barnes-Hut force backend against the direct sum, for one force evaluation
+on random initial conditions of the gravity and charged simulations.
+    python force_backend_report.py --n_balls 50 200 1000 5000 --theta 0.3 0.5 0.7
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n_balls', type=int, nargs='+', default=[50, 200, 1000, 2000],
+                    help='Numbers of particles to evaluate.')
+parser.add_argument('--theta', type=float, nargs='+', default=[0.3, 0.5, 0.7, 1.0],
+                    help='Opening angles of the Barnes-Hut backend.')
+parser.add_argument('--repeats', type=int, default=3,
+                    help='Timings are the best of this many evaluations.')
+parser.add_argument('--seed', type=int, default=42,
+                    help='Random seed.')
+parser.add_argument('--out', type=str, default='force_backend_report.csv',
+                    help='CSV file the report is written to.')
+
+
+def best_time(func, repeats):
+    best, result = np.inf, None
+    for _ in range(repeats):
+        t = time.time()
+        result = func()
+        best = min(best, time.time() - t)
+    return best, result
+
+
+def make_forces(simulation, n_balls, backend, theta, rng):
+    """
+    :return: function evaluating the unclamped forces of one random system
+    """
+    if simulation == 'gravity':
+        sim = GravitySim(n_balls=n_balls, force_backend=backend, theta=theta)
+        mass = rng.randn(1, n_balls, 1) * 0.1
+        pos = rng.randn(1, n_balls, 3)
+        return lambda: sim.compute_acceleration(pos, mass, sim.interaction_strength, sim.softening) * mass
+    sim = ChargedParticlesSim(n_balls=n_balls, force_backend=backend, theta=theta)
+    sim._max_F = np.inf
+    charges = rng.choice(sim._charge_types, size=(1, n_balls, 1), p=[1. / 2, 0, 1. / 2])
+    edges = charges @ charges.transpose(0, 2, 1)
+    loc = rng.randn(1, n_balls, 3) * sim.loc_std
+    return lambda: sim._forces(loc, edges, charges)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rows = []
+    for simulation in ['gravity', 'charged']:
+        for n_balls in args.n_balls:
+            # the same system for every backend
+            direct = make_forces(simulation, n_balls, 'direct', 0., np.random.RandomState(args.seed))
+            direct_time, F_direct = best_time(direct, args.repeats)
+            norm = np.linalg.norm(F_direct, axis=-1)
+            for theta in args.theta:
+                bh = make_forces(simulation, n_balls, 'barnes_hut', theta, np.random.RandomState(args.seed))
+                bh_time, F_bh = best_time(bh, args.repeats)
+                rel_err = np.linalg.norm(F_bh - F_direct, axis=-1) / norm
+                rows.append(dict(simulation=simulation, n_balls=n_balls, theta=theta,
+                                 direct_sec=round(direct_time, 5), barnes_hut_sec=round(bh_time, 5),
+                                 speedup=round(direct_time / bh_time, 3),
+                                 median_rel_err=float('%.3e' % np.median(rel_err)),
+                                 p99_rel_err=float('%.3e' % np.percentile(rel_err, 99))))
+                print(rows[-1])
+
+    with open(args.out, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'Report written to {args.out}')
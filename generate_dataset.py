@@ -1,15 +1,35 @@
-from synthetic_sim import ChargedParticlesSim, SpringSim, GravitySim
+from synthetic_sim import ChargedParticlesSim, SpringSim, GravitySim, INTEGRATORS
+from arguments import parse_frames
 import time
 import numpy as np
 import argparse
+import json
+import os
+import multiprocessing
 from pathlib import Path
 
 """
 nbody_small:   python3 -u generate_dataset.py --simulation=charged --num-train 10000 --seed 43 --suffix small
     python -u generate_dataset.py --simulation=charged --num-train 3000 --seed 43 --suffix small --length 20000 --length_test 20000 --n_balls 20
+    add --workers 8 to spread the simulations over 8 processes (same output for any number of workers)
+    add --shard 0/4 ... --shard 3/4 to split the run over 4 machines, --resume to restart a preempted run,
+    then --merge 4 (with the same arguments) to combine the shards into the canonical files
+    add --keep_frames 30:131 to only store the frames the loaders read (recorded in the manifest)
+    add --integrator yoshida4 --energy_tol 1e-5 for a 4th order integrator with as few steps per frame as the target allows
+    add --health_check --max_speed 50 --max_energy_drift 0.1 to abort blown up simulations and resample them with a fresh seed
+    add --continue_dataset 32000 (with the same arguments) to extend the finished test set by 32000 steps from its stored final states
 gravity_small: python3 -u generate_dataset.py --simulation=gravity --num-train 10000 --seed 43 --suffix small
 """
 
+
+
+def parse_shard(value):
+    i, k = (int(x) for x in value.split('/'))
+    if not 0 <= i < k:
+        raise argparse.ArgumentTypeError('Shard must be i/k with 0 <= i < k, got {}'.format(value))
+    return i, k
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--simulation', type=str, default='charged', choices=['springs', 'charged', 'gravity'],
                     help='What simulation to generate.')
@@ -33,55 +53,375 @@ parser.add_argument('--initial_vel', type=int, default=1,
                     help='consider initial velocity')
 parser.add_argument('--suffix', type=str, default="",
                     help='add a suffix to the name')
+parser.add_argument('--force_backend', type=str, default='direct', choices=['direct', 'barnes_hut'],
+                    help='Direct O(N^2) sum or Barnes-Hut octree for the charged and gravity forces.')
+parser.add_argument('--theta', type=float, default=0.5,
+                    help='Opening angle of the Barnes-Hut force backend.')
+parser.add_argument('--integrator', type=str, default='leapfrog', choices=INTEGRATORS,
+                    help='Time integrator, block_kdk (adaptive block timesteps) is gravity only.')
+parser.add_argument('--energy_tol', type=float, default=None,
+                    help='Relative energy error target the integrator step is calibrated to '
+                         '(once per ensemble, so the output then depends on --ensemble_size).')
+parser.add_argument('--health_check', action='store_true', default=False,
+                    help='Abort simulations that blow up (NaNs, --max_speed, --max_energy_drift) and resample them.')
+parser.add_argument('--max_speed', type=float, default=None,
+                    help='Largest particle speed a healthy simulation may reach.')
+parser.add_argument('--max_energy_drift', type=float, default=None,
+                    help='Largest relative energy drift a healthy simulation may reach.')
+parser.add_argument('--check_every', type=int, default=1,
+                    help='Integrator steps between health checks (leapfrog, otherwise every frame).')
+parser.add_argument('--max_resamples', type=int, default=10,
+                    help='Give up on a simulation after this many failed resamples.')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes simulating in parallel.')
+parser.add_argument('--ensemble_size', type=int, default=10,
+                    help='Number of simulations integrated together in one batched call.')
+parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                    help='Only generate shard i/k of every partition.')
+parser.add_argument('--resume', action='store_true', default=False,
+                    help='Skip the simulations already recorded in the manifest.')
+parser.add_argument('--keep_frames', type=parse_frames, default=None,
+                    help='Only store the sampled frames start:stop[:stride], as (frames, nodes, 3).')
+parser.add_argument('--merge', type=int, default=0,
+                    help='Merge this many finished shards into the canonical files instead of simulating.')
+parser.add_argument('--continue_dataset', type=int, default=0,
+                    help='Extend the finished datasets by this many integrator steps instead of simulating.')
+parser.add_argument('--continue_partitions', type=str, nargs='+', default=['test'],
+                    choices=['train', 'valid', 'test'],
+                    help='Partitions extended by --continue_dataset.')
 
 args = parser.parse_args()
+if args.health_check and args.simulation == 'springs':
+    parser.error('--health_check is only implemented for the charged and gravity simulations')
+health = dict(health_check=args.health_check, max_speed=args.max_speed,
+              max_energy_drift=args.max_energy_drift, check_every=args.check_every)
 
 initial_vel_norm = 0.5
 if not args.initial_vel:
     initial_vel_norm = 1e-16
 
 if args.simulation == 'springs':
-    sim = SpringSim(noise_var=0.0, n_balls=args.n_balls)
+    sim = SpringSim(noise_var=0.0, n_balls=args.n_balls,
+                    integrator=args.integrator, energy_tol=args.energy_tol)
     suffix = '_springs'
 elif args.simulation == 'charged':
-    sim = ChargedParticlesSim(noise_var=0.0, n_balls=args.n_balls, vel_norm=initial_vel_norm)
+    sim = ChargedParticlesSim(noise_var=0.0, n_balls=args.n_balls, vel_norm=initial_vel_norm,
+                              force_backend=args.force_backend, theta=args.theta,
+                              integrator=args.integrator, energy_tol=args.energy_tol, **health)
     suffix = '_charged'
 elif args.simulation == 'gravity':
-    sim = GravitySim(noise_var=0.0, n_balls=args.n_balls, vel_norm=initial_vel_norm)
+    sim = GravitySim(noise_var=0.0, n_balls=args.n_balls, vel_norm=initial_vel_norm,
+                     force_backend=args.force_backend, theta=args.theta,
+                     integrator=args.integrator, energy_tol=args.energy_tol, **health)
     suffix = '_gravity'
 else:
     raise ValueError('Simulation {} not implemented'.format(args.simulation))
 
 suffix += str(args.n_balls) + "_initvel%d" % args.initial_vel + args.suffix
-np.random.seed(args.seed)
+# output files, in the order sample_trajectories returns them
+OUTPUT_NAMES = ['loc', 'vel', 'edges', 'charges']
+# final integrator state (positions, velocities) and random stream of every
+# simulation, which --continue_dataset resumes from
+STATE_NAMES = ['end_loc', 'end_vel', 'rng']
+# one independent seed sequence per partition, spawned into one child per simulation
+seed_train, seed_valid, seed_test = np.random.SeedSequence(args.seed).spawn(3)
 
 print(suffix)
 
 
-def generate_dataset(num_sims, length, sample_freq):
-    loc_all = list()
-    vel_all = list()
-    edges_all = list()
-    charges_all = list()
-    for i in range(num_sims):
+def shard_tag(shard, num_shards):
+    return '' if num_shards == 1 else '.shard{}of{}'.format(shard, num_shards)
+
+
+def manifest_config(num_sims, length, sample_freq):
+    return dict(simulation=args.simulation, n_balls=args.n_balls, initial_vel=args.initial_vel,
+                seed=args.seed, num_sims=num_sims, length=length, sample_freq=sample_freq,
+                force_backend=args.force_backend, theta=args.theta,
+                integrator=args.integrator, energy_tol=args.energy_tol, health=health,
+                keep_frames=None if args.keep_frames is None else list(args.keep_frames))
+
+
+def frame_window(num_frames):
+    """
+    :return: range of the sampled frames kept by --keep_frames, out of num_frames
+    """
+    if args.keep_frames is None:
+        return range(num_frames)
+    return range(num_frames)[slice(*args.keep_frames)]
+
+
+def keep_frames(shape, x=None):
+    """
+    Cut a per-frame output (T_save x 3 x N, or T_save x N x 3 for gravity) to the
+    --keep_frames window in T x N x 3 layout, so the loaders need no transpose.
+    :return: the kept shape, or the kept x (with a leading ensemble axis) if given
+    """
+    if args.keep_frames is None or len(shape) != 3:
+        return shape if x is None else x
+    swap = args.simulation != 'gravity'
+    if x is None:
+        T, a, b = shape
+        return (len(frame_window(T)),) + ((b, a) if swap else (a, b))
+    x = x[:, slice(*args.keep_frames)]
+    return x.transpose(0, 1, 3, 2) if swap else x
+
+
+def state_shapes():
+    # legacy RandomState state: 624 key words, position, has_gauss, cached gaussian
+    return [(args.n_balls, 3), (args.n_balls, 3), (627,)]
+
+
+def pack_rng(rng):
+    _, key, pos, has_gauss, gauss = rng.get_state()
+    return np.concatenate([key, [pos, has_gauss, gauss]])
+
+
+def unpack_rng(state):
+    rng = np.random.RandomState()
+    rng.set_state(('MT19937', state[:624].astype(np.uint32), int(state[624]), int(state[625]), float(state[626])))
+    return rng
+
+
+def end_state(rngs):
+    """
+    :return: the STATE_NAMES outputs of the last sample_trajectories call
+    """
+    loc, vel = sim.final_state[:2]
+    return [loc, vel, np.stack([pack_rng(rng) for rng in rngs])]
+
+
+def write_manifest(manifest, path):
+    # write to a temporary file first, so a crash never leaves a truncated manifest
+    tmp_path = path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def simulate_chunk(task):
+    """
+    Run one ensemble of simulations, each one driven by its own seed sequence.
+    With --health_check, every aborted simulation is run again from a fresh
+    child of its seed sequence, until it is healthy or --max_resamples is hit.
+    :return: indices, outputs followed by the final states, and the seed
+        sequence and resample count of every simulation
+    """
+    indices, seeds, length, sample_freq = task
+    seeds = list(seeds)
+    resamples = np.zeros(len(seeds), dtype=int)
+
+    def simulate(todo):
+        rngs = [np.random.RandomState(np.random.MT19937(seeds[j])) for j in todo]
+        outputs = sim.sample_trajectories(len(todo), T=length, sample_freq=sample_freq, rngs=rngs)
+        return list(outputs) + end_state(rngs)
+
+    todo = np.arange(len(seeds))
+    chunk = simulate(todo)
+    while args.health_check and sim.unhealthy.any():
+        todo = todo[sim.unhealthy]
+        if resamples[todo].max() == args.max_resamples:
+            raise RuntimeError("Simulation {} still unhealthy after {} resamples".format(
+                indices[todo[resamples[todo].argmax()]], args.max_resamples))
+        for j in todo:
+            seeds[j] = seeds[j].spawn(1)[0]
+        resamples[todo] += 1
+        for out, x in zip(chunk, simulate(todo)):
+            out[todo] = x
+    shapes = sim.output_shapes(T=length, sample_freq=sample_freq) + state_shapes()
+    return indices, [keep_frames(shape, x) for shape, x in zip(shapes, chunk)], seeds, resamples
+
+
+def continue_chunk(task):
+    """
+    Continue one ensemble of simulations from their final states by length steps.
+    :return: indices, the new frames of the per-frame outputs followed by the new final states
+    """
+    indices, state, rng_states, length, sample_freq = task
+    rngs = [unpack_rng(r) for r in rng_states]
+    outputs = sim.sample_trajectories(len(indices), T=length, sample_freq=sample_freq, rngs=rngs, state=state)
+    if args.health_check and sim.unhealthy.any():
+        # the earlier frames are already stored, so the simulation cannot be resampled
+        raise RuntimeError("Continued simulations {} are unhealthy".format(np.array(indices)[sim.unhealthy]))
+    shapes = sim.output_shapes(T=length, sample_freq=sample_freq, continued=True)
+    return indices, [x for shape, x in zip(shapes, outputs) if len(shape) == 3] + end_state(rngs)
+
+
+def generate_dataset(num_sims, length, sample_freq, seed_seq, partition, outdir):
+    """
+    Simulate this shard of one partition, writing every ensemble into its slot
+    of the memory-mapped output files as soon as it finishes. The manifest
+    records the finished simulations, so --resume only runs the missing ones.
+    """
+    shard, num_shards = args.shard
+    start, stop = num_sims * shard // num_shards, num_sims * (shard + 1) // num_shards
+    # seeds are spawned for the whole partition, so they do not depend on the sharding
+    seeds = seed_seq.spawn(num_sims)
+
+    tag = shard_tag(shard, num_shards)
+    manifest_path = outdir / f'manifest_{partition}{suffix}{tag}.json'
+    config = manifest_config(num_sims, length, sample_freq)
+    shapes = sim.output_shapes(T=length, sample_freq=sample_freq)
+    names = OUTPUT_NAMES[:len(shapes)] + STATE_NAMES
+    frames = None
+    if args.keep_frames is not None:
+        window = frame_window(shapes[0][0])
+        frames = dict(start=window.start, stop=window.stop, stride=window.step, layout='frame,node,dim')
+    shapes = [keep_frames(shape) for shape in shapes] + state_shapes()
+
+    if args.resume and manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        assert manifest['config'] == config and manifest['start'] == start and manifest['stop'] == stop, \
+            "Manifest {} was written with different arguments".format(manifest_path)
+        mode = 'r+'
+    else:
+        manifest = dict(config=config, partition=partition, shard=[shard, num_shards], start=start, stop=stop,
+                        frames=frames, files={name: f'{name}_{partition}{suffix}{tag}.npy' for name in names},
+                        done={})
+        mode = 'w+'
+    outputs = [np.lib.format.open_memmap(outdir / manifest['files'][name], mode=mode,
+                                         dtype=np.float64, shape=(stop - start,) + shape)
+               for name, shape in zip(names, shapes)]
+    write_manifest(manifest, manifest_path)
+
+    todo = [i for i in range(start, stop) if str(i) not in manifest['done']]
+    if len(todo) < stop - start:
+        print("Resuming: {} of {} simulations already done".format(stop - start - len(todo), stop - start))
+    tasks = [(todo[j:j + args.ensemble_size], [seeds[i] for i in todo[j:j + args.ensemble_size]], length, sample_freq)
+             for j in range(0, len(todo), args.ensemble_size)]
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap_unordered(simulate_chunk, tasks)
+    else:
+        pool = None
+        results = map(simulate_chunk, tasks)
+
+    t = time.time()
+    for done, (indices, chunk, used_seeds, resamples) in enumerate(results):
+        offsets = np.array(indices) - start
+        for out, x in zip(outputs, chunk):
+            out[offsets] = x
+            out.flush()
+        # only record the simulations once their data is on disk
+        for i, offset, seed, n in zip(indices, offsets, used_seeds, resamples):
+            manifest['done'][str(i)] = dict(spawn_key=list(seed.spawn_key), offset=int(offset),
+                                            resamples=int(n))
+        manifest['resamples'] = sum(entry.get('resamples', 0) for entry in manifest['done'].values())
+        write_manifest(manifest, manifest_path)
+
+        if done % max(1, 100 // args.ensemble_size) == 0:
+            print("Iter: {}, Simulation time: {}".format(indices[0], time.time() - t))
         t = time.time()
-        loc, vel, edges, charges = sim.sample_trajectory(T=length,
-                                                         sample_freq=sample_freq)
 
-        loc_all.append(loc)
-        vel_all.append(vel)
-        edges_all.append(edges)
-        charges_all.append(charges)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    del outputs
+
+
+def merge_shards(num_sims, length, sample_freq, partition, outdir, num_shards, block=100):
+    """
+    Combine the finished shards of one partition into the canonical
+    loc_{partition}{suffix}.npy (etc.) files and write their manifest.
+    """
+    config = manifest_config(num_sims, length, sample_freq)
+    manifests = []
+    for shard in range(num_shards):
+        with open(outdir / f'manifest_{partition}{suffix}{shard_tag(shard, num_shards)}.json') as f:
+            manifest = json.load(f)
+        assert manifest['config'] == config, "Shard {} was written with different arguments".format(shard)
+        assert len(manifest['done']) == manifest['stop'] - manifest['start'], "Shard {} is not finished".format(shard)
+        manifests.append(manifest)
+
+    merged = dict(config=config, partition=partition, shard=[0, 1], start=0, stop=num_sims,
+                  frames=manifests[0]['frames'], files={}, done={})
+    for name in manifests[0]['files']:
+        merged['files'][name] = f'{name}_{partition}{suffix}.npy'
+        sample = np.load(outdir / manifests[0]['files'][name], mmap_mode='r')
+        out = np.lib.format.open_memmap(outdir / merged['files'][name], mode='w+',
+                                        dtype=sample.dtype, shape=(num_sims,) + sample.shape[1:])
+        for manifest in manifests:
+            src = np.load(outdir / manifest['files'][name], mmap_mode='r')
+            for j in range(0, len(src), block):
+                chunk = src[j:j + block]
+                out[manifest['start'] + j:manifest['start'] + j + len(chunk)] = chunk
+        out.flush()
+        del out
+
+    for manifest in manifests:
+        for i, entry in manifest['done'].items():
+            merged['done'][i] = dict(entry, offset=int(i))
+    merged['resamples'] = sum(entry.get('resamples', 0) for entry in merged['done'].values())
+    write_manifest(merged, outdir / f'manifest_{partition}{suffix}.json')
+
+
+def continue_dataset(num_sims, steps, sample_freq, partition, outdir, block=100):
+    """
+    Extend the finished loc_{partition}{suffix}.npy (etc.) files by steps more
+    integrator steps per simulation, resuming from the stored final states
+    instead of simulating from scratch. The extended files are written next
+    to the old ones and swapped in once complete.
+    """
+    manifest_path = outdir / f'manifest_{partition}{suffix}.json'
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    length = manifest['config']['length']
+    assert manifest['config'] == manifest_config(num_sims, length, sample_freq), \
+        "Manifest {} was written with different arguments".format(manifest_path)
+    assert len(manifest['done']) == num_sims and manifest['shard'] == [0, 1], \
+        "Partition {} is not finished (or not merged)".format(partition)
+    assert manifest['frames'] is None, "Cannot continue a dataset stored with --keep_frames"
+    assert all(name in manifest['files'] for name in STATE_NAMES), \
+        "Partition {} was generated without final states".format(partition)
+    assert steps % sample_freq == 0
+
+    src = {name: np.load(outdir / file, mmap_mode='r') for name, file in manifest['files'].items()}
+    shapes = sim.output_shapes(T=steps, sample_freq=sample_freq, continued=True)
+    # the per-frame outputs grow along the frame axis, the final states are replaced
+    framed = [name for name, shape in zip(OUTPUT_NAMES, shapes) if len(shape) == 3]
+    param = OUTPUT_NAMES[len(shapes) - 1]
+    tmp_files = {name: manifest['files'][name] + '.tmp' for name in framed + STATE_NAMES}
+    outputs = {}
+    for name, file in tmp_files.items():
+        shape = src[name].shape
+        if name in framed:
+            shape = (shape[0], shape[1] + shapes[0][0]) + shape[2:]
+        outputs[name] = np.lib.format.open_memmap(outdir / file, mode='w+', dtype=np.float64, shape=shape)
 
-        if i % 100 == 0:
-            print("Iter: {}, Simulation time: {}".format(i, time.time() - t))
+    T_old = src['loc'].shape[1]
+    for j in range(0, num_sims, block):
+        for name in framed:
+            outputs[name][j:j + block, :T_old] = src[name][j:j + block]
 
-    charges_all = np.stack(charges_all)
-    loc_all = np.stack(loc_all)
-    vel_all = np.stack(vel_all)
-    edges_all = np.stack(edges_all)
+    tasks = [(list(range(j, min(j + args.ensemble_size, num_sims))),
+              tuple(np.array(src[name][j:j + args.ensemble_size]) for name in ['end_loc', 'end_vel', param]),
+              np.array(src['rng'][j:j + args.ensemble_size]), steps, sample_freq)
+             for j in range(0, num_sims, args.ensemble_size)]
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap_unordered(continue_chunk, tasks)
+    else:
+        pool = None
+        results = map(continue_chunk, tasks)
+    for indices, chunk in results:
+        for name, x in zip(framed + STATE_NAMES, chunk):
+            if name in framed:
+                outputs[name][indices, T_old:] = x
+            else:
+                outputs[name][indices] = x
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    return loc_all, vel_all, edges_all, charges_all
+    for out in outputs.values():
+        out.flush()
+    del outputs, src
+    for name, file in tmp_files.items():
+        os.replace(outdir / file, outdir / manifest['files'][name])
+    manifest['config']['length'] = length + steps
+    manifest.setdefault('continued', []).append(dict(from_length=length, steps=steps))
+    write_manifest(manifest, manifest_path)
 
 
 if __name__ == "__main__":
@@ -95,32 +435,17 @@ if __name__ == "__main__":
 
     outdir = Path('data')
 
-    print("Generating {} training simulations".format(args.num_train))
-    loc_train, vel_train, edges_train, charges_train = generate_dataset(args.num_train,
-                                                                        args.length,
-                                                                        args.sample_freq)
-
-    print("Generating {} validation simulations".format(args.num_valid))
-    loc_valid, vel_valid, edges_valid, charges_valid = generate_dataset(args.num_valid,
-                                                                        args.length,
-                                                                        args.sample_freq)
-
-    print("Generating {} test simulations".format(args.num_test))
-    loc_test, vel_test, edges_test, charges_test = generate_dataset(args.num_test,
-                                                                    args.length_test,
-                                                                    args.sample_freq)
-
-    np.save(outdir / f'loc_train{suffix}.npy', loc_train)
-    np.save(outdir / f'vel_train{suffix}.npy', vel_train)
-    np.save(outdir / f'edges_train{suffix}.npy', edges_train)
-    np.save(outdir / f'charges_train{suffix}.npy', charges_train)
-
-    np.save(outdir / f'loc_valid{suffix}.npy', loc_valid)
-    np.save(outdir / f'vel_valid{suffix}.npy', vel_valid)
-    np.save(outdir / f'edges_valid{suffix}.npy', edges_valid)
-    np.save(outdir / f'charges_valid{suffix}.npy', charges_valid)
-
-    np.save(outdir / f'loc_test{suffix}.npy', loc_test)
-    np.save(outdir / f'vel_test{suffix}.npy', vel_test)
-    np.save(outdir / f'edges_test{suffix}.npy', edges_test)
-    np.save(outdir / f'charges_test{suffix}.npy', charges_test)
+    partitions = [('training', 'train', args.num_train, args.length, seed_train),
+                  ('validation', 'valid', args.num_valid, args.length, seed_valid),
+                  ('test', 'test', args.num_test, args.length_test, seed_test)]
+    for name, partition, num_sims, length, seed_seq in partitions:
+        if args.continue_dataset:
+            if partition in args.continue_partitions:
+                print("Continuing {} {} simulations by {} steps".format(num_sims, name, args.continue_dataset))
+                continue_dataset(num_sims, args.continue_dataset, args.sample_freq, partition, outdir)
+        elif args.merge:
+            print("Merging {} shards of {} {} simulations".format(args.merge, num_sims, name))
+            merge_shards(num_sims, length, args.sample_freq, partition, outdir, args.merge)
+        else:
+            print("Generating {} {} simulations".format(num_sims, name))
+            generate_dataset(num_sims, length, args.sample_freq, seed_seq, partition, outdir)
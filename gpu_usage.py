@@ -1,10 +1,9 @@
 import torch
-from main import get_args
+from main import get_args, make_loader
 from pathlib import Path
 import yaml
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
 import os
 import time
 import psutil
@@ -86,14 +85,14 @@ def main(args):
     loss_mse_no_red = nn.MSELoss(reduction='none')
     if args.model == 'segno':
         from SEGNO.nbody.models.model import SEGNO
-        from SEGNO.nbody.dataset_nbody import NBodyDataset #from nbody.dataset_nbody import NBodyDataset
+        from SEGNO.nbody.dataset_nbody import NBodyDataset, collate_batch #from nbody.dataset_nbody import NBodyDataset
         from SEGNO.nbody.train_nbody import run_epoch
 
         nbody_name = config['other_params']['nbody_name']
 
         dataset_train = NBodyDataset(args.data_dir, partition='train', dataset_name=nbody_name, dataset=args.dataset,
                                     max_samples=args.max_samples, n_balls=args.n_balls)
-        loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True)
+        loader_train = make_loader(dataset_train, args, collate_batch, shuffle=True, drop_last=True)
 
         params = config['model_params'] | dict(varDT=args.varDT, device=device)
         params['n_inputs'] = args.num_inputs
@@ -103,7 +102,7 @@ def main(args):
         model = SEGNO(**params)
         criterion = [loss_mse,loss_mse_no_red]
     else:
-        from EGNO.simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset
+        from EGNO.simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset, collate_batch
         from EGNO.model.egno import EGNO
         from EGNO.main_simulation_simple_no import run_epoch
 
@@ -111,7 +110,7 @@ def main(args):
 
         dataset_train = SimulationDataset(data_dir=args.data_dir, partition='train', max_samples=args.max_samples, dataset=args.dataset, n_balls=args.n_balls, 
                                           num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=args.varDT) #, num_inputs=args.num_inputs
-        loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True, num_workers=0)
+        loader_train = make_loader(dataset_train, args, collate_batch, shuffle=True, drop_last=True)
         
         params = config['model_params'] | dict(num_timesteps=args.num_timesteps, num_inputs=args.num_inputs, varDT=args.varDT, device=device)
         model = EGNO(**params)
@@ -10,6 +10,8 @@ from torch import nn, optim
 from torch.utils.data import DataLoader
 from torch_geometric.data import Data
 from EGNO.utils import EarlyStopping
+from utils import DevicePrefetcher, BlockShuffleSampler
+from arguments import parse_frames
 import json
 import wandb
 
@@ -45,6 +47,28 @@ def get_args():
                         help='Test every test_interval epochs')
     parser.add_argument('--n_balls', type=int, default=5,
                         help='Number of balls in the nbody dataset')
+    parser.add_argument('--sample_freq', type=int, default=None,
+                        help='Load the dataset derived at this sample frequency by derive_dataset.py')
+    parser.add_argument('--mmap', type=str2bool, default=False,
+                        help='Keep the datasets memory-mapped and read the samples as they are accessed')
+    parser.add_argument('--cache_dir', type=Path, default=None,
+                        help='Cache the preprocessed datasets here, reused by later runs with the same data and parameters')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='DataLoader worker processes, kept alive across epochs')
+    parser.add_argument('--pin_memory', type=str2bool, default=False,
+                        help='Collate the batches into pinned memory, for asynchronous copies to the GPU')
+    parser.add_argument('--prefetch', type=str2bool, default=False,
+                        help='Copy the next batch to the GPU while the current step runs')
+    parser.add_argument('--shuffle_block', type=int, default=None,
+                        help='Shuffle the training set in blocks of this many contiguous samples, for mostly sequential '
+                             'reads of memory-mapped datasets (pick blocks that fit in the page cache)')
+    parser.add_argument('--windows', type=parse_frames, default=None,
+                        help='Train on sliding windows starting from the frames start:stop[:stride] of every '
+                             'trajectory instead of only from frame 30')
+    parser.add_argument('--window_sampling', type=str, default='all', choices=['all', 'random'],
+                        help='Every window of every trajectory, or one random window of every trajectory per epoch')
+    parser.add_argument('--store_edge_attr', type=str2bool, default=True,
+                        help='EGNO: store the edge attributes of every sample, or compute them from the charges on the device')
     parser.add_argument('--outf', type=Path, default='results', help='Output folder')
     parser.add_argument('--rollout', type=str2bool, default=True)
     
@@ -57,9 +81,29 @@ def get_args():
                         help='The number of inputs to give for each prediction step.')
     parser.add_argument('--use_wb', type=str2bool, default=False,
                         help='Use wandb for logging')
+    parser.add_argument('--save_energies', type=str2bool, default=False,
+                        help='Also store the energies of every rollout step in the results (debug), '
+                             'not only the per-timestep energy drift mean and std')
     return parser.parse_args()
 
 
+def make_loader(dataset, args, collate_fn, shuffle, drop_last):
+    """
+    DataLoader of the datasets, with args.num_workers persistent workers (forked, they read
+    the dataset tensors or memory maps in place), wrapped to stage the batches on the device
+    and measure the time spent waiting for them. With args.shuffle_block the samples are
+    shuffled by blocks.
+    """
+    workers = args.num_workers
+    sampler = None
+    if shuffle and args.shuffle_block:
+        sampler, shuffle = BlockShuffleSampler(dataset, args.shuffle_block), False
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle, sampler=sampler, drop_last=drop_last,
+                        collate_fn=collate_fn, num_workers=workers, persistent_workers=workers > 0,
+                        pin_memory=args.pin_memory and torch.device(args.device).type == 'cuda')
+    return DevicePrefetcher(loader, args.device, prefetch=args.prefetch)
+
+
 def main(args):
     with open(args.config, 'r') as f:
         config = yaml.safe_load(f)[args.model.upper()]
@@ -83,26 +127,30 @@ def main(args):
     loss_mse = nn.MSELoss()
     loss_mse_no_red = nn.MSELoss(reduction='none')
 
-    results = {'eval epoch': [], 'val loss': [], 'test loss': [], 'train loss': []}
+    results = {'eval epoch': [], 'val loss': [], 'test loss': [], 'train loss': [], 'train data wait': []}
     best_val_loss = 1e8
     best_epoch = 0
 
     if args.model == 'segno':
         from SEGNO.nbody.models.model import SEGNO
-        from SEGNO.nbody.dataset_nbody import NBodyDataset #from nbody.dataset_nbody import NBodyDataset
-        from SEGNO.nbody.train_nbody import run_epoch
+        from SEGNO.nbody.dataset_nbody import NBodyDataset, collate_batch #from nbody.dataset_nbody import NBodyDataset
+        from SEGNO.nbody.train_nbody import run_epoch, frame_offsets
 
         nbody_name = config['other_params']['nbody_name']
 
         dataset_train = NBodyDataset(args.data_dir, partition='train', dataset_name=nbody_name, dataset=args.dataset,
-                                    max_samples=args.max_samples, n_balls=args.n_balls)
-        loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True)
+                                    max_samples=args.max_samples, n_balls=args.n_balls, sample_freq=args.sample_freq, mmap=args.mmap, cache_dir=args.cache_dir,
+                                    frames=frame_offsets(args), windows=args.windows, window_sampling=args.window_sampling)
+        loader_train = make_loader(dataset_train, args, collate_batch, shuffle=True, drop_last=True)
 
-        dataset_val = NBodyDataset(args.data_dir, partition='val', dataset_name=nbody_name, dataset=args.dataset, n_balls=args.n_balls)
-        loader_val = DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False)
+        dataset_val = NBodyDataset(args.data_dir, partition='val', dataset_name=nbody_name, dataset=args.dataset, n_balls=args.n_balls,
+                                   sample_freq=args.sample_freq, mmap=args.mmap, cache_dir=args.cache_dir, frames=frame_offsets(args))
+        loader_val = make_loader(dataset_val, args, collate_batch, shuffle=False, drop_last=False)
 
-        dataset_test = NBodyDataset(args.data_dir, partition='test', dataset_name=nbody_name, dataset=args.dataset, n_balls=args.n_balls)
-        loader_test = DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False)
+        dataset_test = NBodyDataset(args.data_dir, partition='test', dataset_name=nbody_name, dataset=args.dataset, n_balls=args.n_balls,
+                                    sample_freq=args.sample_freq, mmap=args.mmap, cache_dir=args.cache_dir,
+                                    frames=frame_offsets(args, rollout=args.rollout))
+        loader_test = make_loader(dataset_test, args, collate_batch, shuffle=False, drop_last=False)
 
         params = config['model_params'] | dict(varDT=args.varDT, device=device)
         params['n_inputs'] = args.num_inputs
@@ -116,26 +164,30 @@ def main(args):
         # if args.num_inputs > 1:
         #     print("Multiple inputs are not supported for EGNO. Using single input instead.")
         #     return None, None, None
-        from EGNO.simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset
+        from EGNO.simulation.dataset_simple import NBodyDynamicsDataset as SimulationDataset, collate_batch
         from EGNO.model.egno import EGNO
         from EGNO.main_simulation_simple_no import run_epoch
 
         args.varDT = True if args.varDT and args.num_inputs>1 else False
 
         dataset_train = SimulationDataset(data_dir=args.data_dir, partition='train', max_samples=args.max_samples, dataset=args.dataset, n_balls=args.n_balls, 
-                                          num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=args.varDT) #, num_inputs=args.num_inputs
-        loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, drop_last=True, num_workers=0)
+                                          num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=args.varDT,
+                                          sample_freq=args.sample_freq, mmap=args.mmap, cache_dir=args.cache_dir,
+                                          store_edge_attr=args.store_edge_attr, windows=args.windows,
+                                          window_sampling=args.window_sampling) #, num_inputs=args.num_inputs
+        loader_train = make_loader(dataset_train, args, collate_batch, shuffle=True, drop_last=True)
 
         dataset_val = SimulationDataset(data_dir=args.data_dir, partition='val', n_balls=args.n_balls, dataset=args.dataset,
-                                        num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=args.varDT)#num_inputs=args.num_inputs
-        loader_val = DataLoader(dataset_val, batch_size=args.batch_size, shuffle=False, drop_last=False,
-                                                num_workers=0)
+                                        num_timesteps=args.num_timesteps,num_inputs=args.num_inputs, varDT=args.varDT,
+                                        sample_freq=args.sample_freq, mmap=args.mmap, cache_dir=args.cache_dir,
+                                        store_edge_attr=args.store_edge_attr)#num_inputs=args.num_inputs
+        loader_val = make_loader(dataset_val, args, collate_batch, shuffle=False, drop_last=False)
 
         dataset_test = SimulationDataset(data_dir=args.data_dir, partition='test', n_balls=args.n_balls, dataset=args.dataset,
                                          num_timesteps=args.num_timesteps, num_inputs=args.num_inputs, rollout=True, 
-                                         traj_len=args.traj_len, varDT= args.varDT)
-        loader_test = DataLoader(dataset_test, batch_size=args.batch_size, shuffle=False, drop_last=False,
-                                                num_workers=0)
+                                         traj_len=args.traj_len, varDT= args.varDT, sample_freq=args.sample_freq, mmap=args.mmap, cache_dir=args.cache_dir,
+                                         store_edge_attr=args.store_edge_attr)
+        loader_test = make_loader(dataset_test, args, collate_batch, shuffle=False, drop_last=False)
         
         params = config['model_params'] | dict(num_timesteps=args.num_timesteps, num_inputs=args.num_inputs, varDT=args.varDT, device=device)
         model = EGNO(**params)
@@ -148,6 +200,8 @@ def main(args):
     for epoch in range(args.epochs):
         train_loss = run_epoch(model, optimizer, criterion, epoch, loader_train, args)
         results['train loss'].append(train_loss)
+        results['train data wait'].append(loader_train.wait_time)
+        print("Epoch %d: %.2fs waiting for data" % (epoch, loader_train.wait_time))
         if (epoch +1) % args.test_interval == 0 or epoch == args.epochs-1:
             val_loss = run_epoch(model, optimizer, criterion, epoch, loader_val, args, backprop=False)
             
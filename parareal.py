@@ -0,0 +1,223 @@
+import argparse
+import json
+import multiprocessing
+import time
+from pathlib import Path
+import numpy as np
+import torch
+import yaml
+from synthetic_sim import ChargedParticlesSim, GravitySim
+
+"""
+Parareal: long simulator-accurate trajectories with the time axis split over processes. A trained
+EGNO/SEGNO checkpoint is the cheap coarse propagator over one slice of num_timesteps frames, the
+simulator the fine one. Every iteration runs the fine propagator of all slices in parallel and
+corrects the coarse predictions with it; after k iterations the first k slices are exact.
+    python parareal.py --model egno --checkpoint results/exp_2/egno/charged_seed=42_n_part=5_n_inputs=1_varDT=False_num_timesteps=10.pth
+        --dataset charged --n_balls 5 --suffix small --num_sims 100 --n_slices 16 --workers 16
+The simulator configuration (sample frequency, integrator, force backend) is read from the
+manifest of the dataset the initial frames are taken from.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, choices=['segno', 'egno'], required=True,
+                    help='Model of the checkpoint used as coarse propagator.')
+parser.add_argument('--checkpoint', type=Path, required=True,
+                    help='State dict saved by main.py.')
+parser.add_argument('--config', type=str, default='model_confs.yaml')
+parser.add_argument('--num_timesteps', type=int, default=10,
+                    help='Frames the checkpoint predicts ahead, the length of one time slice.')
+parser.add_argument('--data_dir', type=Path, default='data')
+parser.add_argument('--dataset', type=str, default='charged', choices=['charged', 'gravity'])
+parser.add_argument('--n_balls', type=int, default=5)
+parser.add_argument('--suffix', type=str, default='small',
+                    help='Suffix of the dataset files, as passed to generate_dataset.py.')
+parser.add_argument('--partition', type=str, default='test', choices=['train', 'valid', 'test'])
+parser.add_argument('--num_sims', type=int, default=100,
+                    help='Number of simulations of the dataset continued from --start_frame.')
+parser.add_argument('--start_frame', type=int, default=30)
+parser.add_argument('--n_slices', type=int, default=16,
+                    help='Number of time slices of num_timesteps frames each.')
+parser.add_argument('--max_iters', type=int, default=None,
+                    help='Stop after this many iterations (at most n_slices are ever needed).')
+parser.add_argument('--tol', type=float, default=1e-6,
+                    help='Converged once no slice boundary state changes by more than this.')
+parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+parser.add_argument('--ensemble_size', type=int, default=10,
+                    help='Number of simulations in one fine propagation task.')
+parser.add_argument('--out', type=Path, default='parareal.npz')
+args = parser.parse_args()
+
+suffix = f'_{args.dataset}{args.n_balls}_initvel1{args.suffix}'
+with open(args.data_dir / f'manifest_{args.partition}{suffix}.json') as f:
+    manifest = json.load(f)
+config = manifest['config']
+sample_freq = config['sample_freq']
+if config['simulation'] == 'charged':
+    sim = ChargedParticlesSim(noise_var=0.0, n_balls=args.n_balls, force_backend=config['force_backend'],
+                              theta=config['theta'], integrator=config['integrator'])
+else:
+    sim = GravitySim(noise_var=0.0, n_balls=args.n_balls, force_backend=config['force_backend'],
+                     theta=config['theta'], integrator=config['integrator'])
+
+
+def open_frames(name):
+    """
+    :return: the memory-mapped {name} output, and the first stored frame and frame stride in it
+    """
+    view = manifest.get('views', {}).get(name)
+    if view is None:
+        return np.load(args.data_dir / f'{name}_{args.partition}{suffix}.npy', mmap_mode='r'), 0, 1
+    return np.load(args.data_dir / view['file'], mmap_mode='r'), view['start'], view['stride']
+
+
+def load_frames(name, frames):
+    """
+    :return: the given trajectory frames of the first num_sims simulations, num_sims x T x N x 3
+    """
+    data, start, stride = open_frames(name)
+    if manifest['frames'] is not None:
+        # window kept by --keep_frames
+        window = manifest['frames']
+        frames = [(frame - window['start']) // window['stride'] for frame in frames]
+    x = np.array(data[:args.num_sims, [start + stride * frame for frame in frames]], dtype=np.float64)
+    if x.shape[-2:] != (args.n_balls, 3):
+        x = x.transpose(0, 1, 3, 2)
+    return x
+
+
+def fine_task(task):
+    """
+    Fine propagation of one time slice of some simulations.
+    :return: slice, first simulation, the num_timesteps frames of loc, vel (B x T x N x 3), runtime
+    """
+    n, j, loc, vel, params = task
+    t = time.time()
+    loc, vel = sim.advance_frames(loc, vel, params, args.num_timesteps, sample_freq)
+    if config['simulation'] != 'gravity':
+        loc, vel = loc.transpose(0, 1, 3, 2), vel.transpose(0, 1, 3, 2)
+    return n, j, loc, vel, time.time() - t
+
+
+def load_model(device):
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)[args.model.upper()]
+    if args.model == 'egno':
+        from EGNO.model.egno import EGNO
+        params = config['model_params'] | dict(num_timesteps=args.num_timesteps, num_inputs=1, varDT=False, device=device)
+        model = EGNO(**params)
+    else:
+        from SEGNO.nbody.models.model import SEGNO
+        params = config['model_params'] | dict(varDT=False, device=device, n_inputs=1)
+        model = SEGNO(**params)
+    model.load_state_dict(torch.load(args.checkpoint, map_location=device, weights_only=False))
+    model.eval()
+    return model
+
+
+@torch.no_grad()
+def coarse_step(model, loc, vel, params, device):
+    """
+    Coarse propagation of one time slice, built like one step of the rollouts of the training scripts.
+    :param loc, vel: B x N x 3 frame, params: B x N x 1 charges or masses
+    :return: loc, vel num_timesteps frames later
+    """
+    B, N, _ = loc.shape
+    loc = torch.tensor(loc, dtype=torch.float32, device=device).view(-1, 3)
+    vel = torch.tensor(vel, dtype=torch.float32, device=device).view(-1, 3)
+    charges = torch.tensor(params, dtype=torch.float32, device=device).view(-1, 1)
+    nodes = torch.cat([torch.sqrt(torch.sum(vel ** 2, dim=1)).unsqueeze(1), charges], dim=1)
+    if args.model == 'egno':
+        # fully connected graph, with the charge products as edge attributes
+        i, j = np.nonzero(~np.eye(N, dtype=bool))
+        offsets = np.repeat(np.arange(B) * N, len(i))
+        rows = torch.tensor(np.tile(i, B) + offsets, device=device)
+        cols = torch.tensor(np.tile(j, B) + offsets, device=device)
+        loc_dist = torch.sum((loc[rows] - loc[cols]) ** 2, 1).unsqueeze(1)
+        edge_attr = torch.cat([charges[rows] * charges[cols], loc_dist], 1)
+        loc_mean = loc.view(B, N, 3).mean(dim=1, keepdim=True).repeat(1, N, 1).view(-1, 3)
+        loc_pred, vel_pred, _ = model(loc, nodes, [rows, cols], edge_attr, v=vel, loc_mean=loc_mean)
+        loc_pred = loc_pred.view(args.num_timesteps, -1, 3)[-1]
+        vel_pred = vel_pred.view(args.num_timesteps, -1, 3)[-1]
+    else:
+        from torch_geometric.nn import knn_graph
+        batch = torch.arange(B, device=device).repeat_interleave(N)
+        edge_index = knn_graph(loc, 4, batch)
+        rows, cols = edge_index
+        edge_attr = torch.sum((loc[rows] - loc[cols]) ** 2, 1).unsqueeze(1)
+        loc_pred, _, vel_pred = model(nodes, loc, edge_index, vel, edge_attr, T=args.num_timesteps)
+    return (loc_pred.view(B, N, 3).double().cpu().numpy(),
+            vel_pred.view(B, N, 3).double().cpu().numpy())
+
+
+def parareal(model, loc0, vel0, params, pool, device):
+    """
+    :return: loc, vel trajectories (num_sims x n_slices * num_timesteps x N x 3) from the fine
+        propagations of the last iteration, the number of iterations and the largest change of
+        a slice boundary state in every iteration
+    """
+    K, m = args.n_slices, args.num_timesteps
+    max_iters = K if args.max_iters is None else min(args.max_iters, K)
+    # boundary states U[n] of the slices, and the coarse propagations G[n] of U[n]
+    U = np.zeros((K + 1, 2) + loc0.shape)
+    G = np.zeros((K, 2) + loc0.shape)
+    U[0] = loc0, vel0
+    for n in range(K):
+        G[n] = coarse_step(model, U[n, 0], U[n, 1], params, device)
+        U[n + 1] = G[n]
+
+    frames = np.zeros((2, K, len(loc0), m) + loc0.shape[1:])
+    changes, fine_time = [], 0.
+    for k in range(max_iters):
+        # slices before k start from exact states and are already final
+        tasks = [(n, j, U[n, 0, j:j + args.ensemble_size], U[n, 1, j:j + args.ensemble_size],
+                  params[j:j + args.ensemble_size])
+                 for n in range(k, K) for j in range(0, len(loc0), args.ensemble_size)]
+        for n, j, loc, vel, runtime in pool.imap_unordered(fine_task, tasks):
+            frames[0, n, j:j + len(loc)] = loc
+            frames[1, n, j:j + len(loc)] = vel
+            fine_time += runtime
+
+        U_new = U.copy()
+        for n in range(k, K):
+            g = coarse_step(model, U_new[n, 0], U_new[n, 1], params, device)
+            U_new[n + 1] = g + frames[:, n, :, -1] - G[n]
+            G[n] = g
+        changes.append(float(np.abs(U_new - U).max()))
+        U = U_new
+        print("Iteration {}: largest boundary state change {:.3e}".format(k + 1, changes[-1]))
+        if changes[-1] <= args.tol:
+            break
+
+    # (2, K, B, m, N, 3) -> (2, B, K * m, N, 3)
+    frames = frames.transpose(0, 2, 1, 3, 4, 5).reshape(2, len(loc0), K * m, *loc0.shape[1:])
+    return frames[0], frames[1], len(changes), changes, fine_time
+
+
+if __name__ == "__main__":
+    # fork the workers before torch starts any threads
+    pool = multiprocessing.Pool(args.workers)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = load_model(device)
+
+    loc0, vel0 = load_frames('loc', [args.start_frame])[:, 0], load_frames('vel', [args.start_frame])[:, 0]
+    params = np.array(np.load(args.data_dir / f'charges_{args.partition}{suffix}.npy', mmap_mode='r')[:args.num_sims])
+
+    t = time.time()
+    loc, vel, iterations, changes, fine_time = parareal(model, loc0, vel0, params, pool, device)
+    wall_time = time.time() - t
+    pool.close()
+    pool.join()
+
+    print("Converged after {} of {} parareal iterations in {:.1f}s, {:.1f}s of fine propagation"
+          .format(iterations, args.n_slices, wall_time, fine_time))
+    # the dataset may already hold (part of) the trajectory to check against
+    data, start, stride = open_frames('loc')
+    stored = len(range(start, data.shape[1], stride))
+    last = min(args.start_frame + args.n_slices * args.num_timesteps, stored - 1)
+    if manifest['frames'] is None and last > args.start_frame:
+        reference = load_frames('loc', list(range(args.start_frame + 1, last + 1)))
+        print("Largest deviation from the stored trajectory: {:.3e}".format(
+            np.abs(loc[:, :last - args.start_frame] - reference).max()))
+    np.savez(args.out, loc=loc, vel=vel, charges=params, iterations=iterations, changes=np.array(changes),
+             start_frame=args.start_frame, num_timesteps=args.num_timesteps, sample_freq=sample_freq)
@@ -9,6 +9,7 @@ import pickle
 import textwrap
 from tabulate import tabulate
 from PIL import Image
+from energy import total_energy
 
 #funzionamento attuale SEGNO (NODE)
 # def forward(x):
@@ -468,17 +469,8 @@ def estimate_velocities(loc, delta_t):
     return vel
 
 def tot_energy(loc, vel, edges, interaction_strength=.1):
-        with np.errstate(divide='ignore'):
-            K = 0.5 * (vel ** 2).sum()
-            U = 0
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * interaction_strength * edges[
-                            i, j] * (dist ** 2) / 2
-            return U + K
+    # loc, vel: np.array of shape (..., 3, N)
+    return total_energy('springs', np.swapaxes(loc, -1, -2), np.swapaxes(vel, -1, -2), edges, interaction_strength)
 
 def compute_energy_drift(loc, vels, edges):
     """
@@ -490,21 +482,15 @@ def compute_energy_drift(loc, vels, edges):
     - edges: np.array of shape (N, N)
     
     Returns:
-    - energy_drift: np.array of shape (T,)
+    - energy_drift: np.array of shape (T-1,), for the frames with an estimated velocity
     """
     delta_t = 0.01  # or whatever your simulation used
     vel = estimate_velocities(loc, delta_t)
-    T = loc.shape[0]
-    energy_drift = np.zeros(T)
+    energy = tot_energy(loc[:len(vel)], vel, edges)
 
     # Initial energy
-    E0 = tot_energy(loc[0], vel[0], edges)
-
-    for t in range(T):
-        Et = tot_energy(loc[t], vel[t], edges)
-        energy_drift[t] = np.abs((Et - E0) / (E0 + 1e-10))  # epsilon for stability
-
-    return energy_drift
+    E0 = energy[0]
+    return np.abs((energy - E0) / (E0 + 1e-10))  # epsilon for stability
 
 
 def load_trajectory_for_config(config, model, metric="MSE"):
@@ -965,6 +951,11 @@ def compute_avg_loss_until_t_wandb(config, same_t=True, metric="MAE", std=True):
 
 def compute_energy_mean_std_per_timestep(tensor_list):
     
+    if len(tensor_list) > 0 and hasattr(tensor_list[0], 'keys') and 'energy_drift_mean' in tensor_list[0]:
+        # results with the streamed drift summary: average the per-timestep mean drift over the runs
+        ed_losses = torch.stack([torch.as_tensor(r['energy_drift_mean']) for r in tensor_list], dim=0)  # Shape: (runs, T)
+        return torch.mean(ed_losses, dim=0), torch.std(ed_losses, dim=0)
+
     #T = tensor_list[0].shape[2]  # Extract T (number of timesteps)
     energy_drift_list = []  
     # Iterate over each tensor in the list and compute MSE loss for each timestep
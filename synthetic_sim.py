@@ -1,17 +1,300 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+from energy import kinetic_energy, potential_energy, total_energy
+
+
+def _system_rngs(B, rngs=None):
+    """
+    Return one random stream per system of an ensemble. A stream only needs
+    the np.random.RandomState interface (randn, choice); when no streams are
+    given every system draws from the global np.random state.
+    """
+    if rngs is None:
+        return [np.random] * B
+    assert (len(rngs) == B), "Need one random stream per system"
+    return list(rngs)
+
+
+# 'direct' sums all N^2 pairs, 'barnes_hut' approximates far away nodes of an
+# octree with their monopoles (opening angle theta), in O(N log N)
+FORCE_BACKENDS = ['direct', 'barnes_hut']
+
+
+def _morton_keys(cells, depth):
+    """
+    Interleave the bits of integer cell coordinates (N, 3) into Morton keys,
+    so that sorting the keys sorts particles along the octree.
+    """
+    keys = np.zeros(len(cells), dtype=np.uint64)
+    cells = cells.astype(np.uint64)
+    for bit in range(depth):
+        for d in range(3):
+            keys |= ((cells[:, d] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + d)
+    return keys
+
+
+class BarnesHutTree(object):
+    """
+    Linear octree over one system, built with bulk NumPy operations on the
+    sorted Morton keys of the particles. Every node keeps two monopoles, one
+    for the positive and one for the negative weights, so that signed charges
+    (and signed masses) are approximated without cancelling inside a node.
+    """
+
+    def __init__(self, pos, weights, max_depth=21):
+        '''
+        :param pos: Nx3 particle positions
+        :param weights: N masses or charges
+        :param max_depth: maximum number of levels below the root
+        '''
+        N = len(pos)
+        lo = pos.min(axis=0)
+        size = (pos.max(axis=0) - lo).max() * (1. + 1e-9)
+        size = size if size > 0 else 1.
+        cells = np.minimum(((pos - lo) / size * 2 ** max_depth).astype(np.int64), 2 ** max_depth - 1)
+        keys = _morton_keys(cells, max_depth)
+        order = np.argsort(keys, kind='stable')
+        keys, cells = keys[order], cells[order]
+        pos, weights = pos[order], weights[order]
+        w_pos, w_neg = np.maximum(weights, 0.), np.minimum(weights, 0.)
+
+        self.pos = pos
+        self.order = order
+        self.levels = []
+        for level in range(max_depth + 1):
+            shift = max_depth - level
+            level_keys = keys >> np.uint64(3 * shift)
+            first = np.flatnonzero(np.concatenate(([True], level_keys[1:] != level_keys[:-1])))
+            node = np.cumsum(np.concatenate(([0], level_keys[1:] != level_keys[:-1])))
+            count = np.diff(np.append(first, N))
+            side = size / 2 ** level
+            monopoles = []
+            for w in (w_pos, w_neg):
+                W = np.add.reduceat(w, first)
+                moment = np.add.reduceat(w[:, None] * pos, first, axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    center = np.where(W[:, None] != 0, moment / W[:, None], 0.)
+                monopoles.append((W, center))
+            self.levels.append(dict(keys=level_keys[first], count=count, node=node, side=side,
+                                    center=lo + ((cells[first] >> shift) + 0.5) * side,
+                                    monopoles=monopoles))
+            if count.max() == 1:
+                break
+
+        # children of every node are contiguous in the next level
+        for parent, child in zip(self.levels[:-1], self.levels[1:]):
+            up = child['keys'] >> np.uint64(3)
+            parent['child_start'] = np.searchsorted(up, parent['keys'], side='left')
+            parent['child_end'] = np.searchsorted(up, parent['keys'], side='right')
+
+    def field(self, theta=0.5, softening=0.):
+        '''
+        :return: Nx3 field sum_j w_j (r_j - r_i) / (|r_j - r_i|^2 + softening^2)^(3/2)
+            at every particle, in the original particle order
+        '''
+        N = len(self.pos)
+        out = np.zeros((N, 3))
+        target = np.arange(N)
+        node = np.zeros(N, dtype=np.int64)
+        for depth, level in enumerate(self.levels):
+            leaf = (level['count'][node] == 1) | (depth == len(self.levels) - 1)
+            far = (level['node'][target] != node) & \
+                (level['side'] < theta * np.linalg.norm(self.pos[target] - level['center'][node], axis=-1))
+            accept = leaf | far
+            t, n = target[accept], node[accept]
+            for W, center in level['monopoles']:
+                r = center[n] - self.pos[t]
+                r2 = (r ** 2).sum(axis=-1) + softening ** 2
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    f = np.where(r2 > 0, W[n] / r2 ** 1.5, 0.)
+                for d in range(3):
+                    out[:, d] += np.bincount(t, weights=f * r[:, d], minlength=N)
+
+            # open the remaining nodes
+            target, node = target[~accept], node[~accept]
+            if len(target) == 0:
+                break
+            start, n_children = level['child_start'][node], level['child_end'][node] - level['child_start'][node]
+            target = np.repeat(target, n_children)
+            offsets = np.arange(len(target)) - np.repeat(np.cumsum(n_children) - n_children, n_children)
+            node = np.repeat(start, n_children) + offsets
+
+        field = np.zeros_like(out)
+        field[self.order] = out
+        return field
+
+
+def barnes_hut_field(pos, weights, theta=0.5, softening=0.):
+    """
+    Barnes-Hut approximation of sum_j w_j (r_j - r_i) / (|r_j - r_i|^2 + softening^2)^(3/2)
+    for positions (..., N, 3) and weights (..., N); one tree is built per system.
+    """
+    flat_pos = pos.reshape(-1, *pos.shape[-2:])
+    flat_weights = weights.reshape(-1, weights.shape[-1])
+    field = np.stack([BarnesHutTree(p, w).field(theta, softening)
+                      for p, w in zip(flat_pos, flat_weights)])
+    return field.reshape(pos.shape)
+
+
+# 'leapfrog' is the original fixed step scheme of every simulator; the others
+# choose their step from an energy error target (see _calibrate_level)
+INTEGRATORS = ['leapfrog', 'yoshida4', 'forest_ruth', 'block_kdk']
+
+_W1 = 1. / (2. - 2. ** (1. / 3.))
+_W0 = 1. - 2. * _W1
+# symmetric splitting schemes as (operation, fraction of the step) sequences
+SPLITTING_SCHEMES = {
+    # Yoshida triple jump of kick-drift-kick leapfrog, 4th order
+    'yoshida4': [('kick', _W1 / 2), ('drift', _W1), ('kick', (_W1 + _W0) / 2), ('drift', _W0),
+                 ('kick', (_W0 + _W1) / 2), ('drift', _W1), ('kick', _W1 / 2)],
+    # Forest-Ruth, the same triple jump starting with a drift, 4th order
+    'forest_ruth': [('drift', _W1 / 2), ('kick', _W1), ('drift', (_W1 + _W0) / 2), ('kick', _W0),
+                    ('drift', (_W0 + _W1) / 2), ('kick', _W1), ('drift', _W1 / 2)],
+}
+# kick-drift-kick leapfrog, the fallback of the schemes above when their target is
+# not reached within the original number of force evaluations
+_LEAPFROG_SCHEME = [('kick', .5), ('drift', 1.), ('kick', .5)]
+
+
+def _splitting_step(x, v, a, accel, h, scheme):
+    """
+    Advance x, v in place by one step h of a splitting scheme. a is the
+    acceleration at x (or None if unknown) and is returned for the new x, so
+    that kicks separated by no drift share one force evaluation.
+    """
+    for op, c in scheme:
+        if op == 'drift':
+            x += c * h * v
+            a = None
+        else:
+            if a is None:
+                a = accel(x)
+            v += c * h * a
+    return a
+
+
+def _relative_energy_drift(energy, E0):
+    '''
+    :param energy: (K, U) per system
+    :param E0: (K0, U0) per system at the start
+    :return: |E - E0| / (|K0| + |U0|) per system
+    '''
+    K, U = energy
+    K0, U0 = E0
+    return np.abs(K + U - K0 - U0) / (np.abs(K0) + np.abs(U0))
+
+
+def _relative_energy_error(energy, E0):
+    # largest relative energy drift over the ensemble
+    return np.max(_relative_energy_drift(energy, E0))
+
+
+def _unhealthy(loc, vel, max_speed=None, max_energy_drift=None, energy=None, E0=None):
+    '''
+    Health check of an ensemble state.
+    :param loc, vel: BxNx3 positions and velocities
+    :param energy: callable giving (K, U) per system of loc, vel, only
+        evaluated (and compared to E0) when max_energy_drift is given
+    :return: mask of the B systems with non-finite values, a particle faster
+        than max_speed or a relative energy drift above max_energy_drift
+    '''
+    # written so that NaNs fail every comparison
+    bad = ~(np.isfinite(loc).all(axis=(1, 2)) & np.isfinite(vel).all(axis=(1, 2)))
+    if max_speed is not None:
+        bad |= ~((vel ** 2).sum(axis=-1).max(axis=-1) <= max_speed ** 2)
+    if max_energy_drift is not None:
+        with np.errstate(all='ignore'):
+            bad |= ~(_relative_energy_drift(energy(loc, vel), E0) <= max_energy_drift)
+    return bad
+
+
+def _calibrate_level(pilot, energy_tol, max_level=12, fallback=None):
+    """
+    Smallest resolution level (the step halves with every level) whose pilot
+    run keeps the relative energy error below energy_tol. If no level up to
+    max_level does, max_level is used, or None is returned when a fallback
+    (a description of what the caller uses instead) is given.
+    """
+    for level in range(max_level + 1):
+        if pilot(level) <= energy_tol:
+            return level
+    if fallback is not None:
+        print("Energy error target {} not reached up to level {}, falling back to {}".format(
+            energy_tol, max_level, fallback))
+        return None
+    print("Energy error target {} not reached, using level {}".format(energy_tol, max_level))
+    return max_level
+
+
+def _force_evals_per_step(scheme):
+    # kicks of consecutive steps with no drift in between share one force evaluation
+    kicks = sum(op == 'kick' for op, _ in scheme)
+    return kicks - (scheme[0][0] == 'kick' and scheme[-1][0] == 'kick')
+
+
+def _splitting_substeps(x, v, accel, energy, frame_dt, sample_freq, scheme, energy_tol, calib_frames=5):
+    """
+    Scheme and number of steps per stored frame of a splitting scheme: the
+    original sample_freq without an energy target, otherwise the fewest power
+    of two steps meeting the target on a short pilot run from the initial
+    state, within the force evaluations of the original sample_freq leapfrog
+    steps. If the target is not met within that budget (clamped forces may make
+    it unreachable), leapfrog with the original sample_freq steps is used.
+    """
+    if energy_tol is None:
+        return scheme, sample_freq
+    budget = sample_freq // _force_evals_per_step(scheme)
+
+    def pilot(level):
+        x_p, v_p, a = x.copy(), v.copy(), None
+        E0 = energy(x_p, v_p)
+        error = 0.
+        for _ in range(calib_frames):
+            for _ in range(2 ** level):
+                a = _splitting_step(x_p, v_p, a, accel, frame_dt / 2 ** level, scheme)
+            error = max(error, _relative_energy_error(energy(x_p, v_p), E0))
+        return error
+
+    fallback = "leapfrog with {} steps per frame".format(sample_freq)
+    if budget < 1:
+        print("Energy error target {} needs more force evaluations than {} steps per frame, "
+              "falling back to {}".format(energy_tol, sample_freq, fallback))
+        return _LEAPFROG_SCHEME, sample_freq
+    level = _calibrate_level(pilot, energy_tol, max_level=int(np.log2(budget)), fallback=fallback)
+    if level is None:
+        return _LEAPFROG_SCHEME, sample_freq
+    return scheme, 2 ** level
+
+
+def _splitting_frames(x, v, accel, energy, frame_dt, sample_freq, n_frames, integrator, energy_tol):
+    """
+    Advance x, v in place frame by frame with a splitting scheme, yielding
+    after each of the n_frames frames (the acceleration at x, or None).
+    """
+    scheme, n_sub = _splitting_substeps(x, v, accel, energy, frame_dt, sample_freq,
+                                        SPLITTING_SCHEMES[integrator], energy_tol)
+    a = None
+    for _ in range(n_frames):
+        for _ in range(n_sub):
+            a = _splitting_step(x, v, a, accel, frame_dt / n_sub, scheme)
+        yield a
 
 
 class SpringSim(object):
     def __init__(self, n_balls=5, box_size=5., loc_std=.5, vel_norm=.5,
-                 interaction_strength=.1, noise_var=0.):
+                 interaction_strength=.1, noise_var=0., integrator='leapfrog', energy_tol=None):
+        if integrator not in SPLITTING_SCHEMES and integrator != 'leapfrog':
+            raise ValueError('Integrator {} not implemented for springs'.format(integrator))
         self.n_balls = n_balls
         self.box_size = box_size
         self.loc_std = loc_std
         self.vel_norm = vel_norm
         self.interaction_strength = interaction_strength
         self.noise_var = noise_var
+        self.integrator = integrator
+        self.energy_tol = energy_tol
+        self.force_evals = 0
 
         self._spring_types = np.array([0., 0.5, 1.])
         self._delta_T = 0.001
@@ -19,19 +302,15 @@ class SpringSim(object):
         self.dim = 3
 
     def _energy(self, loc, vel, edges):
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide='ignore'):
-
-            K = 0.5 * (vel ** 2).sum()
-            U = 0
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * self.interaction_strength * edges[
-                            i, j] * (dist ** 2) / 2
-            return U + K
+        # loc, vel: 3xN
+        return total_energy('springs', loc.T, vel.T, edges, self.interaction_strength)
+
+    def _ensemble_energy(self, loc, vel, edges):
+        '''
+        :param loc: BxNx3 locations, vel: BxNx3 velocities, edges: BxNxN
+        :return: kinetic and potential energy of each system, both of shape B
+        '''
+        return kinetic_energy(vel), potential_energy('springs', loc, edges, self.interaction_strength)
 
     def _clamp(self, loc, vel):
         '''
@@ -71,84 +350,134 @@ class SpringSim(object):
         dist = A_norm + B_norm - 2 * A.dot(B.transpose())
         return dist
 
+    def _forces(self, loc, edges):
+        '''
+        :param loc: BxNx3 locations of B systems at one time stamp
+        :param edges: BxNxN spring types of each system
+        :return: BxNx3 clamped forces
+        '''
+        self.force_evals += 1
+        n = loc.shape[1]
+        forces_size = - self.interaction_strength * edges
+        # self forces are zero
+        forces_size[:, np.arange(n), np.arange(n)] = 0
+        F = (forces_size[..., None] *
+             (loc[:, :, None, :] - loc[:, None, :, :])).sum(axis=2)
+        F[F > self._max_F] = self._max_F
+        F[F < -self._max_F] = -self._max_F
+        return F
+
+    def output_shapes(self, T=10000, sample_freq=10, continued=False):
+        '''
+        :param continued: shapes of a call continuing from a final_state
+        :return: shapes of loc, vel, edges as returned by sample_trajectory
+        '''
+        T_save = int(T / sample_freq - (not continued))
+        n = self.n_balls
+        return [(T_save, self.dim, n), (T_save, self.dim, n), (n, n)]
+
+    def advance_frames(self, loc, vel, edges, n_frames, sample_freq=10):
+        '''
+        Continue B systems from one stored frame without noise.
+        :param loc, vel: BxNx3 frame, velocities half a step behind for leapfrog
+        :return: loc, vel of the next n_frames stored frames, Bxn_framesx3xN
+        '''
+        if self.integrator != 'leapfrog':
+            # frames of the splitting schemes are the integrator state
+            return self.sample_trajectories(len(loc), T=n_frames * sample_freq, sample_freq=sample_freq,
+                                            state=(loc, vel, edges))[:2]
+        # the kick following the frame, then every step is stored and subsampled
+        vel = vel + self._delta_T * self._forces(loc, edges)
+        loc, vel, _ = self.sample_trajectories(len(loc), T=n_frames * sample_freq, sample_freq=1,
+                                               state=(loc, vel, edges))
+        return loc[:, sample_freq - 1::sample_freq], vel[:, sample_freq - 1::sample_freq]
+
     def sample_trajectory(self, T=10000, sample_freq=10,
-                          spring_prob=[1. / 2, 0, 1. / 2]):
+                          spring_prob=[1. / 2, 0, 1. / 2], rng=None):
+        loc, vel, edges = self.sample_trajectories(
+            1, T=T, sample_freq=sample_freq, spring_prob=spring_prob,
+            rngs=None if rng is None else [rng])
+        return loc[0], vel[0], edges[0]
+
+    def sample_trajectories(self, B, T=10000, sample_freq=10,
+                            spring_prob=[1. / 2, 0, 1. / 2], rngs=None, state=None):
+        '''
+        Integrate an ensemble of B independent systems in lockstep.
+        :param B: number of systems
+        :param rngs: optional list of B random streams, one per system
+        :param state: final_state (loc, vel, edges) of an earlier call, which is
+            then continued by T more steps (T / sample_freq new frames)
+        :return: loc, vel of shape BxT_savex3xN and edges of shape BxNxN,
+            i.e. the outputs of sample_trajectory stacked along axis 0. The
+            integrator state at the end is left in self.final_state.
+        '''
         n = self.n_balls
         assert (T % sample_freq == 0)
-        T_save = int(T / sample_freq - 1)
-        diag_mask = np.ones((n, n), dtype=bool)
-        np.fill_diagonal(diag_mask, 0)
+        T_save = int(T / sample_freq - (state is None))
+        rngs = _system_rngs(B, rngs)
         counter = 0
-        # Sample edges
-        edges = np.random.choice(self._spring_types,
-                                 size=(self.n_balls, self.n_balls),
-                                 p=spring_prob)
-        edges = np.tril(edges) + np.tril(edges, -1).T
-        np.fill_diagonal(edges, 0)
-        # Initialize location and velocity
-        loc = np.zeros((T_save, self.dim, n))
-        vel = np.zeros((T_save, self.dim, n))
-        loc_next = np.random.randn(self.dim, n) * self.loc_std
-        vel_next = np.random.randn(self.dim, n)
-        v_norm = np.sqrt((vel_next ** 2).sum(axis=0)).reshape(1, -1)
-        vel_next = vel_next * self.vel_norm / v_norm
-        loc[0, :, :], vel[0, :, :] = self._clamp(loc_next, vel_next)
-
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide='ignore'):
-
-            forces_size = - self.interaction_strength * edges
-            np.fill_diagonal(forces_size,
-                             0)  # self forces are zero (fixes division by zero)
-            F = (forces_size.reshape(1, n, n) *
-                 np.concatenate((
-                     np.subtract.outer(loc_next[0, :],
-                                       loc_next[0, :]).reshape(1, n, n),
-                     np.subtract.outer(loc_next[1, :],
-                                       loc_next[1, :]).reshape(1, n, n),
-                     np.subtract.outer(loc_next[2, :],
-                                       loc_next[2, :]).reshape(1, n, n)
-                 ))).sum(
-                axis=-1)
-            F[F > self._max_F] = self._max_F
-            F[F < -self._max_F] = -self._max_F
-
-            vel_next += self._delta_T * F
-            # run leapfrog
-            for i in range(1, T):
+        if state is None:
+            edges = np.zeros((B, n, n))
+            loc_next = np.zeros((B, n, self.dim))
+            vel_next = np.zeros((B, n, self.dim))
+            for b, rng in enumerate(rngs):
+                # Sample edges
+                edges_b = rng.choice(self._spring_types, size=(n, n), p=spring_prob)
+                edges_b = np.tril(edges_b) + np.tril(edges_b, -1).T
+                np.fill_diagonal(edges_b, 0)
+                edges[b] = edges_b
+                # Initialize location and velocity (drawn as 3xN like a single system)
+                loc_next[b] = (rng.randn(self.dim, n) * self.loc_std).T
+                vel_next[b] = rng.randn(self.dim, n).T
+            v_norm = np.sqrt((vel_next ** 2).sum(axis=-1, keepdims=True))
+            vel_next = vel_next * self.vel_norm / v_norm
+            loc_next, vel_next = self._clamp(loc_next, vel_next)
+        else:
+            loc_next, vel_next, edges = (np.array(x, dtype=float) for x in state)
+
+        loc = np.zeros((B, T_save, self.dim, n))
+        vel = np.zeros((B, T_save, self.dim, n))
+        self.force_evals = 0
+
+        if self.integrator == 'leapfrog':
+            if state is None:
+                # half step leapfrog
+                vel_next += self._delta_T * self._forces(loc_next, edges)
+            # run leapfrog (a continued run is already at step T - 1 of the
+            # earlier call, which had T % sample_freq == 0)
+            for i in range(1, T) if state is None else range(T):
                 loc_next += self._delta_T * vel_next
-                #loc_next, vel_next = self._clamp(loc_next, vel_next)
 
                 if i % sample_freq == 0:
-                    loc[counter, :, :], vel[counter, :, :] = loc_next, vel_next
+                    loc[:, counter] = loc_next.transpose(0, 2, 1)
+                    vel[:, counter] = vel_next.transpose(0, 2, 1)
                     counter += 1
 
-                forces_size = - self.interaction_strength * edges
-                np.fill_diagonal(forces_size, 0)
-                # assert (np.abs(forces_size[diag_mask]).min() > 1e-10)
-
-                F = (forces_size.reshape(1, n, n) *
-                     np.concatenate((
-                         np.subtract.outer(loc_next[0, :],
-                                           loc_next[0, :]).reshape(1, n, n),
-                         np.subtract.outer(loc_next[1, :],
-                                           loc_next[1, :]).reshape(1, n, n),
-                         np.subtract.outer(loc_next[2, :],
-                                           loc_next[2, :]).reshape(1, n, n)
-                     ))).sum(
-                    axis=-1)
-                F[F > self._max_F] = self._max_F
-                F[F < -self._max_F] = -self._max_F
-                vel_next += self._delta_T * F
-            # Add noise to observations
-            loc += np.random.randn(T_save, self.dim, self.n_balls) * self.noise_var
-            vel += np.random.randn(T_save, self.dim, self.n_balls) * self.noise_var
-            return loc, vel, edges
+                vel_next += self._delta_T * self._forces(loc_next, edges)
+        else:
+            # same frame times, with positions and velocities in sync
+            frames = _splitting_frames(loc_next, vel_next, lambda x: self._forces(x, edges),
+                                       lambda x, v: self._ensemble_energy(x, v, edges),
+                                       sample_freq * self._delta_T, sample_freq, T_save,
+                                       self.integrator, self.energy_tol)
+            for counter, _ in enumerate(frames):
+                loc[:, counter] = loc_next.transpose(0, 2, 1)
+                vel[:, counter] = vel_next.transpose(0, 2, 1)
+        self.final_state = (loc_next, vel_next, edges)
+        # Add noise to observations
+        for b, rng in enumerate(rngs):
+            loc[b] += rng.randn(T_save, self.dim, n) * self.noise_var
+            vel[b] += rng.randn(T_save, self.dim, n) * self.noise_var
+        return loc, vel, edges
 
 
 class ChargedParticlesSim(object):
     def __init__(self, n_balls=5, box_size=5., loc_std=1., vel_norm=0.5,
-                 interaction_strength=1., noise_var=0.):
+                 interaction_strength=1., noise_var=0., force_backend='direct', theta=0.5,
+                 integrator='leapfrog', energy_tol=None, health_check=False, max_speed=None,
+                 max_energy_drift=None, check_every=1):
+        if integrator not in SPLITTING_SCHEMES and integrator != 'leapfrog':
+            raise ValueError('Integrator {} not implemented for charged particles'.format(integrator))
         self.n_balls = n_balls
         self.box_size = box_size
         self.loc_std = loc_std
@@ -158,6 +487,21 @@ class ChargedParticlesSim(object):
         self.interaction_strength = interaction_strength
         self.noise_var = noise_var
 
+        if force_backend not in FORCE_BACKENDS:
+            raise ValueError('Force backend {} not implemented'.format(force_backend))
+        self.force_backend = force_backend
+        self.theta = theta
+        self.integrator = integrator
+        self.energy_tol = energy_tol
+        self.force_evals = 0
+        # opt-in health check every check_every leapfrog steps (every frame for
+        # the other integrators), failed systems are aborted and flagged in unhealthy
+        self.health_check = health_check
+        self.max_speed = max_speed
+        self.max_energy_drift = max_energy_drift
+        self.check_every = check_every
+        self.unhealthy = None
+
         self._charge_types = np.array([-1., 0., 1.])
         self._delta_T = 0.001
         self._max_F = 0.1 / self._delta_T
@@ -177,20 +521,15 @@ class ChargedParticlesSim(object):
         return dist
 
     def _energy(self, loc, vel, edges):
+        # loc, vel: 3xN
+        return total_energy('charged', loc.T, vel.T, edges, self.interaction_strength)
 
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide='ignore'):
-
-            K = 0.5 * (vel ** 2).sum()
-            U = 0
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * self.interaction_strength * edges[
-                            i, j] / dist
-            return U + K
+    def _ensemble_energy(self, loc, vel, edges):
+        '''
+        :param loc: BxNx3 locations, vel: BxNx3 velocities, edges: BxNxN
+        :return: kinetic and potential energy of each system, both of shape B
+        '''
+        return kinetic_energy(vel), potential_energy('charged', loc, edges, self.interaction_strength)
 
     def _clamp(self, loc, vel):
         '''
@@ -217,87 +556,185 @@ class ChargedParticlesSim(object):
 
         return loc, vel
 
-    def sample_trajectory(self, T=10000, sample_freq=10,
-                          charge_prob=[1. / 2, 0, 1. / 2]):
-        n = self.n_balls
-        assert (T % sample_freq == 0)
-        T_save = int(T / sample_freq - 1)
-        diag_mask = np.ones((n, n), dtype=bool)
-        np.fill_diagonal(diag_mask, 0)
-        counter = 0
-        # Sample edges
-        charges = np.random.choice(self._charge_types, size=(self.n_balls, 1),
-                                   p=charge_prob)
-        edges = charges.dot(charges.transpose())
-        # Initialize location and velocity
-        loc = np.zeros((T_save, self.dim, n))
-        vel = np.zeros((T_save, self.dim, n))
-        loc_next = np.random.randn(self.dim, n) * self.loc_std
-        vel_next = np.random.randn(self.dim, n)
-        v_norm = np.sqrt((vel_next ** 2).sum(axis=0)).reshape(1, -1)
-        vel_next = vel_next * self.vel_norm / v_norm
-        loc[0, :, :], vel[0, :, :] = self._clamp(loc_next, vel_next)
-
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide='ignore'):
-            # half step leapfrog
-            l2_dist_power3 = np.power(
-                self._l2(loc_next.transpose(), loc_next.transpose()), 3. / 2.)
+    def _forces(self, loc, edges, charges, check=False):
+        '''
+        :param loc: BxNx3 locations of B systems at one time stamp
+        :param edges: BxNxN products of charges of each system
+        :param charges: BxNx1 charges of each system
+        :param check: assert that no pair of particles is non-interacting
+        :return: BxNx3 clamped forces
+        '''
+        self.force_evals += 1
+        if self.force_backend == 'barnes_hut':
+            # F_i = k q_i sum_j q_j (r_i - r_j) / |r_i - r_j|^3
+            F = - self.interaction_strength * charges * \
+                barnes_hut_field(loc, charges[..., 0], theta=self.theta)
+            F[F > self._max_F] = self._max_F
+            F[F < -self._max_F] = -self._max_F
+            return F
+
+        n = loc.shape[1]
+        diag = np.arange(n)
+        # disables division by zero warning, since I fix it on the diagonal
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = loc[:, :, None, :] - loc[:, None, :, :]  # BxNxNx3, r_i - r_j
+            l2_dist_power3 = np.power((r ** 2).sum(axis=-1), 3. / 2.)
 
             # size of forces up to a 1/|r| factor
             # since I later multiply by an unnormalized r vector
             forces_size = self.interaction_strength * edges / l2_dist_power3
-            np.fill_diagonal(forces_size,
-                             0)  # self forces are zero (fixes division by zero)
-            assert (np.abs(forces_size[diag_mask]).min() > 1e-10)
-            F = (forces_size.reshape(1, n, n) *
-                 np.concatenate((
-                     np.subtract.outer(loc_next[0, :],
-                                       loc_next[0, :]).reshape(1, n, n),
-                     np.subtract.outer(loc_next[1, :],
-                                       loc_next[1, :]).reshape(1, n, n),
-                     np.subtract.outer(loc_next[2, :],
-                                       loc_next[2, :]).reshape(1, n, n)))).sum(axis=-1)
-            F[F > self._max_F] = self._max_F
-            F[F < -self._max_F] = -self._max_F
+        # self forces are zero (fixes division by zero)
+        forces_size[:, diag, diag] = 0
+        if check:
+            off_diag = ~np.eye(n, dtype=bool)
+            assert (np.abs(forces_size[:, off_diag]).min() > 1e-10)
+        F = (forces_size[..., None] * r).sum(axis=2)
+        F[F > self._max_F] = self._max_F
+        F[F < -self._max_F] = -self._max_F
+        return F
+
+    def output_shapes(self, T=10000, sample_freq=10, continued=False):
+        '''
+        :param continued: shapes of a call continuing from a final_state
+        :return: shapes of loc, vel, edges, charges as returned by sample_trajectory
+        '''
+        T_save = int(T / sample_freq - (not continued))
+        n = self.n_balls
+        return [(T_save, self.dim, n), (T_save, self.dim, n), (n, n), (n, 1)]
 
-            vel_next += self._delta_T * F
-            # run leapfrog
-            for i in range(1, T):
+    def advance_frames(self, loc, vel, charges, n_frames, sample_freq=10):
+        '''
+        Continue B systems from one stored frame without noise.
+        :param loc, vel: BxNx3 frame, velocities half a step behind for leapfrog
+        :param charges: BxNx1
+        :return: loc, vel of the next n_frames stored frames, Bxn_framesx3xN
+        '''
+        if self.integrator != 'leapfrog':
+            # frames of the splitting schemes are the integrator state
+            return self.sample_trajectories(len(loc), T=n_frames * sample_freq, sample_freq=sample_freq,
+                                            state=(loc, vel, charges))[:2]
+        # the kick following the frame, then every step is stored and subsampled
+        edges = charges @ charges.transpose(0, 2, 1)
+        vel = vel + self._delta_T * self._forces(loc, edges, charges)
+        loc, vel, _, _ = self.sample_trajectories(len(loc), T=n_frames * sample_freq, sample_freq=1,
+                                                  state=(loc, vel, charges))
+        return loc[:, sample_freq - 1::sample_freq], vel[:, sample_freq - 1::sample_freq]
+
+    def sample_trajectory(self, T=10000, sample_freq=10,
+                          charge_prob=[1. / 2, 0, 1. / 2], rng=None):
+        loc, vel, edges, charges = self.sample_trajectories(
+            1, T=T, sample_freq=sample_freq, charge_prob=charge_prob,
+            rngs=None if rng is None else [rng])
+        return loc[0], vel[0], edges[0], charges[0]
+
+    def sample_trajectories(self, B, T=10000, sample_freq=10,
+                            charge_prob=[1. / 2, 0, 1. / 2], rngs=None, state=None):
+        '''
+        Integrate an ensemble of B independent systems in lockstep.
+        :param B: number of systems
+        :param rngs: optional list of B random streams, one per system
+        :param state: final_state (loc, vel, charges) of an earlier call, which
+            is then continued by T more steps (T / sample_freq new frames)
+        :return: loc, vel of shape BxT_savex3xN, edges BxNxN and charges BxNx1,
+            i.e. the outputs of sample_trajectory stacked along axis 0. With
+            health_check, self.unhealthy masks the aborted systems, whose
+            outputs are incomplete. The integrator state at the end is left
+            in self.final_state (NaN for aborted systems).
+        '''
+        n = self.n_balls
+        assert (T % sample_freq == 0)
+        T_save = int(T / sample_freq - (state is None))
+        rngs = _system_rngs(B, rngs)
+        counter = 0
+        if state is None:
+            charges = np.zeros((B, n, 1))
+            loc_next = np.zeros((B, n, self.dim))
+            vel_next = np.zeros((B, n, self.dim))
+            for b, rng in enumerate(rngs):
+                # Sample edges
+                charges[b] = rng.choice(self._charge_types, size=(n, 1),
+                                        p=charge_prob)
+                # Initialize location and velocity (drawn as 3xN like a single system)
+                loc_next[b] = (rng.randn(self.dim, n) * self.loc_std).T
+                vel_next[b] = rng.randn(self.dim, n).T
+            edges = charges @ charges.transpose(0, 2, 1)
+            v_norm = np.sqrt((vel_next ** 2).sum(axis=-1, keepdims=True))
+            vel_next = vel_next * self.vel_norm / v_norm
+            loc_next, vel_next = self._clamp(loc_next, vel_next)
+        else:
+            loc_next, vel_next, charges = (np.array(x, dtype=float) for x in state)
+            edges = charges @ charges.transpose(0, 2, 1)
+
+        loc = np.zeros((B, T_save, self.dim, n))
+        vel = np.zeros((B, T_save, self.dim, n))
+        self.force_evals = 0
+        self.unhealthy = np.zeros(B, dtype=bool)
+        E0 = self._ensemble_energy(loc_next, vel_next, edges) if self.health_check else None
+
+        if self.integrator == 'leapfrog':
+            # systems still running, with their own view of edges and charges
+            alive, edges_a, charges_a = np.arange(B), edges, charges
+            if state is None:
+                # half step leapfrog
+                vel_next += self._delta_T * self._forces(loc_next, edges, charges, check=True)
+            # run leapfrog (a continued run is already at step T - 1 of the
+            # earlier call, with half step velocities)
+            for i in range(1, T) if state is None else range(T):
                 loc_next += self._delta_T * vel_next
-                #loc_next, vel_next = self._clamp(loc_next, vel_next)
 
                 if i % sample_freq == 0:
-                    loc[counter, :, :], vel[counter, :, :] = loc_next, vel_next
+                    loc[alive, counter] = loc_next.transpose(0, 2, 1)
+                    vel[alive, counter] = vel_next.transpose(0, 2, 1)
                     counter += 1
 
-                l2_dist_power3 = np.power(
-                    self._l2(loc_next.transpose(), loc_next.transpose()),
-                    3. / 2.)
-                forces_size = self.interaction_strength * edges / l2_dist_power3
-                np.fill_diagonal(forces_size, 0)
-                # assert (np.abs(forces_size[diag_mask]).min() > 1e-10)
-
-                F = (forces_size.reshape(1, n, n) *
-                     np.concatenate((
-                         np.subtract.outer(loc_next[0, :],
-                                           loc_next[0, :]).reshape(1, n, n),
-                         np.subtract.outer(loc_next[1, :],
-                                           loc_next[1, :]).reshape(1, n, n),
-                         np.subtract.outer(loc_next[2, :],
-                                           loc_next[2, :]).reshape(1, n, n)
-                     ))).sum(axis=-1)
-                F[F > self._max_F] = self._max_F
-                F[F < -self._max_F] = -self._max_F
-                vel_next += self._delta_T * F
-            # Add noise to observations
-            loc += np.random.randn(T_save, self.dim, self.n_balls) * self.noise_var
-            vel += np.random.randn(T_save, self.dim, self.n_balls) * self.noise_var
-            return loc, vel, edges, charges
+                vel_next += self._delta_T * self._forces(loc_next, edges_a, charges_a)
+
+                if self.health_check and i % self.check_every == 0:
+                    bad = _unhealthy(loc_next, vel_next, self.max_speed, self.max_energy_drift,
+                                     lambda x, v: self._ensemble_energy(x, v, edges_a), E0)
+                    if bad.any():
+                        # abort the failed systems, the others carry on alone
+                        self.unhealthy[alive[bad]] = True
+                        keep = ~bad
+                        alive, edges_a, charges_a = alive[keep], edges_a[keep], charges_a[keep]
+                        loc_next, vel_next = loc_next[keep], vel_next[keep]
+                        E0 = (E0[0][keep], E0[1][keep])
+                        if len(alive) == 0:
+                            break
+            loc_end = np.full((B, n, self.dim), np.nan)
+            vel_end = np.full((B, n, self.dim), np.nan)
+            loc_end[alive], vel_end[alive] = loc_next, vel_next
+            loc_next, vel_next = loc_end, vel_end
+        else:
+            # same frame times, with positions and velocities in sync
+            frames = _splitting_frames(loc_next, vel_next, lambda x: self._forces(x, edges, charges),
+                                       lambda x, v: self._ensemble_energy(x, v, edges),
+                                       sample_freq * self._delta_T, sample_freq, T_save,
+                                       self.integrator, self.energy_tol)
+            for counter, _ in enumerate(frames):
+                loc[:, counter] = loc_next.transpose(0, 2, 1)
+                vel[:, counter] = vel_next.transpose(0, 2, 1)
+                if self.health_check:
+                    self.unhealthy |= _unhealthy(loc_next, vel_next, self.max_speed, self.max_energy_drift,
+                                                 lambda x, v: self._ensemble_energy(x, v, edges), E0)
+                    if self.unhealthy.all():
+                        break
+        self.final_state = (loc_next, vel_next, charges)
+        # Add noise to observations
+        for b, rng in enumerate(rngs):
+            loc[b] += rng.randn(T_save, self.dim, n) * self.noise_var
+            vel[b] += rng.randn(T_save, self.dim, n) * self.noise_var
+        return loc, vel, edges, charges
 
 
 class GravitySim(object):
-    def __init__(self, n_balls=100, loc_std=1, vel_norm=0.5, interaction_strength=1, noise_var=0, dt=0.001, softening=0.1):
+    def __init__(self, n_balls=100, loc_std=1, vel_norm=0.5, interaction_strength=1, noise_var=0, dt=0.001, softening=0.1,
+                 force_backend='direct', theta=0.5, integrator='leapfrog', energy_tol=None, eta=0.05, max_rung=12,
+                 health_check=False, max_speed=None, max_energy_drift=None, check_every=1):
+        if force_backend not in FORCE_BACKENDS:
+            raise ValueError('Force backend {} not implemented'.format(force_backend))
+        if integrator not in INTEGRATORS:
+            raise ValueError('Integrator {} not implemented'.format(integrator))
         self.n_balls = n_balls
         self.loc_std = loc_std
         self.vel_norm = vel_norm
@@ -305,105 +742,282 @@ class GravitySim(object):
         self.noise_var = noise_var
         self.dt = dt
         self.softening = softening
+        self.force_backend = force_backend
+        self.theta = theta
+        self.integrator = integrator
+        self.energy_tol = energy_tol
+        # block_kdk: timestep criterion dt_i <= eta * sqrt(softening / |a_i|),
+        # with steps of frame_dt / 2**rung for rung in 0..max_rung
+        self.eta = eta
+        self.max_rung = max_rung
+        self.force_evals = 0
+        # opt-in health check every check_every leapfrog steps (every frame for
+        # the other integrators), failed systems are aborted and flagged in unhealthy
+        self.health_check = health_check
+        self.max_speed = max_speed
+        self.max_energy_drift = max_energy_drift
+        self.check_every = check_every
+        self.unhealthy = None
 
         self.dim = 3
 
     def compute_acceleration(self, pos, mass, G, softening):
-        # positions r = [x,y,z] for all particles
-        x = pos[:, 0:1]
-        y = pos[:, 1:2]
-        z = pos[:, 2:3]
+        # positions r = [x,y,z] for all particles, optionally with leading
+        # ensemble dimensions: pos (..., N, 3), mass (..., N, 1)
+        self.force_evals += 1
+        if self.force_backend == 'barnes_hut':
+            return G * barnes_hut_field(pos, mass[..., 0], theta=self.theta, softening=softening)
 
-        # matrix that stores all pairwise particle separations: r_j - r_i
-        dx = x.T - x
-        dy = y.T - y
-        dz = z.T - z
+        # tensor that stores all pairwise particle separations: r_j - r_i
+        dr = pos[..., None, :, :] - pos[..., :, None, :]  # (..., N, N, 3)
 
         # matrix that stores 1/r^3 for all particle pairwise particle separations
-        inv_r3 = (dx**2 + dy**2 + dz**2 + softening**2)
+        inv_r3 = (dr**2).sum(axis=-1) + softening**2
         inv_r3[inv_r3 > 0] = inv_r3[inv_r3 > 0]**(-1.5)
 
-        ax = G * (dx * inv_r3) @ mass
-        ay = G * (dy * inv_r3) @ mass
-        az = G * (dz * inv_r3) @ mass
-
-        # pack together the acceleration components
-        a = np.hstack((ax, ay, az))
+        # sum over j of G * (r_j - r_i) / r^3 * m_j
+        a = G * (dr * (inv_r3[..., None] * mass[..., None, :, :])).sum(axis=-2)
         return a
 
     def _energy(self, pos, vel, mass, G):
-        # Kinetic Energy:
-        KE = 0.5 * np.sum(np.sum(mass * vel**2))
+        # pos, vel: Nx3, mass: Nx1
+        KE = kinetic_energy(vel, mass)
+        PE = potential_energy('gravity', pos, mass, G)
+        return KE, PE, KE+PE
+
+    def _ensemble_energy(self, pos, vel, mass):
+        '''
+        :param pos: BxNx3 positions, vel: BxNx3 velocities, mass: BxNx1
+        :return: kinetic and (softened) potential energy of each system, both of shape B
+        '''
+        return kinetic_energy(vel, mass), potential_energy('gravity', pos, mass, self.interaction_strength, self.softening)
 
-        # Potential Energy:
+    def _partial_acceleration(self, pos, mass, active):
+        """
+        Accelerations of the active particles only, at cost O(M N) for M of them.
+        :param active: BxN boolean mask
+        :return: Mx3 accelerations, in the order of np.nonzero(active)
+        """
+        if self.force_backend == 'barnes_hut':
+            return self.compute_acceleration(pos, mass, self.interaction_strength, self.softening)[active]
+        b, i = np.nonzero(active)
+        self.force_evals += len(b) / active.size
+        dr = pos[b] - pos[b, i][:, None, :]  # (M, N, 3)
+        inv_r3 = (dr**2).sum(axis=-1) + self.softening**2
+        inv_r3[inv_r3 > 0] = inv_r3[inv_r3 > 0]**(-1.5)
+        return self.interaction_strength * (dr * (inv_r3[..., None] * mass[b])).sum(axis=-2)
 
-        # positions r = [x,y,z] for all particles
-        x = pos[:, 0:1]
-        y = pos[:, 1:2]
-        z = pos[:, 2:3]
+    def _block_rungs(self, acc, frame_dt, eta, min_rung):
+        # finest power of two subdivision of the frame satisfying the timestep criterion
+        a_norm = np.fmax(np.linalg.norm(acc, axis=-1), 1e-300)
+        dt = eta * np.sqrt(self.softening / a_norm)
+        rung = np.ceil(np.log2(np.maximum(frame_dt / dt, 1.)))
+        return np.clip(rung, min_rung, self.max_rung).astype(int)
 
-        # matrix that stores all pairwise particle separations: r_j - r_i
-        dx = x.T - x
-        dy = y.T - y
-        dz = z.T - z
+    def _block_kdk_frames(self, pos, vel, mass, acc, frame_dt, n_frames, eta):
+        """
+        Advance pos, vel, acc in place with block timestep kick-drift-kick, yielding
+        after each of the n_frames frames. Every particle steps with frame_dt / 2**rung;
+        only the particles ending a step get new forces, the others just drift. Rungs
+        may get finer at any step boundary but coarser only where the coarser step is
+        aligned, so all particles are synchronized at the end of each frame.
+        """
+        K = self.max_rung
+        ticks = 2 ** K
+        tick_dt = frame_dt / ticks
+        for _ in range(n_frames):
+            rung = self._block_rungs(acc, frame_dt, eta, 0)
+            # opening half kicks, step ends in units of ticks
+            vel += 0.5 * acc * (frame_dt / 2. ** rung)[..., None]
+            t, t_end = 0, 2 ** (K - rung)
+            while t < ticks:
+                t_next = int(t_end.min())
+                pos += (t_next - t) * tick_dt * vel
+                t = t_next
+                active = t_end == t
+                a = self._partial_acceleration(pos, mass, active)
+                acc[active] = a
+                # closing half kick of the finished step
+                vel[active] += 0.5 * a * (frame_dt / 2. ** rung[active])[:, None]
+                if t == ticks:
+                    break
+                # opening half kick of the next one
+                min_rung = K - ((t & -t).bit_length() - 1)
+                rung[active] = self._block_rungs(a, frame_dt, eta, min_rung)
+                vel[active] += 0.5 * a * (frame_dt / 2. ** rung[active])[:, None]
+                t_end[active] = t + 2 ** (K - rung[active])
+            yield acc
+
+    def _block_kdk_eta(self, pos, vel, mass, acc, frame_dt, calib_frames=5):
+        """
+        The timestep parameter eta without an energy target, otherwise the largest
+        eta / 2**level whose pilot run keeps the relative energy error below it.
+        """
+        if self.energy_tol is None:
+            return self.eta
 
-        # matrix that stores 1/r for all particle pairwise particle separations
-        inv_r = np.sqrt(dx**2 + dy**2 + dz**2)
-        inv_r[inv_r > 0] = 1.0/inv_r[inv_r > 0]
+        def pilot(level):
+            pos_p, vel_p, acc_p = pos.copy(), vel.copy(), acc.copy()
+            E0 = self._ensemble_energy(pos_p, vel_p, mass)
+            error = 0.
+            for _ in self._block_kdk_frames(pos_p, vel_p, mass, acc_p, frame_dt, calib_frames,
+                                            self.eta / 2 ** level):
+                error = max(error, _relative_energy_error(self._ensemble_energy(pos_p, vel_p, mass), E0))
+            return error
 
-        # sum over upper triangle, to count each interaction only once
-        PE = G * np.sum(np.sum(np.triu(-(mass*mass.T)*inv_r, 1)))
+        return self.eta / 2 ** _calibrate_level(pilot, self.energy_tol)
 
-        return KE, PE, KE+PE
+    def output_shapes(self, T=10000, sample_freq=10, continued=False):
+        """
+        :param continued: shapes of a call continuing from a final_state (the same here)
+        :return: shapes of pos, vel, force, mass as returned by sample_trajectory
+        """
+        T_save = int(T/sample_freq)
+        N = self.n_balls
+        return [(T_save, N, self.dim), (T_save, N, self.dim), (T_save, N, self.dim), (N, 1)]
 
-    def sample_trajectory(self, T=10000, sample_freq=10):
+    def advance_frames(self, pos, vel, mass, n_frames, sample_freq=10):
+        """
+        Continue B systems from one stored frame without noise.
+        :param pos, vel: BxNx3 frame, mass: BxNx1
+        :return: pos, vel of the next n_frames stored frames, Bxn_framesxNx3
+        """
+        pos_save, vel_save, _, _ = self.sample_trajectories(len(pos), T=n_frames * sample_freq,
+                                                            sample_freq=sample_freq, state=(pos, vel, mass))
+        if self.integrator != 'leapfrog':
+            return pos_save, vel_save
+        # leapfrog stores the state before stepping, so the frame itself comes first
+        end_pos, end_vel, _ = self.final_state
+        return (np.concatenate([pos_save[:, 1:], end_pos[:, None]], axis=1),
+                np.concatenate([vel_save[:, 1:], end_vel[:, None]], axis=1))
+
+    def sample_trajectory(self, T=10000, sample_freq=10, rng=None):
+        pos_save, vel_save, force_save, mass = self.sample_trajectories(
+            1, T=T, sample_freq=sample_freq,
+            rngs=None if rng is None else [rng])
+        return pos_save[0], vel_save[0], force_save[0], mass[0]
+
+    def sample_trajectories(self, B, T=10000, sample_freq=10, rngs=None, state=None):
+        """
+        Integrate an ensemble of B independent systems in lockstep.
+        :param B: number of systems
+        :param rngs: optional list of B random streams, one per system
+        :param state: final_state (pos, vel, mass) of an earlier call, which is
+            then continued by T more steps (T / sample_freq new frames)
+        :return: pos, vel, force of shape BxT_savexNx3 and mass BxNx1,
+            i.e. the outputs of sample_trajectory stacked along axis 0. With
+            health_check, self.unhealthy masks the aborted systems, whose
+            outputs are incomplete. The integrator state at the end is left
+            in self.final_state (NaN for aborted systems).
+        """
         assert (T % sample_freq == 0)
 
         T_save = int(T/sample_freq)
 
         N = self.n_balls
-
-        pos_save = np.zeros((T_save, N, self.dim))
-        vel_save = np.zeros((T_save, N, self.dim))
-        force_save = np.zeros((T_save, N, self.dim))
-
-        # Specific sim parameters
-        mass = np.ones((N, 1)) * np.random.randn(N, 1) * 0.1
+        rngs = _system_rngs(B, rngs)
+
+        pos_save = np.zeros((B, T_save, N, self.dim))
+        vel_save = np.zeros((B, T_save, N, self.dim))
+        force_save = np.zeros((B, T_save, N, self.dim))
+
+        if state is None:
+            # Specific sim parameters, drawn per system
+            mass = np.zeros((B, N, 1))
+            pos = np.zeros((B, N, self.dim))
+            vel = np.zeros((B, N, self.dim))
+            for b, rng in enumerate(rngs):
+                mass[b] = np.ones((N, 1)) * rng.randn(N, 1) * 0.1
+                pos[b] = rng.randn(N, self.dim)   # randomly selected positions and velocities
+                vel[b] = rng.randn(N, self.dim)
+
+            # Convert to Center-of-Mass frame
+            vel -= np.mean(mass * vel, axis=1, keepdims=True) / np.mean(mass, axis=1, keepdims=True)
+        else:
+            # positions and velocities in sync at step T of the earlier call
+            pos, vel, mass = (np.array(x, dtype=float) for x in state)
         t = 0
-        pos = np.random.randn(N, self.dim)   # randomly selected positions and velocities
-        vel = np.random.randn(N, self.dim)
-
-        # Convert to Center-of-Mass frame
-        vel -= np.mean(mass * vel, 0) / np.mean(mass)
 
         # calculate initial gravitational accelerations
+        self.force_evals = 0
         acc = self.compute_acceleration(pos, mass, self.interaction_strength, self.softening)
+        self.unhealthy = np.zeros(B, dtype=bool)
+        E0 = self._ensemble_energy(pos, vel, mass) if self.health_check else None
 
-        for i in range(T):
-            if i % sample_freq == 0:
-                pos_save[int(i/sample_freq)] = pos
-                vel_save[int(i/sample_freq)] = vel
-                force_save[int(i/sample_freq)] = acc*mass
-
-            # (1/2) kick
-            vel += acc * self.dt/2.0
-
-            # drift
-            pos += vel * self.dt
-
-            # update accelerations
-            acc = self.compute_acceleration(pos, mass, self.interaction_strength, self.softening)
-
-            # (1/2) kick
-            vel += acc * self.dt/2.0
-
-            # update time
-            t += self.dt
+        if self.integrator == 'leapfrog':
+            # systems still running, with their own view of the masses
+            alive, mass_a = np.arange(B), mass
+            for i in range(T):
+                if i % sample_freq == 0:
+                    pos_save[alive, int(i/sample_freq)] = pos
+                    vel_save[alive, int(i/sample_freq)] = vel
+                    force_save[alive, int(i/sample_freq)] = acc*mass_a
+
+                # (1/2) kick
+                vel += acc * self.dt/2.0
+
+                # drift
+                pos += vel * self.dt
+
+                # update accelerations
+                acc = self.compute_acceleration(pos, mass_a, self.interaction_strength, self.softening)
+
+                # (1/2) kick
+                vel += acc * self.dt/2.0
+
+                # update time
+                t += self.dt
+
+                if self.health_check and (i + 1) % self.check_every == 0:
+                    bad = _unhealthy(pos, vel, self.max_speed, self.max_energy_drift,
+                                     lambda x, v: self._ensemble_energy(x, v, mass_a), E0)
+                    if bad.any():
+                        # abort the failed systems, the others carry on alone
+                        self.unhealthy[alive[bad]] = True
+                        keep = ~bad
+                        alive, mass_a = alive[keep], mass_a[keep]
+                        pos, vel, acc = pos[keep], vel[keep], acc[keep]
+                        E0 = (E0[0][keep], E0[1][keep])
+                        if len(alive) == 0:
+                            break
+            pos_end = np.full((B, N, self.dim), np.nan)
+            vel_end = np.full((B, N, self.dim), np.nan)
+            pos_end[alive], vel_end[alive] = pos, vel
+            pos, vel = pos_end, vel_end
+        else:
+            # the initial state is the first frame, unless it is the last
+            # frame of the continued call
+            first = int(state is None)
+            if state is None:
+                pos_save[:, 0] = pos
+                vel_save[:, 0] = vel
+                force_save[:, 0] = acc*mass
+            frame_dt = sample_freq * self.dt
+            if self.integrator == 'block_kdk':
+                eta = self._block_kdk_eta(pos, vel, mass, acc, frame_dt)
+                frames = self._block_kdk_frames(pos, vel, mass, acc, frame_dt, T_save - first, eta)
+            else:
+                accel = lambda x: self.compute_acceleration(x, mass, self.interaction_strength, self.softening)
+                frames = _splitting_frames(pos, vel, accel, lambda x, v: self._ensemble_energy(x, v, mass),
+                                           frame_dt, sample_freq, T_save - first, self.integrator, self.energy_tol)
+            for counter, a in enumerate(frames, first):
+                if a is None:
+                    a = self.compute_acceleration(pos, mass, self.interaction_strength, self.softening)
+                pos_save[:, counter] = pos
+                vel_save[:, counter] = vel
+                force_save[:, counter] = a*mass
+                if self.health_check:
+                    self.unhealthy |= _unhealthy(pos, vel, self.max_speed, self.max_energy_drift,
+                                                 lambda x, v: self._ensemble_energy(x, v, mass), E0)
+                    if self.unhealthy.all():
+                        break
+        self.final_state = (pos, vel, mass)
 
         # Add noise to observations
-        pos_save += np.random.randn(T_save, N, self.dim) * self.noise_var
-        vel_save += np.random.randn(T_save, N, self.dim) * self.noise_var
-        force_save += np.random.randn(T_save, N, self.dim) * self.noise_var
+        for b, rng in enumerate(rngs):
+            pos_save[b] += rng.randn(T_save, N, self.dim) * self.noise_var
+            vel_save[b] += rng.randn(T_save, N, self.dim) * self.noise_var
+            force_save[b] += rng.randn(T_save, N, self.dim) * self.noise_var
         return pos_save, vel_save, force_save, mass
 
 
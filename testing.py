@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from energy import kinetic_energy, potential_energy, total_energy
 
 def repeat_elements_to_exact_shape(tensor_list, n):
     L = len(tensor_list)                    # Number of elements in the list
@@ -55,43 +56,12 @@ def tot_energy_charged(loc, vel, edges, interaction_strength=.1):
         - vel: np.array of shape (T, 3, N)
         - edges: np.array of shape (N, N) with interaction strengths
         """
-        with np.errstate(divide='ignore'):
-            K = 0.5 * (vel ** 2).sum()
-
-            diff = loc[:, :, :, None] - loc[:, :, None, :]  # shape (T, 3, N, N)
-            dist_sq = np.sum(diff ** 2, axis=1)             # shape (T, N, N)
-            U = 0
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * interaction_strength * edges[
-                            i, j] * (dist ** 2) / 2
-            return U + K
+        return total_energy('springs', np.swapaxes(loc, -1, -2), np.swapaxes(vel, -1, -2), edges, interaction_strength)
 
 def tot_energy_gravity(pos, vel, mass, G=1.0):
-        # Kinetic Energy:
-        KE = 0.5 * np.sum(np.sum(mass * vel**2))
-
-        # Potential Energy:
-
-        # positions r = [x,y,z] for all particles
-        x = pos[:, 0:1]
-        y = pos[:, 1:2]
-        z = pos[:, 2:3]
-
-        # matrix that stores all pairwise particle separations: r_j - r_i
-        dx = x.T - x
-        dy = y.T - y
-        dz = z.T - z
-
-        # matrix that stores 1/r for all particle pairwise particle separations
-        inv_r = np.sqrt(dx**2 + dy**2 + dz**2)
-        inv_r[inv_r > 0] = 1.0/inv_r[inv_r > 0]
-
-        # sum over upper triangle, to count each interaction only once
-        PE = G * np.sum(np.sum(np.triu(-(mass*mass.T)*inv_r, 1)))
+        # pos, vel: np.array of shape (..., N, 3), mass: np.array of shape (..., N, 1)
+        KE = kinetic_energy(vel, mass)
+        PE = potential_energy('gravity', pos, mass, G)
 
         return KE, PE, KE+PE
 
@@ -100,40 +70,30 @@ def compute_energy_drift(loc, vel, edges, kind='charged'):
     Compute relative energy drift at each timestep from a trajectory.
     
     Parameters:
-    - loc: np.array of shape (T, 3, N)
-    - vel: np.array of shape (T, 3, N)
+    - loc: np.array of shape (..., T, 3, N)
+    - vel: np.array of shape (..., T, 3, N)
     - edges: np.array of shape (N, N)
     
     Returns:
-    - energy_drift: np.array of shape (T,)
+    - energy_drift: np.array of shape (..., T)
     """
-    T = loc.shape[0]
-    energy_drift = np.zeros(T)
-
-    energy_fun = tot_energy_charged if kind == 'charged' else tot_energy_gravity
+    if kind == 'charged':
+        energy = tot_energy_charged(loc, vel, edges)
+    else:
+        energy = tot_energy_gravity(np.swapaxes(loc, -1, -2), np.swapaxes(vel, -1, -2), edges)[-1]
 
     # Initial energy
-    E0 = energy_fun(loc[0], vel[0], edges)
-
-    for t in range(T):
-        Et = energy_fun(loc[t], vel[t], edges)
-        energy_drift[t] = np.abs((Et - E0) / (E0 + 1e-10))  # epsilon for stability
-
-    return energy_drift
+    E0 = energy[..., :1]
+    return np.abs((energy - E0) / (E0 + 1e-10))  # epsilon for stability
 
 def compute_energy_drift_batch(loc, vel, edges):
-    all_energy_drifts = []
-
-    for i in range(loc.shape[0]):
-        loc_i = reshape_sample(loc[i])
-        vel_i = reshape_sample(vel[i])
-        drift = compute_energy_drift(loc_i, vel_i, edges)
-        all_energy_drifts.append(drift)
-
-    # Optionally convert to np.array: shape (num_samples, T)
-    all_energy_drifts = np.stack(all_energy_drifts)
+    # loc, vel: np.array of shape (num_samples, T, N*3), all samples at once
+    S, T = loc.shape[:2]
+    loc = loc.reshape(S, T, -1, 3).swapaxes(-1, -2)
+    vel = vel.reshape(S, T, -1, 3).swapaxes(-1, -2)
 
-    return all_energy_drifts
+    # shape (num_samples, T)
+    return compute_energy_drift(loc, vel, edges)
 
 if __name__ == "__main__":
     charges = np.random.choice([-1,0,1], size=(3, 1),
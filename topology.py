@@ -0,0 +1,69 @@
+import torch
+
+"""
+Batched graph topologies, built once per (n_nodes, batch_size, T, device) directly on
+the device and reused across batches, epochs and rollout steps: the edge indices of
+batch_size fully connected graphs, their copies for the T output timesteps of EGNO, and
+the node-to-graph assignment that SEGNO passes to knn_graph.
+"""
+
+
+class TopologyCache:
+
+    def __init__(self):
+        self._cache = {}
+        # id of the cached edge tensors -> (n_nodes, batch_size, device) they were built for;
+        # cached tensors are never freed, so their ids are never reused
+        self._origin = {}
+
+    def _get(self, key, build):
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    def edges(self, n_nodes, batch_size, device='cpu'):
+        '''
+        :return: [rows, cols] of batch_size fully connected graphs of n_nodes nodes without
+            self loops, row-major within a graph and the nodes of graph b offset by b * n_nodes
+        '''
+        device = str(device)
+
+        def build():
+            i, j = torch.nonzero(~torch.eye(n_nodes, dtype=torch.bool), as_tuple=True)
+            offsets = torch.arange(batch_size).repeat_interleave(len(i)) * n_nodes
+            rows = (i.repeat(batch_size) + offsets).to(device)
+            cols = (j.repeat(batch_size) + offsets).to(device)
+            self._origin[id(rows)] = (n_nodes, batch_size, device)
+            return rows, cols
+
+        return list(self._get(('edges', n_nodes, batch_size, 1, device), build))
+
+    def expand(self, edge_index, num_nodes, T):
+        '''
+        :param edge_index: [rows, cols] of a graph of num_nodes nodes
+        :return: [rows, cols] of T copies of the graph, the nodes of copy t offset by t * num_nodes.
+            Cached if edge_index comes from edges(), built on every call otherwise.
+        '''
+        rows, cols = edge_index
+
+        def build():
+            offsets = (torch.arange(T, device=rows.device) * num_nodes).repeat_interleave(len(rows))
+            return rows.repeat(T) + offsets, cols.repeat(T) + offsets
+
+        origin = self._origin.get(id(rows))
+        if origin is None or origin[0] * origin[1] != num_nodes:
+            return list(build())
+        n_nodes, batch_size, device = origin
+        return list(self._get(('expanded', n_nodes, batch_size, T, device), build))
+
+    def batch(self, n_nodes, batch_size, device='cpu'):
+        '''
+        :return: graph of every node of batch_size graphs of n_nodes nodes
+        '''
+        device = str(device)
+        return self._get(('batch', n_nodes, batch_size, 1, device),
+                         lambda: torch.arange(batch_size, device=device).repeat_interleave(n_nodes))
+
+
+# shared by the EGNO and SEGNO stacks
+topology = TopologyCache()
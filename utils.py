@@ -1,5 +1,12 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
 import numpy as np
-from torch_geometric.utils import to_dense_batch
+import torch
+from energy import total_energy, energy_drift
 
 def reshape_sample(sample):
     """
@@ -12,131 +19,241 @@ def reshape_sample(sample):
     return sample
 
 def tot_energy_spring(loc, vel, edges, interaction_strength=.1):
-        with np.errstate(divide='ignore'):
-            K = 0.5 * (vel ** 2).sum()
-            U = 0
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * interaction_strength * edges[
-                            i, j] * (dist ** 2) / 2
-            return U + K
+    """
+    loc: np.array of shape (..., 3, N)
+    vel: np.array of shape (..., 3, N)
+    edges: np.array of shape (N, N) with interaction strengths
+    """
+    return total_energy('springs', np.swapaxes(loc, -1, -2), np.swapaxes(vel, -1, -2), edges, interaction_strength)
 
 
 def tot_energy_charged(loc, vel, edges, interaction_strength=1):
     """
-    loc: np.array of shape (3, N)
-    vel: np.array of shape (3, N)
+    loc: np.array of shape (..., 3, N)
+    vel: np.array of shape (..., 3, N)
     edges: np.array of shape (N, N) with interaction strengths
     """
-    # disables division by zero warning, since I fix it with fill_diagonal
-    with np.errstate(divide='ignore'):
-
-        # K = 0.5 * (vel ** 2).sum()
-        K = (0.5 * np.linalg.norm(vel, axis=1)**2).sum()
-        U = 0
-        for i in range(loc.shape[1]):
-            for j in range(loc.shape[1]):
-                if i != j:
-                    r = loc[:, i] - loc[:, j]
-                    # dist = np.sqrt((r ** 2).sum())
-                    # if overflow occurs, return np.inf
-                    dist = np.linalg.norm(r)
-                    U += 0.5 * interaction_strength * edges[
-                        i, j] / dist
-        return U + K
+    return total_energy('charged', np.swapaxes(loc, -1, -2), np.swapaxes(vel, -1, -2), edges, interaction_strength)
 
 
-def tot_energy_charged_batch(loc, vel, edges, interaction_strength=1):
+def tot_energy_charged_batch(loc, vel, edges, interaction_strength=1, memory_budget=None):
     """
     loc, vel: np.array of shape (T, N, 3)
     edges: np.array of shape (N, N) with interaction strengths
+    memory_budget: bytes of temporaries for a blocked evaluation, bounded whatever T and N
     """
     assert loc.shape[-1] == 3, "loc must have shape (T, N, 3)"
-    K = 0.5 * np.sum(np.sum(vel**2, axis=-1), axis=-1)  # (T,)
-
-    # calculate pairwise distances on the last dimension
-    dist = loc[:, :, np.newaxis, :] - loc[:, np.newaxis, :, :]  # (T, N, N, 3)
-    dist = np.linalg.norm(dist, axis=-1)  # (T, N, N)
-    dist = np.where(dist == 0, np.inf, dist)  # avoid division by zero
-    
-    U = 0.5 * interaction_strength * np.sum(np.expand_dims(edges, axis=0) / dist, axis=(-1, -2)).view()  # (T,)
-    return K + U.squeeze()
+    return total_energy('charged', loc, vel, edges, interaction_strength, memory_budget=memory_budget)
 
 
 def tot_energy_gravity(pos, vel, mass, G=1.0):
-    assert pos.shape[1] == 3, "Position must have shape (N, 3)"
-    # Kinetic Energy:
     # pos, vel: np.array of shape (N, 3)
     # mass: np.array of shape (N, 1)
+    assert pos.shape[1] == 3, "Position must have shape (N, 3)"
+    return total_energy('gravity', pos, vel, mass, G)
 
-    KE = 0.5 * np.sum(np.sum(mass * vel**2))
-
-    # Potential Energy:
-
-    # positions r = [x,y,z] for all particles
-    x = pos[:, 0:1]
-    y = pos[:, 1:2]
-    z = pos[:, 2:3]
-
-    # matrix that stores all pairwise particle separations: r_j - r_i
-    dx = x.T - x
-    dy = y.T - y
-    dz = z.T - z
-
-    # matrix that stores 1/r for all particle pairwise particle separations
-    inv_r = np.sqrt(dx**2 + dy**2 + dz**2)
-    inv_r[inv_r > 0] = 1.0/inv_r[inv_r > 0]
-
-    # sum over upper triangle, to count each interaction only once
-    PE = G * np.sum(np.sum(np.triu(-(mass*mass.T)*inv_r, 1)))
-    return KE+PE
-
-def tot_energy_gravity_batch(loc, vel, mass, G=1.0):
+def tot_energy_gravity_batch(loc, vel, mass, G=1.0, memory_budget=None):
     # pos, vel: np.array of shape (T, N, 3) 
     # mass: np.array of shape (T, N, 1)
-
+    # memory_budget: bytes of temporaries for a blocked evaluation, bounded whatever T and N
     assert loc.shape[-1] == 3, "Position must have shape (T, N, 3)"
-    KE = np.squeeze(0.5 * np.sum(np.sum(mass * vel**2, axis=-1), axis=-1))  # (T,)
-
-    # Potential Energy:
-    # positions r = [x,y,z] for all particles
-    x = loc[:, :, 0:1]  # (T, N, 1)
-    y = loc[:, :, 1:2]  # (T, N, 1)
-    z = loc[:, :, 2:3]  # (T, N, 1)
-
-    dx = x.transpose(0, 2, 1) - x  # (T, N, N)
-    dy = y.transpose(0, 2, 1) - y  # (T, N, N)
-    dz = z.transpose(0, 2, 1) - z  # (T, N, N)
-    inv_r = np.sqrt(dx**2 + dy**2 + dz**2) # (T, N, N)
-    inv_r[inv_r > 0] = 1.0 / inv_r[inv_r > 0]  # avoid division by zero
-
-    PE = G * np.sum(np.sum(np.triu(-(mass * mass.transpose(0, 2, 1)) * inv_r, 1), axis=-1), axis=-1)  # (T,)
-    return KE + PE
-
-def conserved_energy_fun(dataset, loc, vel, edges, batch=None):
-    edge_matr, _ = to_dense_batch(edges, batch)
-    edge_matr = edge_matr.cpu().numpy().repeat(edge_matr.shape[1], axis=2)
-    edge_matr = np.einsum('tij,tji ->tij', edge_matr, edge_matr)
-
-    edge_single = to_dense_batch(edges, batch)[0].cpu().numpy()
-    nploc, _ = to_dense_batch(loc, batch)
-    npvel, _ = to_dense_batch(vel, batch)
-    nploc = nploc.cpu().numpy() # (B, N, 3)
-    npvel = npvel.cpu().numpy()
-
-    # for i in range(nploc.shape[0]):
+    return total_energy('gravity', loc, vel, mass, G, memory_budget=memory_budget)
+
+def conserved_energy_fun(dataset, loc, vel, charges, n_nodes):
+    """
+    Energy of every system of a batch, computed with torch on the device of the inputs,
+    for all the leading (timestep) dimensions at once.
+    loc, vel: torch.Tensor of shape (..., B*N, 3)
+    charges: torch.Tensor of shape (B*N, 1), charges for charged, masses for gravity
+    Returns: torch.Tensor of shape (..., B)
+    """
+    loc = loc.reshape(*loc.shape[:-2], -1, n_nodes, 3)  # (..., B, N, 3)
+    vel = vel.reshape(*vel.shape[:-2], -1, n_nodes, 3)
+    charges = charges.reshape(-1, n_nodes, 1)  # (B, N, 1)
+
+    dist2 = torch.sum((loc.unsqueeze(-2) - loc.unsqueeze(-3)) ** 2, dim=-1)  # (..., B, N, N)
+    # leave out self interactions (and coinciding particles)
+    inv_r = torch.where(dist2 > 0, dist2.rsqrt(), torch.zeros_like(dist2))
+    charge_prod = charges * charges.transpose(-1, -2)  # (B, N, N)
     if dataset == "gravity":
-        energies = tot_energy_gravity_batch(nploc, npvel, edge_single)
+        K = 0.5 * torch.sum(charges * vel ** 2, dim=(-2, -1))
+        U = -0.5 * torch.sum(charge_prod * inv_r, dim=(-2, -1))
     elif dataset == "charged":
-        energies = tot_energy_charged_batch(nploc, npvel, edge_matr)
-    # elif dataset == "spring":
-    #     energies = tot_energy_spring_batch(nploc.transpose(0, 2, 1), npvel.transpose(0, 2, 1), edge_matr)
+        K = 0.5 * torch.sum(vel ** 2, dim=(-2, -1))
+        U = 0.5 * torch.sum(charge_prod * inv_r, dim=(-2, -1))
     else:
         raise ValueError(f"Unknown dataset: {dataset}")
-    return energies
+    return K + U
+
+class EnergyDriftAccumulator:
+    """
+    Running per-timestep mean and std of the relative energy drift |E_t - E_0| / (E_0 + eps)
+    of rollouts, merged batch by batch with Welford's (parallel) update, so that the energies
+    of all samples never need to be stored. Statistics are kept in float64 on the device of
+    the first update.
+    """
+
+    def __init__(self, eps=1e-10):
+        self.eps = eps
+        self.count = None  # (T,) samples seen per timestep
+        self.mean = None
+        self.m2 = None
+
+    def update(self, energies, E0, start=0):
+        """
+        energies: torch.Tensor of shape (T, B), energies of timesteps start:start + T of B rollouts
+        E0: torch.Tensor of shape (B,), initial energies of the rollouts
+        """
+        drift = torch.abs((energies.double() - E0.double()) / (E0.double() + self.eps))
+        T, B = drift.shape
+        if self.count is None or len(self.count) < start + T:
+            # grow to cover the new timesteps
+            grow = start + T - (0 if self.count is None else len(self.count))
+            zeros = torch.zeros(grow, dtype=torch.float64, device=drift.device)
+            self.count = zeros.clone() if self.count is None else torch.cat((self.count, zeros))
+            self.mean = zeros.clone() if self.mean is None else torch.cat((self.mean, zeros))
+            self.m2 = zeros.clone() if self.m2 is None else torch.cat((self.m2, zeros))
+
+        count, mean, m2 = self.count[start:start + T], self.mean[start:start + T], self.m2[start:start + T]
+        batch_mean = drift.mean(dim=1)
+        batch_m2 = torch.sum((drift - batch_mean.unsqueeze(1)) ** 2, dim=1)
+        total = count + B
+        delta = batch_mean - mean
+        # in place on the slices of the running statistics
+        m2 += batch_m2 + delta ** 2 * count * B / total
+        mean += delta * B / total
+        count += B
+
+    def summary(self):
+        """
+        Returns: dict of per-timestep energy_drift_mean, energy_drift_std (sample std) and energy_drift_count
+        """
+        if self.count is None:
+            return {}
+        std = torch.sqrt(self.m2 / (self.count - 1).clamp(min=1))
+        return {'energy_drift_mean': self.mean.cpu(), 'energy_drift_std': std.cpu(), 'energy_drift_count': self.count.cpu()}
+
+
+class BlockShuffleSampler(torch.utils.data.Sampler):
+    """
+    Shuffled order of the samples of a dataset that visits contiguous blocks of block_size
+    samples in random order, and the samples of each block in random order. Reads from
+    memory-mapped datasets stay within one block at a time, so they are mostly sequential
+    and a block of block_size samples should fit in the page cache. The samples are
+    independent simulations, so batches drawn from blocks are distributed like batches
+    drawn from the whole dataset.
+    """
+
+    def __init__(self, data_source, block_size=1024):
+        self.data_source = data_source
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        n = len(self.data_source)
+        n_blocks = (n + self.block_size - 1) // self.block_size
+        for block in torch.randperm(n_blocks).tolist():
+            start = block * self.block_size
+            size = min(self.block_size, n - start)
+            yield from (start + torch.randperm(size)).tolist()
+
+
+class DevicePrefetcher:
+    """
+    Iterates over a DataLoader with the batches already on the device. On CUDA the
+    next batch is copied on a side stream (from pinned memory, without blocking) while
+    the current step runs. Batches are lists of tensors, or None for absent fields.
+    wait_time is the time the last pass over the loader waited for batches.
+    """
+
+    def __init__(self, loader, device, prefetch=True):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if prefetch and self.device.type == 'cuda' else None
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def next_batch(self, it):
+        t = time.perf_counter()
+        batch = next(it, None)
+        self.wait_time += time.perf_counter() - t
+        if batch is None or self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return [None if d is None else d.to(self.device, non_blocking=True) for d in batch]
+
+    def __iter__(self):
+        self.wait_time = 0.
+        it = iter(self.loader)
+        batch = self.next_batch(it)
+        while batch is not None:
+            if self.stream is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_stream(self.stream)
+                for d in batch:
+                    if d is not None:
+                        # allocated on the side stream, used on the current one
+                        d.record_stream(stream)
+            # staged while the step on this batch runs
+            next_batch = self.next_batch(it)
+            yield batch
+            batch = next_batch
+
+
+def dataset_cache_key(files, **params):
+    """
+    Name of the cache entry of a preprocessed dataset.
+
+    Parameters:
+        files: source files of the dataset, identified by path, size and modification time
+        params: parameters the preprocessed tensors depend on
+
+    Returns:
+        hex digest of files and params
+    """
+    h = hashlib.sha1()
+    for f in sorted(os.path.abspath(f) for f in files):
+        st = os.stat(f)
+        h.update(f'{f}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:20]
+
+
+def load_dataset_cache(cache_dir, key):
+    """
+    Returns: dict of the tensors cached under key, memory-mapped copy-on-write so that
+        nothing is read until accessed, or None if there is no such entry
+    """
+    entry = Path(cache_dir) / key
+    if not entry.is_dir():
+        return None
+    return {f.stem: torch.from_numpy(np.load(f, mmap_mode='c')) for f in entry.glob('*.npy')}
+
+
+def save_dataset_cache(cache_dir, key, tensors, params=None):
+    """
+    Store tensors (dict of name: tensor or array) as .npy files of the entry key of
+    cache_dir, with the params they were computed for. The entry is written aside and
+    renamed in place, so concurrent runs never read a partial entry.
+    """
+    entry = Path(cache_dir) / key
+    tmp = entry.with_name(f'{key}.tmp{os.getpid()}')
+    tmp.mkdir(parents=True, exist_ok=True)
+    for name, x in tensors.items():
+        np.save(tmp / f'{name}.npy', np.asarray(x))
+    with open(tmp / 'params.json', 'w') as f:
+        json.dump(params, f, indent=4, default=str)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # written by another run in the meantime
+        shutil.rmtree(tmp)
+
 
 def compute_energy_drift(loc, vel, edges):
     """
@@ -150,28 +267,15 @@ def compute_energy_drift(loc, vel, edges):
     Returns:
     - energy_drift: np.array of shape (T,)
     """
-    T = loc.shape[0]
-    energy_drift = np.zeros(T)
-
-    # Initial energy
-    E0 = tot_energy_charged(loc[0], vel[0], edges)
-
-    for t in range(T):
-        Et = tot_energy_charged(loc[t], vel[t], edges)
-        energy_drift[t] = np.abs((Et - E0) / (E0 + 1e-10))  # epsilon for stability
+    return energy_drift('charged', np.swapaxes(loc, -1, -2), np.swapaxes(vel, -1, -2), edges)
 
-    return energy_drift
-
-def compute_energy_drift_batch(loc, vel, edges):
-    all_energy_drifts = []
-
-    for i in range(loc.shape[0]):
-        loc_i = reshape_sample(loc[i])
-        vel_i = reshape_sample(vel[i])
-        drift = compute_energy_drift(loc_i, vel_i, edges)
-        all_energy_drifts.append(drift)
-
-    # Optionally convert to np.array: shape (num_samples, T)
-    all_energy_drifts = np.stack(all_energy_drifts)
-
-    return all_energy_drifts
\ No newline at end of file
+def compute_energy_drift_batch(loc, vel, edges, memory_budget=None):
+    """
+    Relative energy drift of all samples at once.
+    loc, vel: np.array of shape (num_samples, T, N*3)
+    memory_budget: bytes of temporaries for a blocked evaluation, bounded whatever T and N
+    Returns: np.array of shape (num_samples, T)
+    """
+    S, T = loc.shape[:2]
+    return energy_drift('charged', loc.reshape(S, T, -1, 3), vel.reshape(S, T, -1, 3), edges,
+                        memory_budget=memory_budget)